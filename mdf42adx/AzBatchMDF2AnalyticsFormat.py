@@ -1,7 +1,6 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-from asammdf import MDF
 import json
 import os
 from   pathlib import Path
@@ -9,29 +8,29 @@ import time
 import uuid
 import multiprocessing as mp
 from multiprocessing import get_context
+from functools import partial
 
 # Other external script definitions to run this orchestrator script:
 from DecodeParquet import processSignalAsParquet
-from MetadataTools import writeMetadata
+from MetadataTools import calculateMetadata, writeMetadata
 from MDF2AnalyticsFormatProcessing import processSignals
+from SignalFilter import readSignalFilter
+from RemoteInput import inputBasename
+from OutputSink import openOutputSink
+from OutputFormats import createFormat, readEncodingOptions
 
 # Dedicated Azure Batch Script:
 from AzureBatch import AzureBatchEnvironmentVariables, AzureBatchProcessFilesOutputFolder
 
-# Monitor VM/Batch Pool Statistics:
-import psutil
-import shutil
+# Monitor VM/Batch Pool Statistics in the background:
+from MetricsSampler import MetricsSampler, formatSample
 
+# Uploads the output files with OUTPUT_URL (e.g. a container URL with a SAS token), created for the output folder of the task
+outputSink = None
 
 # Log the VM Statistics that can aid users to understand the performance on the VM and any hardware bottlenecks, e.g. out of memory issues
 def log_hardwareInfo():
-    memory_usage = psutil.virtual_memory()
-    memory_percent = memory_usage.percent
-    cpu_percent = psutil.cpu_percent(interval=1)
-    total, used, free = shutil.disk_usage("/")
-
-    hardwareInfoLog = f"***Memory Usage: {memory_percent:.2f}%\nCPU Usage: {cpu_percent:.2f}%\nDisk Space: Total: {total / (2**30):.2f} GB, Used: {used / (2**30):.2f} GB, Free: {free / (2**30):.2f} GB***"
-    print(hardwareInfoLog)
+    print(f"***{formatSample(metricsSampler.latest())}***")
     
 
 
@@ -42,82 +41,18 @@ def log_error(error):
     print(f"{error}")
 
 
-updates = 0
-vPreviousValue = -1 # Ensures that only one event is sent out every 10th percentage - to stop spamming with events
-
 def log_completition(result):
-    global updates, vPreviousValue
-
-    #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-    ''' Below only works when % completition is exactly 10 %, 20 %, 30 % etc.
-    if divmod(int(result), 10) == (updates, 0):
-        updates += 1
-        print(f"Completed {result:9.0f}%")
-    '''
-    #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
     '''
-        Below ensure that when a threshold is reached (one block of an if statement), one event is pushed/printed e.g. to Azure Event Grid. This ensures we are not spamming eventGrid with multiple events, e.g.
-        if there is a file with lots of signals we do not want to fire an event for 0.0001%, 0.0002%, 0.0003% etc.
+        When a 10% threshold is reached, one event is pushed/printed e.g. to Azure Event Grid. The decoding only calls it once per 10% step
+        (see SignalsDecoding), so we are not spamming eventGrid with multiple events, e.g. if there is a file with lots of signals we do not
+        want to fire an event for 0.0001%, 0.0002%, 0.0003% etc.
+        The event uses the last sample of the metrics sampler, so the collection of the results is never blocked.
     '''
-    
-    if result == 100 and vPreviousValue < 100:
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-
-    elif result >= 90 and vPreviousValue < 90:
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-
-    elif result >= 80 and vPreviousValue < 80:
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-
-    elif result >= 70 and vPreviousValue < 70:
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-
-    elif result >= 60 and vPreviousValue < 60:
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-
-    elif result >= 50 and vPreviousValue < 50:
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-
-    elif result >= 40 and vPreviousValue < 40:  
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-
-    elif result >= 30 and vPreviousValue < 30: 
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-
-    elif result >= 20 and vPreviousValue < 20: 
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-
-    elif result >= 10 and vPreviousValue < 10:   
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
-    
-    elif result >= 0 and vPreviousValue < 0:   
-        print(f'DECODING PROGRESS {result}%...')
-        log_hardwareInfo()
-        vPreviousValue = result
+    metricsSampler.progress(result)
 
 
 # This implementation writes the report to the disk    
-def createReport(basename, target, uuid, signalsMetadata, finishedSignals, errorSignals, timeoutSignals, vEntriesCount):
+def createReport(basename, target, uuid, signalsMetadata, finishedSignals, errorSignals, timeoutSignals, vEntriesCount, skippedSignals=None, telemetry=None):
     '''
          Write a JSON file with the results
 
@@ -128,6 +63,8 @@ def createReport(basename, target, uuid, signalsMetadata, finishedSignals, error
                 finishedSignals: the list of signals that were processed successfully
                 errorSignals: the list of signals that were processed with an error
                 timeoutSignals: the list of signals that were processed with a timeout
+                skippedSignals: the list of signals excluded by the signal filter
+                telemetry: the time, bytes and memory of the decoding stages (see Telemetry.summarizeTelemetry)
 
     '''
 
@@ -172,14 +109,18 @@ def createReport(basename, target, uuid, signalsMetadata, finishedSignals, error
         report = {
             "finished": finishedSignals,
             "error": errorSignals,
-            "timeout": timeoutSignals
+            "timeout": timeoutSignals,
+            "skipped": skippedSignals or [],
+            "telemetry": telemetry
         }
         reportFile.write(json.dumps(report))
 
+    if outputSink is not None:
+        outputSink.commit(os.path.join(target, f"REPORT-{basename}.json"))
     
 
 def readBlacklistedSignals():
-    # Future implementation can use this method to return a list of blacklisted signals from a file.
+    # Workers skip the blacklisted signals after opening the file, use the signal filter (see SignalFilter) to skip signals before decoding.
     return [
     ]
 
@@ -188,27 +129,48 @@ def readBlacklistedSignals():
 # Function to kick start processing (decoding) the file:
 def processFile(fileLocation, fileNameEnvVar):
     '''Processes a single MDF file.'''
+    global outputSink
+
     start_time = time.time()
-    mdf = MDF(fileLocation)
     
     # Save the processed file to a separate folder:   
     outputFolder = AzureBatchProcessFilesOutputFolder(fileNameEnvVar)
 
+    # With OUTPUT_URL the files are uploaded while the file is decoded, and the output folder only stages the files waiting for upload
+    outputSink = openOutputSink(outputFolder, os.environ.get('OUTPUT_URL'), int(os.environ.get('UPLOAD_CONCURRENCY', 4)), int(os.environ.get('UPLOAD_STAGING_MB', 1024)))
+
     # Decoding processess:
-    basename = Path(fileLocation).stem
+    basename = inputBasename(fileLocation)
     file_uuid = uuid.uuid4()  
     numberOfChunks = 0
     
     # Send an event to say ready to start decoding:
     print(f"Ready to start decoding for file {fileLocation}...")
 
-    signalsMetadata = writeMetadata(basename, mdf, file_uuid, outputFolder, fileLocation)
+    # Reads the MDF file metadata with all the file and signal information
+    metadata = calculateMetadata(fileLocation, basename, file_uuid)
+    signalsMetadata = metadata["signals"]
     numberOfSignals = len(signalsMetadata)
     print(f"Total Number of Signals: {numberOfSignals}")
-    processSignals(fileLocation, basename, file_uuid, outputFolder, signalsMetadata, readBlacklistedSignals(), processSignalAsParquet, numberOfSignals, log_result, log_error, log_completition, createReport)
+
+    # The encoding profile (PARQUET_PROFILE) and the signal filter (SIGNAL_FILTER_FILE) apply as with the command line options
+    fileFormat = createFormat("parquet", **readEncodingOptions(os.environ.get('PARQUET_PROFILE')))
+    signalFilter = readSignalFilter(os.environ.get('SIGNAL_FILTER_FILE'))
+    print(f"Parquet profile: {os.environ.get('PARQUET_PROFILE') or 'default'}, signal filter: {os.environ.get('SIGNAL_FILTER_FILE') or 'none'}")
+
+    processSignals(fileLocation, basename, file_uuid, outputFolder, signalsMetadata, readBlacklistedSignals(), partial(processSignalAsParquet, outputSink=outputSink, fileFormat=fileFormat), numberOfSignals, log_result, log_error, log_completition, createReport, signalFilter=signalFilter, outputSink=outputSink, fileFormat=fileFormat)
+
+    # Writes the calculated metadata, with the decoding status of each signal
+    writeMetadata(metadata, basename, file_uuid, outputFolder, outputSink)
 
     end_time = time.time()
 
+    # The metrics of the whole task are written next to the report
+    metricsSampler.stop()
+    metricsSampler.write(os.path.join(outputFolder, f"METRICS-{basename}.json"))
+    outputSink.commit(os.path.join(outputFolder, f"METRICS-{basename}.json"))
+    outputSink.close()
+
     print (f"Processing {fileLocation} started at {start_time} and ended at {end_time} (took {time.time() - start_time} secs / {(time.time() - start_time)/60} mins) and has {numberOfSignals} signals")
 
     # Decoding finish:
@@ -226,11 +188,18 @@ if __name__ == "__main__":
 
     try:
         print('Starting up...')
+
+        # Sample the VM Statistics every METRICS_INTERVAL seconds (default 5) while the file is decoded
+        metricsSampler = MetricsSampler(float(os.environ.get('METRICS_INTERVAL', 5)))
+        metricsSampler.start()
         log_hardwareInfo() # Log the VM Statistics before any decoding happens
         
         taskWorkingDirectory, taskBatchDirectory, taskNodeRootDirectory, fileNameEnvVar = AzureBatchEnvironmentVariables() # Read the Azure Batch Environment variables - external script 
 
         fileLocation = f"{taskWorkingDirectory}/{fileNameEnvVar}" # Construct the full location of the raw mf4 file on the VM Volume
+
+        # With CUSTOM_FILE_URL (e.g. a blob URL with a SAS token) the file is read with range requests while it is decoded, instead of being staged on the VM Volume
+        fileLocation = os.environ.get('CUSTOM_FILE_URL') or fileLocation
         processFile(fileLocation, fileNameEnvVar) # Main function for decoding processess of MDF files
         print("File Processed ...")
 
@@ -0,0 +1,337 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+import argparse
+import asammdf
+from asammdf import Source
+from datetime import datetime
+from functools import partial
+import json
+import multiprocessing as mp
+from multiprocessing import get_context
+import numpy as np
+import gzip
+import os
+import pyarrow.parquet as pq
+from pathlib import Path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from MDF2AnalyticsFormatProcessing import processSignals, prepareFile
+from MetadataTools import calculateMetadata, DECODER_VERSION
+from DecodeParquet import processSignalAsParquet, processGroupAsParquet
+from DecodeWideParquet import processGroupAsWideParquet
+from DecodeCSV import processSignalAsCsv, processGroupAsCsv
+from OutputFormats import ArrowFormat
+from SampleReduction import readSampleReduction
+
+# Version of the structure of the results file
+BENCHMARK_VERSION = "1.0"
+
+SIGNAL_TYPES = ["float", "int", "uint64", "string", "text", "record"]
+
+# Method and group batch size of each benchmark case, as selected by MDF2AnalyticsFormat for the same options
+CASES = {
+    "parquet": (processSignalAsParquet, None),
+    "parquet-group": (processGroupAsParquet, 0),
+    "parquet-coalesced": (partial(processGroupAsParquet, targetFileSize=256 * 2**20), 0),
+    "parquet-wide": (processGroupAsWideParquet, 0),
+    "arrow": (partial(processSignalAsParquet, fileFormat=ArrowFormat()), None),
+    "csv": (processSignalAsCsv, None),
+    "csv-group": (processGroupAsCsv, 0),
+}
+
+def parseTypeMix(typeMix):
+    '''
+        Parses a type mix such as float=4,int=2,string=1 into a list of (type, weight).
+    '''
+    weights = []
+    for item in typeMix.split(","):
+        signalType, _, weight = item.partition("=")
+        if signalType not in SIGNAL_TYPES:
+            raise ValueError(f"Unknown signal type {signalType}, use one of {', '.join(SIGNAL_TYPES)}")
+        weights.append((signalType, int(weight or 1)))
+
+    return weights
+
+def signalTypes(numberOfSignals, typeMix):
+    '''
+        Returns the type of each signal, cycling over the types of the mix according to their weights.
+    '''
+    cycle = [signalType for signalType, weight in parseTypeMix(typeMix) for _ in range(weight)]
+
+    return [cycle[index % len(cycle)] for index in range(numberOfSignals)]
+
+def createSignal(index, signalType, timestamps, rng, source):
+    '''
+        Creates a signal with random samples of the given type.
+    '''
+    numberOfSamples = len(timestamps)
+    name = f"{signalType.capitalize()}Signal{index}"
+
+    if signalType == "float":
+        samples = 100 * np.sin(2 * np.pi * rng.uniform(0.1, 10) * timestamps) + rng.normal(0, 5, size=numberOfSamples)
+    elif signalType == "int":
+        samples = rng.integers(-2**31, 2**31, size=numberOfSamples, dtype=np.int32)
+    elif signalType == "uint64":
+        samples = rng.integers(0, 2**64, size=numberOfSamples, dtype=np.uint64, endpoint=False)
+    elif signalType == "string":
+        samples = np.char.add(b"Value ", rng.integers(0, 10000, size=numberOfSamples).astype("S5"))
+        return asammdf.Signal(samples, timestamps, name=name, source=source, encoding="utf-8")
+    elif signalType == "text":
+        # Value range to text conversion, as in CreateSampleMDF
+        conversion = {f"lower_{i}": i * 10 for i in range(20)}
+        conversion.update({f"upper_{i}": (i + 1) * 10 for i in range(20)})
+        conversion.update({f"text_{i}": f"Level {i}" for i in range(20)})
+        conversion["default"] = b"Unknown level"
+        samples = rng.integers(0, 240, size=numberOfSamples, dtype=np.uint8)
+        return asammdf.Signal(samples, timestamps, name=name, source=source, conversion=conversion)
+    else:
+        samples = np.empty(numberOfSamples, dtype=[("counter", "<u1"), ("value", "<f8")])
+        samples["counter"] = np.arange(numberOfSamples) % 256
+        samples["value"] = rng.normal(0, 1, size=numberOfSamples)
+
+    return asammdf.Signal(samples, timestamps, name=name, unit="-", source=source)
+
+def generateFile(filename, numberOfSignals, numberOfSamples, typeMix, signalsPerGroup=0, compression=0, seed=0):
+    '''
+        Generates a MDF-4 file with random signals. The same arguments always generate the same file content.
+
+        Args:
+            filename: the MDF-4 file to create
+            numberOfSignals: the number of signals
+            numberOfSamples: the number of samples of each signal, sampled every millisecond
+            typeMix: the types of the signals with their weights, for example float=4,int=2,string=1 (see SIGNAL_TYPES)
+            signalsPerGroup: the number of signals of each channel group, 0 for a single channel group
+            compression: the compression of the data blocks, 0 none, 1 deflate and 2 transposed deflate
+            seed: the seed of the random samples
+    '''
+    rng = np.random.default_rng(seed)
+    source = Source(source_type=Source.SOURCE_ECU, bus_type=Source.BUS_TYPE_CAN, name="BenchmarkECU", path="Benchmark", comment="Generated")
+    timestamps = np.arange(numberOfSamples, dtype=np.float64) / 1000
+    types = signalTypes(numberOfSignals, typeMix)
+    signalsPerGroup = signalsPerGroup or numberOfSignals
+
+    mdf = asammdf.MDF()
+
+    for first in range(0, numberOfSignals, signalsPerGroup):
+        signals = [createSignal(index, types[index], timestamps, rng, source) for index in range(first, min(first + signalsPerGroup, numberOfSignals))]
+        mdf.append(signals, common_timebase=True)
+
+    mdf.save(filename, overwrite=True, compression=compression)
+    mdf.close()
+
+def peakMemoryMB(who):
+    '''
+        Returns the peak resident memory in MB of the current process (RUSAGE_SELF) or of its finished child processes
+        (RUSAGE_CHILDREN), or None where the resource module is not available.
+    '''
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(who).ru_maxrss
+
+    # Linux reports kilobytes and macOS bytes
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+def directorySize(directory):
+    return sum(os.path.getsize(os.path.join(folder, file)) for folder, _, files in os.walk(directory) for file in files)
+
+def exportedFiles(directory):
+    '''
+        Returns the parquet and CSV files of an export by their path relative to directory.
+    '''
+    return {
+        os.path.relpath(os.path.join(folder, file), directory): os.path.join(folder, file)
+        for folder, _, files in os.walk(directory) for file in files if file.endswith((".parquet", ".csv.gz"))
+    }
+
+def compareExports(directory, otherDirectory):
+    '''
+        Compares the content of the files of two exports of the same file with the same run ID, ignoring how the rows are
+        split in row groups.
+
+        Returns:
+            the list of the files that are missing in one of the exports or that have different content
+    '''
+    files = exportedFiles(directory)
+    otherFiles = exportedFiles(otherDirectory)
+    differences = sorted(set(files) ^ set(otherFiles))
+
+    for relativePath in sorted(set(files) & set(otherFiles)):
+        if relativePath.endswith(".parquet"):
+            table, otherTable = pq.read_table(files[relativePath]), pq.read_table(otherFiles[relativePath])
+            # pandas compares the NaN values of the value column as equal
+            equal = table.schema.equals(otherTable.schema) and table.to_pandas().equals(otherTable.to_pandas())
+        else:
+            with gzip.open(files[relativePath]) as csvFile, gzip.open(otherFiles[relativePath]) as otherCsvFile:
+                equal = csvFile.read() == otherCsvFile.read()
+        if not equal:
+            differences.append(relativePath)
+
+    return differences
+
+def runCase(name, filename, target, results, chunkRecords=None, downsampling=None):
+    '''
+        Decodes the file with the method of a case and puts its measurements in the results queue.
+        Runs in its own process, so the peak memory of the process and of its workers belongs to this case only.
+
+        Args:
+            chunkRecords: the --chunk-records of the decoding, None to decode the signals at once
+            downsampling: the --downsample rules of the decoding (see SampleReduction)
+    '''
+    # The decoding logs every signal, only the measurements are reported
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    method, groupBatchSize = CASES[name]
+    if chunkRecords is not None:
+        method = partial(method, chunkRecords=chunkRecords)
+    if downsampling:
+        method = partial(method, reduction=readSampleReduction(downsamplingRules=downsampling))
+
+    basename = Path(filename).stem
+    # The run ID depends on the content of the file, so the exports of the same file can be compared
+    file_uuid, metadata = prepareFile(filename, basename, runId="content")
+    signalsMetadata = metadata["signals"]
+    report = {}
+
+    def createReport(basename, target, uuid, signalsMetadata, finishedSignals, errorSignals, timeoutSignals, vEntriesCount, skippedSignals=None, telemetry=None):
+        report.update(
+            failed=len([signal for signal in finishedSignals if signal["value"][1] != True]) + len(errorSignals),
+            timeout=len(timeoutSignals),
+            samples=vEntriesCount,
+            stages={name: stage["sum"] for name, stage in telemetry["stages"].items()} if telemetry else {},
+        )
+
+    ignore = lambda value: None
+
+    start_time = time.perf_counter()
+    processSignals(filename, basename, file_uuid, target, signalsMetadata, [], method, len(signalsMetadata), ignore, ignore, ignore, createReport, groupBatchSize=groupBatchSize)
+    seconds = time.perf_counter() - start_time
+
+    results.put(
+        {
+            "case": name,
+            "seconds": seconds,
+            "samples": report.get("samples", 0),
+            "failed_signals": report.get("failed", len(signalsMetadata)),
+            "timeout_signals": report.get("timeout", 0),
+            "output_bytes": directorySize(target),
+            "peak_rss_mb": peakMemoryMB(resource.RUSAGE_SELF) if resource is not None else None,
+            "workers_peak_rss_mb": peakMemoryMB(resource.RUSAGE_CHILDREN) if resource is not None else None,
+            "stage_seconds": report.get("stages", {}),
+        }
+    )
+
+def runBenchmark(filename, cases, workdir, chunkRecords=None, downsampling=None, checkChunks=False):
+    '''
+        Measures the metadata calculation and the decoding of the file with each case.
+
+        Args:
+            chunkRecords: the --chunk-records of the decoding, None to decode the signals at once
+            downsampling: the --downsample rules of the decoding (see SampleReduction)
+            checkChunks: if set, the file is also decoded without chunkRecords and the files of both exports are compared
+        Returns:
+            the measurements of the metadata and of each case, with the throughput in samples and input MB per second
+    '''
+    fileSize = os.path.getsize(filename)
+
+    start_time = time.perf_counter()
+    metadata = calculateMetadata(filename, Path(filename).stem, "benchmark")
+    metadataSeconds = time.perf_counter() - start_time
+
+    caseResults = []
+    for name in cases:
+        target = os.path.join(workdir, name)
+        os.makedirs(target, exist_ok=True)
+
+        results = get_context("spawn").Queue()
+        process = get_context("spawn").Process(target=runCase, args=(name, filename, target, results, chunkRecords, downsampling))
+        process.start()
+        result = results.get()
+        process.join()
+
+        # The windows of a chunked decoding must give the same files as decoding each signal at once
+        if checkChunks:
+            unchunkedTarget = f"{target}-unchunked"
+            os.makedirs(unchunkedTarget, exist_ok=True)
+            process = get_context("spawn").Process(target=runCase, args=(name, filename, unchunkedTarget, results, None, downsampling))
+            process.start()
+            results.get()
+            process.join()
+
+            result["chunk_differences"] = compareExports(target, unchunkedTarget)
+            print(f"{name}: {len(result['chunk_differences'])} files differ with --chunk-records {chunkRecords}: {', '.join(result['chunk_differences'])}" if result["chunk_differences"] else f"{name}: chunked and unchunked files are equal")
+            shutil.rmtree(unchunkedTarget, ignore_errors=True)
+
+        result["samples_per_second"] = result["samples"] / result["seconds"]
+        result["input_mb_per_second"] = fileSize / 2**20 / result["seconds"]
+        result["output_mb_per_second"] = result["output_bytes"] / 2**20 / result["seconds"]
+        caseResults.append(result)
+
+        print(f"{name}: {result['seconds']:.2f} s, {result['samples_per_second']:.0f} samples/s, {result['input_mb_per_second']:.1f} MB/s, {result['output_bytes'] / 2**20:.1f} MB output, workers peak RSS {result['workers_peak_rss_mb']} MB")
+
+        shutil.rmtree(target, ignore_errors=True)
+
+    return {
+        "metadata": {"seconds": metadataSeconds, "signals": len(metadata["signals"])},
+        "cases": caseResults,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates a synthetic MDF-4 file and measures the decoding throughput and memory of each export method.")
+    parser.add_argument("--signals", dest="numberOfSignals", type=int, default=100, help="Number of signals of the generated file. Default is 100")
+    parser.add_argument("--samples", dest="numberOfSamples", type=int, default=100000, help="Number of samples of each signal. Default is 100000")
+    parser.add_argument("--types", dest="typeMix", default="float=4,int=2,uint64=1,string=1,text=1,record=1", help=f"Signal types with their weights, from {', '.join(SIGNAL_TYPES)}. Default is float=4,int=2,uint64=1,string=1,text=1,record=1")
+    parser.add_argument("--signals-per-group", dest="signalsPerGroup", type=int, default=0, help="Number of signals of each channel group. Default 0 puts all signals in one channel group.")
+    parser.add_argument("--compression", dest="compression", type=int, choices=[0, 1, 2], default=0, help="Compression of the data blocks: 0 none, 1 deflate, 2 transposed deflate. Default is 0")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Seed of the random samples. Default is 0")
+    parser.add_argument("--cases", dest="cases", nargs="+", choices=list(CASES), default=["parquet", "parquet-group", "csv"], help="Export methods to measure. Default is parquet parquet-group csv")
+    parser.add_argument("--file", dest="file", default=None, help="Benchmark this MDF-4 file instead of generating one.")
+    parser.add_argument("--chunk-records", dest="chunkRecords", type=int, default=None, help="Decode the signals in windows of this number of records, as with --chunk-records of MDF2AnalyticsFormat.")
+    parser.add_argument("--downsample", dest="downsampling", action="append", default=None, help="Downsampling rule, as with --downsample of MDF2AnalyticsFormat. Can be repeated.")
+    parser.add_argument("--check-chunks", dest="checkChunks", action="store_true", help="With --chunk-records, also decode the file without windows and check that the files of both exports are equal.")
+    parser.add_argument("--output", dest="output", default=None, help="JSON file with the results. Default is benchmark-<date>.json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="mdf42adx-benchmark-")
+
+    try:
+        parameters = vars(args).copy()
+        filename = args.file
+
+        if filename is None:
+            filename = os.path.join(workdir, "benchmark.mf4")
+            start_time = time.perf_counter()
+            generateFile(filename, args.numberOfSignals, args.numberOfSamples, args.typeMix, args.signalsPerGroup, args.compression, args.seed)
+            print(f"Generated {filename} with {args.numberOfSignals} signals of {args.numberOfSamples} samples in {time.perf_counter() - start_time:.2f} s")
+
+        results = {
+            "benchmark_version": BENCHMARK_VERSION,
+            "decoder_version": DECODER_VERSION,
+            "date": datetime.utcnow().isoformat() + "Z",
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "asammdf": asammdf.__version__,
+            "cpu_count": mp.cpu_count(),
+            "parameters": parameters,
+            "file_bytes": os.path.getsize(filename),
+        }
+        results.update(runBenchmark(filename, args.cases, workdir, args.chunkRecords, args.downsampling, args.checkChunks and args.chunkRecords is not None))
+
+        output = args.output or f"benchmark-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json"
+        with open(output, "w") as outputFile:
+            outputFile.write(json.dumps(results, indent=2))
+
+        print(f"Results written to {output}")
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
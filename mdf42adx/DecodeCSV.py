@@ -1,13 +1,33 @@
-from asammdf import MDF
 import csv
 import gzip
+import io
 import os
 import time 
 import re
 import multiprocessing as mp
-from DecodeUtils import getSource, extractSignalsByType
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+from DecodeUtils import getSource, extractSignalsByType, rawColumn, selectDecodedAndRaw, iterRecordWindows, getRecordsCount, constantColumn
+from MdfCache import getMdf, releaseMdf
+from Telemetry import stage, setSignal, withTelemetry
 
-def processSignalAsCsv(counter, filename, signalMetadata, uuid, targetdir, blacklistedSignals):
+# python-isal provides a multithreaded gzip compressor, if it is not installed compression uses a single thread
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+# Number of rows formatted and compressed at a time, this bounds the memory used by the writer
+CSV_CHUNK_SIZE = 1000000
+# Default gzip level, the level of gzip.open used by the previous versions. Lower levels are faster but write larger files
+CSV_COMPRESSION_LEVEL = 9
+# Number of rows formatted by the arrow CSV writer before they are compressed
+CSV_BATCH_SIZE = 65536
+
+@withTelemetry
+def processSignalAsCsv(counter, filename, signalMetadata, uuid, targetdir, blacklistedSignals, chunkSize=CSV_CHUNK_SIZE, compressionLevel=CSV_COMPRESSION_LEVEL, compressionThreads=1, chunkRecords=None, reduction=None):
 
     start_signal_time = time.time()
     print(f"pid {os.getpid()}: Launched task signal {counter}: {signalMetadata['name']}")
@@ -19,50 +39,323 @@ def processSignalAsCsv(counter, filename, signalMetadata, uuid, targetdir, black
     group_index = signalMetadata["group_index"]
     channel_index = signalMetadata["channel_index"]
 
-    # Open the MDF file and select a single signal
-    mdf = MDF(filename)          
-    # We select a specific signal, both decoded and raw
-    decodedSignal = mdf.select(channels=[(None, group_index, channel_index)])[0]
-    rawSignal = mdf.select(channels=[(None, group_index, channel_index)], raw=True)[0]
-    
-    print(f"pid {os.getpid()}: Processing signal {counter}: {decodedSignal.name} group index {group_index} channel index {channel_index} with type {decodedSignal.samples.dtype}")   
-
-
-    # Escape all characters from the decodedSignal.name and use only alphanumeric and underscore for the basename
-    # This is to avoid issues with the basename_template and parquet
-    escaped_signal_name = re.sub(r"[^a-zA-Z0-9_]", "_", decodedSignal.name)
-    targetfile = os.path.join(targetdir, f"{escaped_signal_name}-{uuid}-{counter}.csv.gz")
-    os.makedirs(os.path.dirname(targetfile), exist_ok=True)
-
-    # open the file in the write mode
-    with gzip.open(targetfile, 'wt') as csvFile:
-
-        floatSignals, stringSignals = extractSignalsByType(decodedSignal=decodedSignal, rawSignal=rawSignal)                       
-
-        writer = csv.writer(csvFile)
-        writer.writerow(["source_uuid", "group_index", "channel_index", "name", "unit", "timestamp", "value", "value_string", "value_raw"])                
-                        
-        # Iterate on the entries for the signal
-        for indx in range(0, len(decodedSignal.timestamps)):
-
-            writer.writerow(
-                [
-                    str(uuid),
-                    group_index,
-                    channel_index,
-                    decodedSignal.name, 
-                    decodedSignal.unit, 
-                    decodedSignal.timestamps[indx],
-                    floatSignals[indx],
-                    stringSignals[indx],
-                    rawSignal[indx],
-                ]
-            )
-
-    csvFile.close()
-    
+    # Open the MDF file (or reuse the one cached by this worker) and select a single signal
+    with stage("open"):
+        mdf = getMdf(filename)          
+
+    try:
+        reductions = [reduction.forSignal(signalMetadata)] if reduction is not None else None
+
+        # Long signals are decoded in windows of chunkRecords records to bound the memory used
+        if chunkRecords and getRecordsCount(mdf, group_index) > chunkRecords:
+            return streamSignalsAsCsv([counter], mdf, [(None, group_index, channel_index)], uuid, targetdir, chunkRecords, start_signal_time, chunkSize, compressionLevel, compressionThreads, reductions)[0]
+
+        # We select a specific signal, reading the raw samples once and decoding them in memory
+        decodedSignal, rawSignal = selectDecodedAndRaw(mdf, [(None, group_index, channel_index)], reductions)[0]
+        
+        print(f"pid {os.getpid()}: Processing signal {counter}: {decodedSignal.name} group index {group_index} channel index {channel_index} with type {decodedSignal.samples.dtype}")   
+
+        return writeSignalAsCsv(counter, decodedSignal, rawSignal, group_index, channel_index, uuid, targetdir, start_signal_time, chunkSize, compressionLevel, compressionThreads)
+
+    finally:
+        releaseMdf(mdf)
+
+@withTelemetry
+def processGroupAsCsv(counters, filename, signalsMetadata, uuid, targetdir, blacklistedSignals, chunkSize=CSV_CHUNK_SIZE, compressionLevel=CSV_COMPRESSION_LEVEL, compressionThreads=1, chunkRecords=None, reduction=None):
+    '''
+        Creates the CSV export for a batch of signals that belong to the same channel group.
+        The MDF file is opened once and all channels of the batch are selected together, so the records
+        of the channel group are read once for the whole batch instead of twice per signal.
+
+        Args:
+            counters: the position of each signal of the batch in the file metadata
+            filename: the MDF-4 file to process
+            signalsMetadata: the metadata of each signal of the batch, in the same order as counters
+            uuid: the UUID that identifies this decoding run
+            targetdir: the directory where the CSV files are written
+            blacklistedSignals: the list of signals to skip
+            chunkSize, compressionLevel, compressionThreads: see writeSignalAsCsv
+            chunkRecords: if set, channel groups with more records are decoded and written in windows of chunkRecords records
+            reduction: the time window and downsampling of the signals (see SampleReduction), None to export all samples
+        Returns:
+            a list with one result per signal, with the same structure as processSignalAsCsv
+    '''
+
+    print(f"pid {os.getpid()}: Launched task for {len(counters)} signals of group index {signalsMetadata[0]['group_index']}")
+
+    results = []
+    selected = []
+
+    for counter, signalMetadata in zip(counters, signalsMetadata):
+        if signalMetadata["name"] in blacklistedSignals:
+            results.append((f"pid {os.getpid()}", False, counter, f">>> Skipped: {signalMetadata}", 0))
+        else:
+            selected.append((counter, signalMetadata))
+
+    if len(selected) == 0:
+        return results
+
+    with stage("open"):
+        mdf = getMdf(filename)
+
+    try:
+        channels = [(None, signalMetadata["group_index"], signalMetadata["channel_index"]) for _, signalMetadata in selected]
+        reductions = [reduction.forSignal(signalMetadata) for _, signalMetadata in selected] if reduction is not None else None
+
+        # Long channel groups are decoded in windows to bound the memory used
+        if chunkRecords and getRecordsCount(mdf, selected[0][1]["group_index"]) > chunkRecords:
+            results.extend(streamSignalsAsCsv([counter for counter, _ in selected], mdf, channels, uuid, targetdir, chunkRecords, time.time(), chunkSize, compressionLevel, compressionThreads, reductions))
+            return results
+
+        # We select all signals of the batch with a single pass over the channel group, decoding them in memory
+        signals = selectDecodedAndRaw(mdf, channels, reductions)
+
+        for (counter, signalMetadata), (decodedSignal, rawSignal) in zip(selected, signals):
+            start_signal_time = time.time()
+            setSignal(counter)
+
+            try:
+                results.append(writeSignalAsCsv(counter, decodedSignal, rawSignal, signalMetadata["group_index"], signalMetadata["channel_index"], uuid, targetdir, start_signal_time, chunkSize, compressionLevel, compressionThreads))
+            except Exception as e:
+                results.append((f"pid {os.getpid()}", False, counter, f"Signal {counter}: {decodedSignal.name} failed: {str(e)}", 0))
+
+        setSignal(None)
+
+    except Exception as e:
+        # If the channel group cannot be read, every signal without a result is reported as failed
+        processedCounters = set(result[2] for result in results)
+        for counter, signalMetadata in selected:
+            if counter not in processedCounters:
+                results.append((f"pid {os.getpid()}", False, counter, f"Signal {counter}: {signalMetadata['name']} failed: {str(e)}", 0))
+
+    finally:
+        releaseMdf(mdf)
+
+    return results
+
+def writeSignalAsCsv(counter, decodedSignal, rawSignal, group_index, channel_index, uuid, targetdir, start_signal_time, chunkSize=CSV_CHUNK_SIZE, compressionLevel=CSV_COMPRESSION_LEVEL, compressionThreads=1):
+    '''
+        Writes a decoded signal to a compressed CSV file and returns the result for processSignals.
+
+        Args:
+            chunkSize: the number of rows formatted and compressed at a time
+            compressionLevel: the gzip compression level
+            compressionThreads: the number of compression threads, more than one requires python-isal (levels 0 to 3)
+    '''
+
+    stream = CsvSignalStream(counter, group_index, channel_index, uuid, targetdir, chunkSize, compressionLevel, compressionThreads)
+    try:
+        stream.write(decodedSignal, rawSignal)
+    finally:
+        stream.close()
+
     end_signal_time = time.time() - start_signal_time
-    mdf.close()
-    
+
     return (f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {decodedSignal.name} with {len(decodedSignal.timestamps)} entries in {end_signal_time}", len(decodedSignal.timestamps))
-    
\ No newline at end of file
+
+def streamSignalsAsCsv(counters, mdf, channels, uuid, targetdir, chunkRecords, start_signal_time, chunkSize=CSV_CHUNK_SIZE, compressionLevel=CSV_COMPRESSION_LEVEL, compressionThreads=1, reductions=None):
+    '''
+        Decodes the channels of a channel group in windows of chunkRecords records and appends each window to the
+        compressed CSV file of its signal. Only one window is kept in memory.
+
+        Returns:
+            a list with one result per signal, with the same structure as writeSignalAsCsv
+    '''
+    streams = [CsvSignalStream(counter, group_index, channel_index, uuid, targetdir, chunkSize, compressionLevel, compressionThreads) for counter, (_, group_index, channel_index) in zip(counters, channels)]
+    errors = {}
+
+    try:
+        for window in iterRecordWindows(mdf, channels, chunkRecords, reductions):
+            for counter, stream, (decodedSignal, rawSignal) in zip(counters, streams, window):
+                if counter in errors:
+                    continue
+                setSignal(counter)
+                try:
+                    stream.write(decodedSignal, rawSignal)
+                except Exception as e:
+                    errors[counter] = f"Signal {counter}: {decodedSignal.name} failed: {str(e)}"
+            setSignal(None)
+            del window
+
+    finally:
+        for stream in streams:
+            stream.close()
+
+    end_signal_time = time.time() - start_signal_time
+
+    results = []
+    for counter, stream in zip(counters, streams):
+        if counter in errors:
+            results.append((f"pid {os.getpid()}", False, counter, errors[counter], 0))
+        else:
+            results.append((f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {stream.name} with {stream.numberOfSamples} entries in {stream.windows} windows in {end_signal_time}", stream.numberOfSamples))
+
+    return results
+
+class CsvSignalStream:
+    '''
+        Writes a signal, decoded at once or in windows, to a compressed CSV file.
+
+        The rows are formatted by the arrow CSV writer a chunk at a time, so the memory used does not depend on the length
+        of the signal. The columns that have the same value in every row are created once per window and reused for every chunk.
+
+        The file has the format written with the csv module by the previous versions: values are only quoted when they
+        contain a comma, a quote or a line break, lines end with CRLF and floats are rendered as str does (see floatText).
+        The arrow writer can't quote only some values, so the chunks with such values are written with the csv module.
+    '''
+
+    def __init__(self, counter, group_index, channel_index, uuid, targetdir, chunkSize, compressionLevel, compressionThreads):
+        self.counter = counter
+        self.group_index = group_index
+        self.channel_index = channel_index
+        self.uuid = uuid
+        self.targetdir = targetdir
+        self.chunkSize = chunkSize
+        self.compressionLevel = compressionLevel
+        self.compressionThreads = compressionThreads
+        self.csvFile = None
+        self.name = None
+        self.numberOfSamples = 0
+        self.windows = 0
+
+    def write(self, decodedSignal, rawSignal):
+        if self.csvFile is None:
+            self.name = decodedSignal.name
+
+            # Escape all characters from the decodedSignal.name and use only alphanumeric and underscore for the basename
+            # This is to avoid issues with the basename_template and parquet
+            escaped_signal_name = re.sub(r"[^a-zA-Z0-9_]", "_", decodedSignal.name)
+            targetfile = os.path.join(self.targetdir, f"{escaped_signal_name}-{self.uuid}-{self.counter}.csv.gz")
+            os.makedirs(os.path.dirname(targetfile), exist_ok=True)
+
+            # open the file in the write mode
+            self.csvFile = openCompressedFile(targetfile, self.compressionLevel, self.compressionThreads)
+
+        numberOfSamples = len(decodedSignal.timestamps)
+        chunkSize = self.chunkSize
+
+        with stage("extract"):
+            floatSignals, stringSignals = extractSignalsByType(decodedSignal=decodedSignal, rawSignal=rawSignal)
+
+            # Records and arrays can't be written to a CSV cell, their raw value is the rendered string
+            rawSamples = rawColumn(rawSignal, stringSignals)
+
+        constantColumns = {
+            "source_uuid": constantColumn(str(self.uuid), min(chunkSize, numberOfSamples)),
+            "group_index": constantColumn(self.group_index, min(chunkSize, numberOfSamples), pa.int32()),
+            "channel_index": constantColumn(self.channel_index, min(chunkSize, numberOfSamples), pa.int32()),
+            "name": constantColumn(decodedSignal.name, min(chunkSize, numberOfSamples)),
+            "unit": constantColumn(decodedSignal.unit, min(chunkSize, numberOfSamples)),
+        }
+
+        for start in range(0, max(numberOfSamples, 1), chunkSize):
+            end = min(start + chunkSize, numberOfSamples)
+
+            chunk = {name: column.slice(0, end - start) for name, column in constantColumns.items()}
+            chunk["timestamp"] = decodedSignal.timestamps[start:end]
+            chunk["value"] = floatSignals[start:end]
+            chunk["value_string"] = stringSignals[start:end]
+            chunk["value_raw"] = rawSamples[start:end]
+
+            with stage("build"):
+                table = pa.table(chunk)
+
+                columns = dict(zip(table.column_names, table.columns))
+                for name, column in columns.items():
+                    if not pa.types.is_floating(column.type):
+                        continue
+                    # The raw value of a float signal without conversion is its value, which is rendered once
+                    if name == "value_raw" and column.equals(table.column("value")):
+                        columns[name] = columns["value"]
+                    else:
+                        columns[name] = floatText(column)
+                table = pa.table(columns)
+
+            with stage("write"):
+                # The column names never need quotes
+                if self.windows == 0 and start == 0:
+                    self.csvFile.write((",".join(table.column_names) + "\r\n").encode())
+
+                writeCsvRows(self.csvFile, table)
+
+        self.numberOfSamples += numberOfSamples
+        self.windows += 1
+
+    def close(self):
+        # Closing flushes the last compressed block
+        with stage("write"):
+            if self.csvFile is not None:
+                self.csvFile.close()
+                self.csvFile = None
+
+def floatText(column):
+    '''
+        Renders a float column as str renders each value. The arrow cast also writes the shortest representation, but
+        without ".0" for integral values and with other limits for the scientific notation, which str uses below 1e-4
+        and from 1e16. The values whose notation differs are rendered by str, which is only done for the few signals
+        that have them.
+    '''
+    # The columns of a chunk are built from a single array
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+
+    if pa.types.is_float16(column.type):
+        return pa.array([str(value) for value in column.to_numpy(zero_copy_only=False)], pa.string())
+
+    text = pc.cast(column, pa.string())
+
+    # str compares the value as a double, also for float32 values
+    magnitude = pc.abs(pc.cast(column, pa.float64()))
+
+    integral = pc.fill_null(pc.and_(pc.equal(column, pc.floor(column)), pc.less(magnitude, 1e16)), False)
+    if pc.any(integral).as_py():
+        text = pc.replace_with_mask(text, integral, pc.binary_join_element_wise(text.filter(integral), ".0", ""))
+    scientific = pc.or_(pc.greater_equal(magnitude, 1e16), pc.and_(pc.greater(magnitude, 0), pc.less(magnitude, 1e-4)))
+    # str writes at least two digits in the exponent, which arrow only does from 1e-10
+    rendered = pc.or_(pc.xor(pc.match_substring(text, "e"), scientific), pc.and_(pc.less(magnitude, 1e-4), pc.greater(magnitude, 1e-10)))
+    rendered = pc.fill_null(rendered, False)
+
+    if pc.any(rendered).as_py():
+        text = pc.replace_with_mask(text, rendered, pa.array([str(value) for value in column.filter(rendered).to_numpy(zero_copy_only=False)], pa.string()))
+
+    return text
+
+def needsQuotes(column):
+    '''
+        Returns True if a value of a text column contains a comma, a quote or a line break, which the csv module quotes.
+    '''
+    # The constant columns have a dictionary with their single value
+    if pa.types.is_dictionary(column.type):
+        return any(needsQuotes(chunk.dictionary) for chunk in column.chunks)
+
+    if not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+        return False
+
+    return pc.any(pc.match_substring_regex(column, r'[,"\r\n]')).as_py() or False
+
+def writeCsvRows(csvFile, table):
+    '''
+        Writes the rows of a table without header to a binary file, with the format of the csv module.
+    '''
+    if any(needsQuotes(column) for column in table.columns):
+        text = io.TextIOWrapper(csvFile, encoding="utf-8", newline="", write_through=True)
+        try:
+            csv.writer(text).writerows(zip(*[column.to_pylist() for column in table.columns]))
+        finally:
+            text.detach()
+        return
+
+    # Without values to quote, the arrow writer writes the same rows, with LF line ends
+    for batch in table.to_batches(max_chunksize=CSV_BATCH_SIZE):
+        buffer = pa.BufferOutputStream()
+        pcsv.write_csv(batch, buffer, pcsv.WriteOptions(include_header=False, quoting_style="none"))
+        csvFile.write(buffer.getvalue().to_pybytes().replace(b"\n", b"\r\n"))
+
+def openCompressedFile(targetfile, compressionLevel, compressionThreads):
+    '''
+        Opens a gzip file for binary writing, using the multithreaded python-isal compressor if more than one thread is requested.
+    '''
+    if compressionThreads > 1 and igzip_threaded is not None:
+        return igzip_threaded.open(targetfile, 'wb', compresslevel=min(compressionLevel, 3), threads=compressionThreads)
+
+    return gzip.open(targetfile, 'wb', compresslevel=compressionLevel)
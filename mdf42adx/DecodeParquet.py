@@ -1,6 +1,5 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
-from asammdf import MDF
 from datetime import datetime, timedelta
 import time 
 import numpy as np
@@ -8,9 +7,15 @@ import pyarrow as pa
 import pyarrow.parquet as pq
 import os
 import re
-from DecodeUtils import getSource, extractSignalsByType
+from DecodeUtils import getSource, extractSignalsByType, extractLongValues, rawColumn, selectDecodedAndRaw, iterRecordWindows, getRecordsCount, constantColumn, getStartTime, absoluteTimestampColumn, timeRange
+from MdfCache import getMdf, releaseMdf
+from Telemetry import stage, setSignal, withTelemetry
+from OutputSink import commitOutput, withOutputSink
+from OutputFormats import ParquetFormat
 
-def processSignalAsParquet(counter, filename, signalMetadata, uuid, targetdir, blacklistedSignals):
+@withTelemetry
+@withOutputSink
+def processSignalAsParquet(counter, filename, signalMetadata, uuid, targetdir, blacklistedSignals, chunkRecords=None, longValues=False, absoluteTimestamps=False, reduction=None, fileFormat=None):
     '''
         Creates a parquet export with the structure that we will import into ADX.
         There are three important pieces of information for time analysis of automotive signals
@@ -22,6 +27,13 @@ def processSignalAsParquet(counter, filename, signalMetadata, uuid, targetdir, b
             - The source ECU, as some analysis are related to specific Electronic Control Units.
             - The type of BUS, as some analysis are specific to CAN, LIN or ETH.
 
+        Signals with more than chunkRecords records are decoded and written in windows of chunkRecords records.
+        With longValues, integer samples are also written to the value_long and value_decimal columns (see buildSignalTable).
+        With absoluteTimestamps, the timestamp column is the UTC time of each sample and the result includes the time range of the signal.
+        With a reduction (see SampleReduction), only the samples in its time window are exported, optionally downsampled.
+        With an outputSink keyword argument (see OutputSink.withOutputSink), the file is uploaded before the result is returned.
+        With a fileFormat (see OutputFormats), the file is written in that format instead of parquet.
+        The result has an additional element with the name of the file, and the time range of the signal with absoluteTimestamps.
     '''
 
     # Get the signal group and channel index to load that specific signal ONLY
@@ -31,8 +43,9 @@ def processSignalAsParquet(counter, filename, signalMetadata, uuid, targetdir, b
     print(f"pid {os.getpid()}: Processing signal {counter}: {signal_name} group index {group_index} channel index {channel_index}") 
 
     try:        
-        # Open the MDF file and select a single signal
-        mdf = MDF(filename)     
+        # Open the MDF file (or reuse the one cached by this worker) and select a single signal
+        with stage("open"):
+            mdf = getMdf(filename)     
 
         start_signal_time = time.time()
 
@@ -40,49 +53,465 @@ def processSignalAsParquet(counter, filename, signalMetadata, uuid, targetdir, b
         if signal_name in blacklistedSignals:
             return (f"pid {os.getpid()}", True, counter, f"Skipped: {signalMetadata}", 0)
 
-        # We select a specific signal, both decoded and raw
-        decodedSignal = mdf.select(channels=[(None, group_index, channel_index)])[0]
-        rawSignal = mdf.select(channels=[(None, group_index, channel_index)], raw=True)[0]
+        # The start time of the file is used to calculate the absolute timestamps
+        startTime = getStartTime(mdf) if absoluteTimestamps else None
+
+        reductions = [reduction.forSignal(signalMetadata)] if reduction is not None else None
+
+        # Long signals are decoded in windows to bound the memory used
+        if chunkRecords and getRecordsCount(mdf, group_index) > chunkRecords:
+            return streamSignalsAsParquet([counter], mdf, [(None, group_index, channel_index)], uuid, targetdir, chunkRecords, start_signal_time, longValues, startTime, reductions, fileFormat)[0]
+
+        # We select a specific signal, reading the raw samples once and decoding them in memory
+        decodedSignal, rawSignal = selectDecodedAndRaw(mdf, [(None, group_index, channel_index)], reductions)[0]
     
-        numberOfSamples = len(decodedSignal.timestamps)
-
-        # If there are no samples, we report a success but with 0 samples
-        if (numberOfSamples == 0):              
-            return (f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {decodedSignal.name} - no samples in file", numberOfSamples)
-
-        floatSignals, stringSignals = extractSignalsByType(decodedSignal=decodedSignal, rawSignal=rawSignal)                       
-
-        table = pa.table (
-            {                   
-                "source_uuid": np.full(numberOfSamples, str(uuid), dtype=object),
-                "group_index": np.full(numberOfSamples, group_index, dtype=np.int32),
-                "channel_index": np.full(numberOfSamples, channel_index, dtype=np.int32),
-                "name": np.full(numberOfSamples, decodedSignal.name, dtype=object),
-                "timestamp": decodedSignal.timestamps,
-                "value": floatSignals,
-                "value_string": stringSignals,
-                "valueRaw" : rawSignal.samples,
-            }
-        )
-
-        # Escape all characters from the decodedSignal.name and use only alphanumeric and underscore for the basename
-        # This is to avoid issues with the basename_template and parquet
-        parquetFileName = re.sub(r"[^a-zA-Z0-9_]", "_", decodedSignal.name)
-
-        pq.write_to_dataset(
-            table, 
-            root_path=targetdir,
-            basename_template=f"{group_index}-{channel_index}-{parquetFileName}-{{i}}.parquet",
-            use_threads=True,
-            compression="snappy")                 
-        
-        end_signal_time = time.time() - start_signal_time        
-
-        return (f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {decodedSignal.name} with {len(decodedSignal.timestamps)} type {decodedSignal.samples.dtype} entries in {end_signal_time}", numberOfSamples)
+        return writeSignalAsParquet(counter, decodedSignal, rawSignal, group_index, channel_index, uuid, targetdir, start_signal_time, longValues, startTime, fileFormat)
     
     except Exception as e:
-        return (f"pid {os.getpid()}", False, counter, f"Signal {counter}: {decodedSignal.name} with {len(decodedSignal.timestamps)} type {decodedSignal.samples.dtype} failed: {str(e)}", 0)
+        return (f"pid {os.getpid()}", False, counter, f"Signal {counter}: {signal_name} failed: {str(e)}", 0)
     
     finally:
-        mdf.close()
-        del decodedSignal, rawSignal, mdf
+        releaseMdf(mdf)
+        del mdf
+
+@withTelemetry
+@withOutputSink
+def processGroupAsParquet(counters, filename, signalsMetadata, uuid, targetdir, blacklistedSignals, targetFileSize=None, rowGroupSize=None, chunkRecords=None, longValues=False, absoluteTimestamps=False, reduction=None, fileFormat=None):
+    '''
+        Creates the parquet export for a batch of signals that belong to the same channel group.
+        The MDF file is opened once and all channels of the batch are selected together, so the records
+        of the channel group are read once for the whole batch instead of twice per signal.
+
+        Args:
+            counters: the position of each signal of the batch in the file metadata
+            filename: the MDF-4 file to process
+            signalsMetadata: the metadata of each signal of the batch, in the same order as counters
+            uuid: the UUID that identifies this decoding run
+            targetdir: the directory where the parquet files are written
+            blacklistedSignals: the list of signals to skip
+            targetFileSize: if set, the signals are sorted by name and coalesced into parquet files of about this size in bytes
+                            instead of one file per signal. The results include the file and row groups of each signal.
+            rowGroupSize: the maximum number of rows per row group of the coalesced files
+            chunkRecords: if set, channel groups with more records are decoded and written in windows of chunkRecords records.
+                          Not used for coalesced files.
+            longValues: if set, integer samples are also written to the value_long and value_decimal columns (see buildSignalTable)
+            absoluteTimestamps: if set, the timestamp column is the UTC time of each sample and the results include the time range of each signal
+            reduction: the time window and downsampling of the signals (see SampleReduction), None to export all samples
+            fileFormat: the format of the files of the signals (see OutputFormats), parquet if None. Coalesced files are
+                        always parquet, written with the encoding options of fileFormat if it is a ParquetFormat.
+            outputSink: keyword argument, the sink that uploads the files of the task (see OutputSink.withOutputSink)
+        Returns:
+            a list with one result per signal, with the same structure as processSignalAsParquet
+    '''
+
+    print(f"pid {os.getpid()}: Processing {len(counters)} signals of group index {signalsMetadata[0]['group_index']}")
+
+    results = []
+    selected = []
+
+    # If the signal is blacklisted, we skip it and return 0 samples
+    for counter, signalMetadata in zip(counters, signalsMetadata):
+        if signalMetadata["name"] in blacklistedSignals:
+            results.append((f"pid {os.getpid()}", True, counter, f"Skipped: {signalMetadata}", 0))
+        else:
+            selected.append((counter, signalMetadata))
+
+    if len(selected) == 0:
+        return results
+
+    # Coalesced files store the signals sorted by name, so the row group statistics can be used to skip the other signals
+    coalescedWriter = None
+    if targetFileSize is not None:
+        selected.sort(key=lambda item: item[1]["name"])
+        coalescedWriter = CoalescedParquetWriter(targetdir, f"{signalsMetadata[0]['group_index']}-{counters[0]}", targetFileSize, rowGroupSize, longValues, absoluteTimestamps, fileFormat)
+
+    with stage("open"):
+        mdf = getMdf(filename)
+
+    try:
+        start_group_time = time.time()
+
+        # The start time of the file is used to calculate the absolute timestamps
+        startTime = getStartTime(mdf) if absoluteTimestamps else None
+
+        reductions = [reduction.forSignal(signalMetadata) for _, signalMetadata in selected] if reduction is not None else None
+
+        # Long channel groups are decoded in windows to bound the memory used
+        if chunkRecords and coalescedWriter is None and getRecordsCount(mdf, selected[0][1]["group_index"]) > chunkRecords:
+            channels = [(None, signalMetadata["group_index"], signalMetadata["channel_index"]) for _, signalMetadata in selected]
+            results.extend(streamSignalsAsParquet([counter for counter, _ in selected], mdf, channels, uuid, targetdir, chunkRecords, start_group_time, longValues, startTime, reductions, fileFormat))
+            return results
+
+        # We select all signals of the batch with a single pass over the channel group, decoding them in memory
+        channels = [(None, signalMetadata["group_index"], signalMetadata["channel_index"]) for _, signalMetadata in selected]
+        signals = selectDecodedAndRaw(mdf, channels, reductions)
+
+        print(f"pid {os.getpid()}: Read {len(channels)} signals of group index {selected[0][1]['group_index']} in {time.time() - start_group_time}")
+
+        for (counter, signalMetadata), (decodedSignal, rawSignal) in zip(selected, signals):
+            start_signal_time = time.time()
+            setSignal(counter)
+
+            try:
+                if coalescedWriter is None:
+                    results.append(writeSignalAsParquet(counter, decodedSignal, rawSignal, signalMetadata["group_index"], signalMetadata["channel_index"], uuid, targetdir, start_signal_time, longValues, startTime, fileFormat))
+                else:
+                    results.append(writeSignalToCoalescedParquet(counter, decodedSignal, rawSignal, signalMetadata["group_index"], signalMetadata["channel_index"], uuid, coalescedWriter, start_signal_time, startTime))
+            except Exception as e:
+                results.append((f"pid {os.getpid()}", False, counter, f"Signal {counter}: {decodedSignal.name} with {len(decodedSignal.timestamps)} type {decodedSignal.samples.dtype} failed: {str(e)}", 0))
+
+        setSignal(None)
+
+    except Exception as e:
+        # If the channel group cannot be read, every signal without a result is reported as failed
+        processedCounters = set(result[2] for result in results)
+        for counter, signalMetadata in selected:
+            if counter not in processedCounters:
+                results.append((f"pid {os.getpid()}", False, counter, f"Signal {counter}: {signalMetadata['name']} failed: {str(e)}", 0))
+
+    finally:
+        if coalescedWriter is not None:
+            coalescedWriter.close()
+        releaseMdf(mdf)
+        del mdf
+
+    return results
+
+def writeSignalAsParquet(counter, decodedSignal, rawSignal, group_index, channel_index, uuid, targetdir, start_signal_time, longValues=False, startTime=None, fileFormat=None):
+    '''
+        Writes a decoded signal to a parquet file (or a file of fileFormat) and returns the result for processSignals.
+        Exceptions are raised to the caller, which decides how the failure is reported.
+        The result has an additional element with the name of the file ("output"), and with the start time of the file
+        (see getStartTime) the timestamps are absolute and it also has the time range of the signal.
+    '''
+    numberOfSamples = len(decodedSignal.timestamps)
+
+    # If there are no samples, we report a success but with 0 samples
+    if (numberOfSamples == 0):              
+        return (f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {decodedSignal.name} - no samples in file", numberOfSamples)
+
+    table = buildSignalTable(decodedSignal, rawSignal, group_index, channel_index, uuid, longValues, startTime)
+
+    fileName = writeSignalTable(table, decodedSignal.name, group_index, channel_index, targetdir, fileFormat)
+    
+    end_signal_time = time.time() - start_signal_time        
+
+    details = {"output": fileName}
+
+    if startTime is not None:
+        details.update(timeRange(decodedSignal.timestamps.min(), decodedSignal.timestamps.max(), startTime))
+
+    return (f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {decodedSignal.name} with {len(decodedSignal.timestamps)} type {decodedSignal.samples.dtype} entries in {end_signal_time}", numberOfSamples, details)
+
+def writeSignalTable(table, name, group_index, channel_index, targetdir, fileFormat=None):
+    '''
+        Writes the table of a signal to its own file, parquet or fileFormat (see OutputFormats), and hands it to the
+        output sink of the task.
+
+        Returns:
+            the name of the file, relative to targetdir
+    '''
+    fileFormat = fileFormat or ParquetFormat()
+
+    # Escape all characters from the signal name and use only alphanumeric and underscore for the file name
+    fileName = signalFileName(name, group_index, channel_index, fileFormat)
+    os.makedirs(targetdir, exist_ok=True)
+
+    with stage("write"):
+        writer = fileFormat.open(os.path.join(targetdir, fileName), table.schema)
+        try:
+            writer.write(table)
+        finally:
+            writer.close()
+
+    commitOutput(os.path.join(targetdir, fileName))
+
+    return fileName
+
+def signalFileName(name, group_index, channel_index, fileFormat):
+    '''
+        Returns the name of the file of a signal, with the group and channel index and the escaped signal name.
+    '''
+    return fileFormat.fileName(f"{group_index}-{channel_index}-{re.sub(r'[^a-zA-Z0-9_]', '_', name)}-0")
+
+def streamSignalsAsParquet(counters, mdf, channels, uuid, targetdir, chunkRecords, start_signal_time, longValues=False, startTime=None, reductions=None, fileFormat=None):
+    '''
+        Decodes the channels of a channel group in windows of chunkRecords records and appends each window as a row group
+        to the parquet file of its signal. Only one window is kept in memory.
+
+        Returns:
+            a list with one result per signal, with the same structure as writeSignalAsParquet
+    '''
+    streams = [ParquetSignalStream(targetdir, group_index, channel_index, uuid, longValues, startTime, fileFormat) for _, group_index, channel_index in channels]
+    errors = {}
+
+    try:
+        for window in iterRecordWindows(mdf, channels, chunkRecords, reductions):
+            for counter, stream, (decodedSignal, rawSignal) in zip(counters, streams, window):
+                if counter in errors:
+                    continue
+                setSignal(counter)
+                try:
+                    stream.write(decodedSignal, rawSignal)
+                except Exception as e:
+                    errors[counter] = f"Signal {counter}: {decodedSignal.name} with {len(decodedSignal.timestamps)} type {decodedSignal.samples.dtype} failed: {str(e)}"
+            setSignal(None)
+            del window
+
+    finally:
+        for stream in streams:
+            stream.close()
+
+    end_signal_time = time.time() - start_signal_time
+
+    results = []
+    for counter, stream in zip(counters, streams):
+        if counter in errors:
+            results.append((f"pid {os.getpid()}", False, counter, errors[counter], 0))
+        else:
+            result = (f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {stream.name} with {stream.numberOfSamples} type {stream.dtype} entries in {stream.windows} windows in {end_signal_time}", stream.numberOfSamples)
+
+            if stream.numberOfSamples > 0:
+                details = {"output": stream.fileName}
+                if startTime is not None:
+                    details.update(timeRange(stream.firstTimestamp, stream.lastTimestamp, startTime))
+                result += (details,)
+
+            results.append(result)
+
+    return results
+
+class ParquetSignalStream:
+    '''
+        Writes a signal decoded in windows to a parquet file (or a file of fileFormat), each window as its own row group.
+        The file is created with the name and schema of the first window.
+    '''
+
+    def __init__(self, targetdir, group_index, channel_index, uuid, longValues=False, startTime=None, fileFormat=None):
+        self.targetdir = targetdir
+        self.group_index = group_index
+        self.channel_index = channel_index
+        self.uuid = uuid
+        self.longValues = longValues
+        self.startTime = startTime
+        self.fileFormat = fileFormat or ParquetFormat()
+        self.firstTimestamp = None
+        self.lastTimestamp = None
+        self.writer = None
+        self.fileName = None
+        self.schema = None
+        self.name = None
+        self.dtype = None
+        self.numberOfSamples = 0
+        self.windows = 0
+
+    def write(self, decodedSignal, rawSignal):
+        if len(decodedSignal.timestamps) == 0:
+            return
+
+        table = buildSignalTable(decodedSignal, rawSignal, self.group_index, self.channel_index, self.uuid, self.longValues, self.startTime)
+
+        if self.writer is None:
+            self.name = decodedSignal.name
+            self.dtype = decodedSignal.samples.dtype
+
+            # Same file name as the one used by writeSignalAsParquet
+            self.fileName = signalFileName(decodedSignal.name, self.group_index, self.channel_index, self.fileFormat)
+            os.makedirs(self.targetdir, exist_ok=True)
+            self.schema = table.schema
+            self.writer = self.fileFormat.open(os.path.join(self.targetdir, self.fileName), table.schema)
+
+        with stage("write"):
+            # The next windows get the types of the first one, such as a string column of a window without text
+            self.writer.write(table.cast(self.schema))
+        self.numberOfSamples += table.num_rows
+        self.windows += 1
+
+        # Time range of all windows
+        self.firstTimestamp = min(decodedSignal.timestamps.min(), self.firstTimestamp if self.firstTimestamp is not None else np.inf)
+        self.lastTimestamp = max(decodedSignal.timestamps.max(), self.lastTimestamp if self.lastTimestamp is not None else -np.inf)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            commitOutput(os.path.join(self.targetdir, self.fileName))
+
+def buildSignalTable(decodedSignal, rawSignal, group_index, channel_index, uuid, longValues=False, startTime=None):
+    '''
+        Creates the arrow table with the structure that we will import into ADX for a decoded signal.
+
+        With longValues the table has two more columns: value_long with the integer samples as int64, and value_decimal
+        with the uint64 samples that don't fit in an int64. 64 bit integers are not rendered in value_string.
+
+        With the start time of the file (nanoseconds since the epoch), timestamp is the UTC time of each sample
+        instead of the seconds since the start of the recording.
+    '''
+    return signalTable(signalValueColumns(decodedSignal, rawSignal, longValues, startTime), decodedSignal.name, group_index, channel_index, uuid)
+
+def signalValueColumns(decodedSignal, rawSignal, longValues=False, startTime=None):
+    '''
+        Returns the columns of the table of a signal that depend on its samples, from timestamp on (see buildSignalTable).
+    '''
+    with stage("extract"):
+        floatSignals, stringSignals = extractSignalsByType(decodedSignal=decodedSignal, rawSignal=rawSignal, longValues=longValues)                       
+
+    columns = {
+        "timestamp": decodedSignal.timestamps if startTime is None else absoluteTimestampColumn(decodedSignal.timestamps, startTime),
+        "value": floatSignals,
+        "value_string": stringSignals,
+        "valueRaw" : rawColumn(rawSignal, stringSignals),
+    }
+
+    if longValues:
+        with stage("extract"):
+            columns["value_long"], columns["value_decimal"] = extractLongValues(decodedSignal)
+
+    return columns
+
+def signalTable(valueColumns, name, group_index, channel_index, uuid):
+    '''
+        Creates the arrow table of a signal from its value columns (see signalValueColumns), which can be numpy arrays or
+        arrow columns, adding the columns that identify the signal.
+    '''
+    numberOfSamples = len(valueColumns["timestamp"])
+
+    columns = {                   
+        # Columns with the same value in every row are dictionary encoded to avoid creating a string per sample
+        "source_uuid": constantColumn(str(uuid), numberOfSamples),
+        "group_index": np.full(numberOfSamples, group_index, dtype=np.int32),
+        "channel_index": np.full(numberOfSamples, channel_index, dtype=np.int32),
+        "name": constantColumn(name, numberOfSamples),
+        **valueColumns,
+    }
+
+    with stage("build"):
+        return pa.table(columns)
+
+def writeSignalToCoalescedParquet(counter, decodedSignal, rawSignal, group_index, channel_index, uuid, coalescedWriter, start_signal_time, startTime=None):
+    '''
+        Appends a decoded signal to a coalesced parquet file and returns the result for processSignals.
+        The result has an additional element with the file and the range of row groups that contain the signal,
+        and its time range if the start time of the file is given.
+    '''
+    numberOfSamples = len(decodedSignal.timestamps)
+
+    # If there are no samples, we report a success but with 0 samples
+    if (numberOfSamples == 0):
+        return (f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {decodedSignal.name} - no samples in file", numberOfSamples)
+
+    table = buildSignalTable(decodedSignal, rawSignal, group_index, channel_index, uuid, coalescedWriter.longValues, startTime)
+
+    with stage("write"):
+        fileName, firstRowGroup, lastRowGroup = coalescedWriter.write(table)
+
+    end_signal_time = time.time() - start_signal_time
+
+    details = {"file": fileName, "row_groups": [firstRowGroup, lastRowGroup]}
+
+    if startTime is not None:
+        details.update(timeRange(decodedSignal.timestamps.min(), decodedSignal.timestamps.max(), startTime))
+
+    return (f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {decodedSignal.name} with {numberOfSamples} type {decodedSignal.samples.dtype} entries in {end_signal_time}", numberOfSamples, details)
+
+class CoalescedParquetWriter:
+    '''
+        Writes the tables of many signals into a bounded set of parquet files.
+        Each signal is written as its own row groups and a new file is started once a file reaches the target size.
+
+        All signals of a file share the same schema, so value and valueRaw are stored as double as defined in the ADX
+        external table. Raw values that are not numeric (strings, records) are left empty, their text is in value_string.
+    '''
+
+    SCHEMA = pa.schema([
+        ("source_uuid", pa.dictionary(pa.int8(), pa.string())),
+        ("group_index", pa.int32()),
+        ("channel_index", pa.int32()),
+        ("name", pa.dictionary(pa.int8(), pa.string())),
+        ("timestamp", pa.float64()),
+        ("value", pa.float64()),
+        ("value_string", pa.string()),
+        ("valueRaw", pa.float64()),
+    ])
+
+    # Schema with the lossless integer columns, see buildSignalTable
+    LONG_VALUES_SCHEMA = SCHEMA.append(pa.field("value_long", pa.int64())).append(pa.field("value_decimal", pa.decimal128(20, 0)))
+
+    def __init__(self, targetdir, prefix, targetFileSize, rowGroupSize=None, longValues=False, absoluteTimestamps=False, fileFormat=None):
+        self.targetdir = targetdir
+        self.prefix = prefix
+        self.targetFileSize = targetFileSize
+        # The encoding options of the files, see OutputFormats.ParquetFormat
+        self.fileFormat = fileFormat if isinstance(fileFormat, ParquetFormat) else ParquetFormat()
+        self.rowGroupSize = rowGroupSize or self.fileFormat.rowGroupSize
+        self.longValues = longValues
+        self.schema = self.LONG_VALUES_SCHEMA if longValues else self.SCHEMA
+
+        if absoluteTimestamps:
+            self.schema = self.schema.set(self.schema.get_field_index("timestamp"), pa.field("timestamp", pa.timestamp("ns", tz="UTC")))
+        self.fileCounter = 0
+        self.fileName = None
+        self.sink = None
+        self.writer = None
+        self.rowGroups = 0
+
+    def write(self, table):
+        '''
+            Writes the table of a signal and returns the file name (relative to targetdir) and the first and last row group used.
+        '''
+        if self.writer is None:
+            self.open()
+
+        table = self.conform(table)
+
+        # pyarrow splits the table in row groups of rowGroupSize rows, or writes a single one without size
+        if self.rowGroupSize:
+            rowGroupsWritten = max(1, -(-table.num_rows // self.rowGroupSize))
+        else:
+            rowGroupsWritten = 1
+
+        self.writer.write_table(table, row_group_size=self.rowGroupSize)
+
+        fileName = self.fileName
+        firstRowGroup = self.rowGroups
+        self.rowGroups += rowGroupsWritten
+
+        if self.sink.tell() >= self.targetFileSize:
+            self.close()
+
+        return fileName, firstRowGroup, firstRowGroup + rowGroupsWritten - 1
+
+    def conform(self, table):
+        '''
+            Casts the table of a signal to the common schema of the coalesced files.
+        '''
+        columns = []
+        for field in self.schema:
+            column = table.column(field.name)
+            if field.name == "valueRaw" and not (pa.types.is_integer(column.type) or pa.types.is_floating(column.type) or pa.types.is_boolean(column.type)):
+                column = pa.nulls(table.num_rows, pa.float64())
+            # 64 bit integers above 2^53 lose precision as double, their exact value is kept in value_string
+            columns.append(column.cast(field.type, safe=False))
+
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def open(self):
+        os.makedirs(self.targetdir, exist_ok=True)
+
+        # Files of a previous run can hold signals that are not decoded again when resuming, they are never overwritten
+        self.fileName = f"{self.prefix}-{self.fileCounter}.parquet"
+        self.fileCounter += 1
+        while os.path.exists(os.path.join(self.targetdir, self.fileName)):
+            self.fileName = f"{self.prefix}-{self.fileCounter}.parquet"
+            self.fileCounter += 1
+        self.rowGroups = 0
+        self.sink = pa.OSFile(os.path.join(self.targetdir, self.fileName), "wb")
+        self.writer = pq.ParquetWriter(self.sink, self.schema, **self.fileFormat.writerOptions(self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.sink.close()
+            self.writer = None
+            self.sink = None
+            commitOutput(os.path.join(self.targetdir, self.fileName))
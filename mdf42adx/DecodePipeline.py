@@ -0,0 +1,310 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+from functools import partial
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing import get_context
+import pyarrow as pa
+from DecodeUtils import selectDecodedAndRaw, getStartTime, timeRange
+from DecodeParquet import signalValueColumns, signalTable, writeSignalTable
+from MdfCache import getMdf, releaseMdf
+from Telemetry import stage, setSignal, withTelemetry
+from OutputSink import withOutputSink
+
+# Directory where the decoded signals wait for the writers. /dev/shm is a memory file system, so the writers map the
+# pages written by the decoding workers instead of reading a copy from disk. It is only used when it has room for the
+# staging limit (see stagingDirectory), Docker gives containers 64 MB unless they are started with --shm-size
+DEFAULT_STAGING_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+class DecodePipeline:
+    '''
+        Splits the export of each signal between two pools of processes: the decoding workers read and decode the
+        signals and extract their value columns, and the writer processes build the tables and encode the parquet files.
+
+        The value columns are handed over as Arrow IPC files in a staging directory in memory (see DEFAULT_STAGING_DIR).
+        The writers memory map them, so the tables they encode use the pages written by the decoding workers without
+        copying or deserializing them. A decoding task only starts when the staged signals are below maxStagedMB.
+    '''
+
+    def __init__(self, writers, maxStagedMB=1024, stagingDir=None):
+        '''
+            Args:
+                writers: the number of writer processes
+                maxStagedMB: the size of the staged signals above which new decoding tasks wait for the writers
+                stagingDir: the directory where the directory of the staged signals is created, by default
+                            DEFAULT_STAGING_DIR if it has room for maxStagedMB (see stagingDirectory)
+        '''
+        self.writers = writers
+        self.maxStagedMB = maxStagedMB
+        self.stagingDir = tempfile.mkdtemp(prefix="mdf42adx-", dir=stagingDir or stagingDirectory(maxStagedMB))
+
+    def method(self, longValues=False, absoluteTimestamps=False, reduction=None, outputSink=None, fileFormat=None):
+        '''
+            Returns the method to process batches of signals with the pipeline, see processGroupAsParquet for the arguments.
+        '''
+        decodeMethod = partial(decodeSignalsToStaging, stagingDir=self.stagingDir, maxStagedMB=self.maxStagedMB, longValues=longValues, absoluteTimestamps=absoluteTimestamps, reduction=reduction)
+        writeMethod = partial(writeStagedSignals, fileFormat=fileFormat)
+        if outputSink is not None:
+            writeMethod = partial(writeMethod, outputSink=outputSink)
+
+        return PipelineMethod(decodeMethod, writeMethod)
+
+    def createPool(self, decodePool):
+        '''
+            Returns a pool that runs the tasks in decodePool and writes their results in a new pool of writers (see PipelinePool).
+        '''
+        return PipelinePool(decodePool, get_context("spawn").Pool(self.writers))
+
+    def close(self):
+        '''
+            Removes the staging directory, with the signals of the tasks that failed or timed out in the writers.
+        '''
+        shutil.rmtree(self.stagingDir, ignore_errors=True)
+
+def stagingDirectory(maxStagedMB):
+    '''
+        Returns DEFAULT_STAGING_DIR if its free space can hold maxStagedMB of staged signals, or the temporary directory.
+        The running tasks stage their signals after the limit is checked, so twice the limit is required.
+    '''
+    free = shutil.disk_usage(DEFAULT_STAGING_DIR).free
+
+    if free >= 2 * maxStagedMB * 2**20:
+        return DEFAULT_STAGING_DIR
+
+    print(f"{DEFAULT_STAGING_DIR} has {free / 2**20:.0f} MB free for {maxStagedMB} MB of staged signals, staging them in {tempfile.gettempdir()} instead")
+    return tempfile.gettempdir()
+
+class PipelineMethod:
+    '''
+        A method that runs in two stages: decodeMethod in a decoding worker, then writeMethod on its result in a writer.
+    '''
+
+    def __init__(self, decodeMethod, writeMethod):
+        self.decodeMethod = decodeMethod
+        self.writeMethod = writeMethod
+
+class PipelinePool:
+    '''
+        A pool with the apply_async, close, join and terminate methods used by TaskScheduler and processSignals. The tasks of a PipelineMethod run
+        in the decoding pool and then in the writer pool, and the callbacks get the result of the writer, so a task is
+        only finished when its files are written. Other tasks (such as calculating the metadata of a file) only run in
+        the decoding pool.
+    '''
+
+    def __init__(self, decodePool, writerPool):
+        self.decodePool = decodePool
+        self.writerPool = writerPool
+
+    def apply_async(self, method, args=(), callback=None, error_callback=None):
+        if not isinstance(method, PipelineMethod):
+            return self.decodePool.apply_async(method, args=args, callback=callback, error_callback=error_callback)
+
+        def write(value):
+            # The callbacks run in the result thread of the decoding pool, an exception would stop it
+            try:
+                self.writerPool.apply_async(method.writeMethod, args=(value,), callback=callback, error_callback=error_callback)
+            except Exception as e:
+                error_callback(e)
+
+        self.decodePool.apply_async(method.decodeMethod, args=args, callback=write, error_callback=error_callback)
+
+    def close(self):
+        # The writer pool receives the results of the decoding tasks that are still running
+        self.decodePool.close()
+
+    def join(self):
+        # The decoding tasks submit their writes from the result thread of the decoding pool, which ends with the pool
+        self.decodePool.join()
+        self.writerPool.close()
+        self.writerPool.join()
+
+    def terminate(self):
+        self.decodePool.terminate()
+        self.writerPool.terminate()
+
+@withTelemetry
+def decodeSignalsToStaging(counters, filename, signalsMetadata, uuid, targetdir, blacklistedSignals, stagingDir, maxStagedMB=1024, longValues=False, absoluteTimestamps=False, reduction=None):
+    '''
+        Decodes a batch of signals of the same channel group and stages their value columns for the writers.
+
+        Args:
+            stagingDir: the directory of the staged signals (see DecodePipeline)
+            maxStagedMB: the size of the staged signals above which the task waits for the writers before decoding
+            See processGroupAsParquet for the other arguments.
+        Returns:
+            a list with one result per signal. The details of the staged signals have a "staged" entry with the IPC file
+            and the information needed to write it (see writeStagedSignals), the other results are final.
+    '''
+    print(f"pid {os.getpid()}: Decoding {len(counters)} signals of group index {signalsMetadata[0]['group_index']}")
+
+    results = []
+    selected = []
+
+    # If the signal is blacklisted, we skip it and return 0 samples
+    for counter, signalMetadata in zip(counters, signalsMetadata):
+        if signalMetadata["name"] in blacklistedSignals:
+            results.append((f"pid {os.getpid()}", True, counter, f"Skipped: {signalMetadata}", 0))
+        else:
+            selected.append((counter, signalMetadata))
+
+    if len(selected) == 0:
+        return results
+
+    # Only the tasks that start wait, the signals of the running tasks are written once the tasks finish
+    waitForStaging(stagingDir, maxStagedMB)
+
+    with stage("open"):
+        mdf = getMdf(filename)
+
+    try:
+        start_group_time = time.time()
+
+        # The start time of the file is used to calculate the absolute timestamps
+        startTime = getStartTime(mdf) if absoluteTimestamps else None
+
+        reductions = [reduction.forSignal(signalMetadata) for _, signalMetadata in selected] if reduction is not None else None
+
+        channels = [(None, signalMetadata["group_index"], signalMetadata["channel_index"]) for _, signalMetadata in selected]
+        signals = selectDecodedAndRaw(mdf, channels, reductions)
+
+        for (counter, signalMetadata), (decodedSignal, rawSignal) in zip(selected, signals):
+            setSignal(counter)
+
+            try:
+                results.append(stageSignal(counter, decodedSignal, rawSignal, signalMetadata["group_index"], signalMetadata["channel_index"], uuid, targetdir, stagingDir, start_group_time, longValues, startTime))
+            except Exception as e:
+                results.append((f"pid {os.getpid()}", False, counter, f"Signal {counter}: {decodedSignal.name} with {len(decodedSignal.timestamps)} type {decodedSignal.samples.dtype} failed: {str(e)}", 0))
+
+        setSignal(None)
+
+    except Exception as e:
+        # If the channel group cannot be read, every signal without a result is reported as failed
+        processedCounters = set(result[2] for result in results)
+        for counter, signalMetadata in selected:
+            if counter not in processedCounters:
+                results.append((f"pid {os.getpid()}", False, counter, f"Signal {counter}: {signalMetadata['name']} failed: {str(e)}", 0))
+
+    finally:
+        releaseMdf(mdf)
+        del mdf
+
+    return results
+
+def stageSignal(counter, decodedSignal, rawSignal, group_index, channel_index, uuid, targetdir, stagingDir, start_signal_time, longValues=False, startTime=None):
+    '''
+        Writes the value columns of a decoded signal to an Arrow IPC file in the staging directory.
+    '''
+    numberOfSamples = len(decodedSignal.timestamps)
+
+    # If there are no samples, we report a success but with 0 samples
+    if (numberOfSamples == 0):
+        return (f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {decodedSignal.name} - no samples in file", numberOfSamples)
+
+    valueColumns = signalValueColumns(decodedSignal, rawSignal, longValues, startTime)
+    with stage("build"):
+        table = pa.table(valueColumns)
+    path = os.path.join(stagingDir, f"{os.getpid()}-{counter}-{uuid}.arrow")
+
+    with stage("share"):
+        try:
+            with pa.OSFile(path, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        except Exception:
+            # A staging directory without space leaves a partial file that would never be written
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+    details = {
+        "staged": {
+            "path": path,
+            "name": decodedSignal.name,
+            "type": str(decodedSignal.samples.dtype),
+            "group_index": group_index,
+            "channel_index": channel_index,
+            "uuid": str(uuid),
+            "targetdir": targetdir,
+            "start": start_signal_time,
+        }
+    }
+
+    if startTime is not None:
+        details.update(timeRange(decodedSignal.timestamps.min(), decodedSignal.timestamps.max(), startTime))
+
+    return (f"pid {os.getpid()}", True, counter, f"Staged signal {counter}: {decodedSignal.name} with {numberOfSamples} entries", numberOfSamples, details)
+
+@withTelemetry
+@withOutputSink
+def writeStagedSignals(results, fileFormat=None):
+    '''
+        Writes the parquet file (or the file of fileFormat, see OutputFormats) of each staged signal of a decoding task,
+        with the same content and name as processGroupAsParquet, and removes it from the staging directory. Results
+        without a staged signal are returned unchanged.
+
+        Returns:
+            a list with one result per signal, with the same structure as processGroupAsParquet
+    '''
+    written = []
+
+    for result in results:
+        if len(result) <= 5 or "staged" not in result[5]:
+            written.append(result)
+            continue
+
+        counter = result[2]
+        staged = result[5]["staged"]
+        setSignal(counter)
+
+        try:
+            written.append(writeStagedSignal(result, staged, fileFormat))
+        except Exception as e:
+            written.append((f"pid {os.getpid()}", False, counter, f"Signal {counter}: {staged['name']} with {result[4]} type {staged['type']} failed: {str(e)}", 0))
+        finally:
+            if os.path.exists(staged["path"]):
+                os.remove(staged["path"])
+
+    setSignal(None)
+
+    return written
+
+def writeStagedSignal(result, staged, fileFormat=None):
+    # The columns reference the mapped pages of the IPC file, which stays mapped until the file is written
+    with stage("share"):
+        source = pa.memory_map(staged["path"], "r")
+        stagedTable = pa.ipc.open_file(source).read_all()
+        valueColumns = dict(zip(stagedTable.column_names, stagedTable.columns))
+
+    try:
+        table = signalTable(valueColumns, staged["name"], staged["group_index"], staged["channel_index"], staged["uuid"])
+        fileName = writeSignalTable(table, staged["name"], staged["group_index"], staged["channel_index"], staged["targetdir"], fileFormat)
+        del table, valueColumns, stagedTable
+    finally:
+        source.close()
+
+    end_signal_time = time.time() - staged["start"]
+    written = (f"pid {os.getpid()}", True, result[2], f"Processed signal {result[2]}: {staged['name']} with {result[4]} type {staged['type']} entries in {end_signal_time}", result[4])
+
+    # The time range of the signal is kept, with the telemetry of the decoding
+    details = {key: value for key, value in result[5].items() if key != "staged"}
+    details["output"] = fileName
+
+    return written + (details,)
+
+def waitForStaging(stagingDir, maxStagedMB, interval=0.1):
+    '''
+        Waits while the files in the staging directory are above maxStagedMB.
+    '''
+    while True:
+        try:
+            staged = sum(entry.stat().st_size for entry in os.scandir(stagingDir) if entry.is_file())
+        except FileNotFoundError:
+            # A file was written between listing and measuring it
+            continue
+
+        if staged <= maxStagedMB * 2**20:
+            return
+
+        time.sleep(interval)
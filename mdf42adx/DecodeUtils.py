@@ -1,56 +1,245 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
+from datetime import datetime, timedelta, timezone
+import json
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from asammdf import Signal
 from asammdf.blocks import v4_constants as v4c
 import traceback
+from Telemetry import stage
+from SampleReduction import concatenateSignals
 
-def getSource(mdf, signal):    
+def getSource(mdf, group_index, source):    
     '''
-        Extracts the source information from the MDF-4 file for a given signal
+        Extracts the source information from the MDF-4 file for a given channel group and channel source
     '''
 
-    if signal.source is not None:
-        source_name = signal.source.name
-        source_type = v4c.SOURCE_TYPE_TO_STRING[signal.source.source_type]
-        bus_type = v4c.BUS_TYPE_TO_STRING[signal.source.bus_type]
+    if source is not None:
+        source_name = source.name
+        source_type = v4c.SOURCE_TYPE_TO_STRING[source.source_type]
+        bus_type = v4c.BUS_TYPE_TO_STRING[source.bus_type]
     else:
         source_name = "Unknown"
         source_type = "Unknown"
         bus_type = "Unknown"
 
     try: 
-        channel_group_acq_name = mdf.groups[signal.group_index].channel_group.acq_name
+        channel_group_acq_name = mdf.groups[group_index].channel_group.acq_name
     except:
         channel_group_acq_name = ""
 
     try: 
-        acq_source_name = mdf.groups[signal.group_index].channel_group.acq_source.name
+        acq_source_name = mdf.groups[group_index].channel_group.acq_source.name
     except:
         acq_source_name = ""
 
     try:
-        acq_source_path = mdf.groups[signal.group_index].channel_group.acq_source.path
+        acq_source_path = mdf.groups[group_index].channel_group.acq_source.path
     except:
         acq_source_path = ""
 
     try:
-        channel_group_acq_source_comment = mdf.groups[signal.group_index].channel_group.acq_source.comment
+        channel_group_acq_source_comment = mdf.groups[group_index].channel_group.acq_source.comment
     except:
         channel_group_acq_source_comment = ""
 
     try:
-        channel_group_comment = mdf.groups[signal.group_index].channel_group.comment
+        channel_group_comment = mdf.groups[group_index].channel_group.comment
     except:
         channel_group_comment = ""
 
     try:
-        signal_source_path = signal.source.path
+        signal_source_path = source.path
     except:
         signal_source_path = ""
 
     return source_name, source_type, bus_type, channel_group_acq_name, acq_source_name, acq_source_path, channel_group_acq_source_comment, channel_group_comment, signal_source_path
 
-def extractSignalsByType(decodedSignal, rawSignal):
+def selectDecodedAndRaw(mdf, channels, reductions=None):
+    '''
+        Selects the channels from the MDF-4 file and returns a (decodedSignal, rawSignal) pair for each one.
+
+        The raw samples are read only once, the decoded samples are calculated in memory applying the channel conversion
+        the same way mdf.select does. Identity conversions reuse the raw samples array and linear conversions allocate a
+        single array for the result.
+
+        Args:
+            mdf: the open MDF-4 file
+            channels: the list of (None, group index, channel index) to select
+            reductions: the SignalReduction of each channel (see SampleReduction), None to keep all samples
+    '''
+    with stage("select"):
+        rawSignals = mdf.select(channels=channels, raw=True)
+
+    with stage("decode"):
+        return [decodeAndReduce(rawSignal, reduction) for rawSignal, reduction in zip(rawSignals, reductions or [None] * len(rawSignals))]
+
+def iterRecordWindows(mdf, channels, chunkRecords, reductions=None):
+    '''
+        Yields the (decodedSignal, rawSignal) pairs of the channels for consecutive windows of at most chunkRecords records.
+        Only one window is kept in memory, so the memory used does not depend on the length of the recording.
+
+        The last bucket of a downsampled signal is kept and downsampled with the next window (see
+        SignalReduction.splitOpenBucket), so the samples are the same as when the signal is decoded at once.
+
+        Args:
+            mdf: the open MDF-4 file
+            channels: the list of (None, group index, channel index) to select, all of them of the same channel group
+            chunkRecords: the number of records of each window
+            reductions: the SignalReduction of each channel (see SampleReduction), None to keep all samples
+    '''
+    cycles = getRecordsCount(mdf, channels[0][1])
+    reductions = reductions or [None] * len(channels)
+    # Raw samples of the last bucket of each downsampled signal, which can continue in the next window
+    openBuckets = [None] * len(channels)
+
+    for record_offset in range(0, cycles, chunkRecords):
+        with stage("select"):
+            rawSignals = mdf.select(channels=channels, raw=True, record_offset=record_offset, record_count=chunkRecords)
+
+        lastWindow = record_offset + chunkRecords >= cycles
+
+        with stage("decode"):
+            window = []
+            for index, (rawSignal, reduction) in enumerate(zip(rawSignals, reductions)):
+                if reduction is None or reduction.interval is None:
+                    window.append(decodeAndReduce(rawSignal, reduction))
+                    continue
+
+                rawSignal = reduction.crop(rawSignal)
+                if openBuckets[index] is not None:
+                    rawSignal = concatenateSignals(openBuckets[index], rawSignal)
+                    openBuckets[index] = None
+                if not lastWindow:
+                    rawSignal, openBuckets[index] = reduction.splitOpenBucket(rawSignal)
+
+                window.append(reduction.downsample(decodeRawSignal(rawSignal), rawSignal))
+
+        yield window
+
+def iterChannelBlocks(mdf):
+    '''
+        Iterates over the channels of the MDF-4 file in the same order as mdf.iter_channels, skipping master channels and
+        the channels that are part of a structure or array, using only the channel blocks read when the file was opened.
+        No data records are read.
+
+        Returns:
+            a (group index, channel index, channel block) tuple for each channel
+    '''
+    for index in mdf.virtual_groups:
+        for group_index, channel_indexes in mdf.included_channels(index)[index].items():
+            for channel_index in channel_indexes:
+                yield group_index, channel_index, mdf.groups[group_index].channels[channel_index]
+
+def getChannelDatatype(channel):
+    '''
+        Returns the numpy type name of the raw samples of a channel as mdf.select returns them, based on its channel block.
+        Variable length channels store offsets in the records, their samples are bytes with the size of the longest value,
+        which is only known after reading them, so their type is reported as bytes.
+    '''
+    if channel.channel_type == v4c.CHANNEL_TYPE_VLSD:
+        return "bytes"
+
+    # Arrays report the type of their elements
+    return channel.dtype_fmt.base.name
+
+def getRecordsCount(mdf, group_index):
+    '''
+        Returns the number of records (cycles) of a channel group without reading its data.
+    '''
+    return mdf.groups[group_index].channel_group.cycles_nr
+
+def getRecordSize(mdf, group_index):
+    '''
+        Returns the size in bytes of a record of a channel group, including its invalidation bytes.
+    '''
+    channel_group = mdf.groups[group_index].channel_group
+
+    return channel_group.samples_byte_nr + channel_group.invalidation_bytes_nr
+
+def decodeAndReduce(rawSignal, reduction=None):
+    '''
+        Returns the (decodedSignal, rawSignal) pair of a raw signal, reduced to the time window and interval of the reduction.
+        The raw signal is cropped before decoding, so only the samples in the time window are converted.
+    '''
+    if reduction is None:
+        return decodeRawSignal(rawSignal), rawSignal
+
+    rawSignal = reduction.crop(rawSignal)
+
+    return reduction.downsample(decodeRawSignal(rawSignal), rawSignal)
+
+def decodeRawSignal(rawSignal):
+    '''
+        Applies the conversion of a raw signal and returns the decoded signal.
+    '''
+    samples = rawSignal.samples
+    encoding = None
+
+    if rawSignal.conversion:
+        samples = rawSignal.conversion.convert(samples)
+
+    # Text produced by MDF-4 conversions is utf-8 encoded
+    if samples.dtype.kind == "S":
+        encoding = "utf-8"
+
+    return Signal(
+        samples,
+        rawSignal.timestamps,
+        unit=rawSignal.unit,
+        name=rawSignal.name,
+        conversion=None,
+        comment=rawSignal.comment,
+        raw=False,
+        master_metadata=rawSignal.master_metadata,
+        display_names=rawSignal.display_names,
+        attachment=rawSignal.attachment,
+        source=rawSignal.source,
+        invalidation_bits=rawSignal.invalidation_bits,
+        encoding=encoding,
+        group_index=rawSignal.group_index,
+        channel_index=rawSignal.channel_index,
+        flags=rawSignal.flags,
+    )
+
+def constantColumn(value, numberOfSamples, type=None):
+    '''
+        Creates an arrow column that has the same value in every row.
+        The column is dictionary encoded with a single entry, so the value is stored only once and not for each sample.
+    '''
+    return pa.DictionaryArray.from_arrays(np.zeros(numberOfSamples, dtype=np.int8), pa.array([value], type=type))
+
+def getStartTime(mdf):
+    '''
+        Returns the start time of the recording in nanoseconds since the epoch.
+        The MDF header stores the start time in UTC, a start time without time zone is considered UTC.
+    '''
+    startTime = mdf.start_time
+
+    if startTime.tzinfo is None:
+        startTime = startTime.replace(tzinfo=timezone.utc)
+
+    return (startTime - datetime(1970, 1, 1, tzinfo=timezone.utc)) // timedelta(microseconds=1) * 1000
+
+def absoluteTimestampColumn(timestamps, startTime):
+    '''
+        Converts the timestamps of a signal (seconds since the start of the recording) to an arrow column with the UTC time of each sample.
+        The start time is added as an integer, so the column keeps the nanosecond resolution of the timestamps.
+    '''
+    return pa.array(np.round(timestamps * 1e9).astype(np.int64) + startTime, type=pa.timestamp("ns", tz="UTC"))
+
+def timeRange(firstTimestamp, lastTimestamp, startTime):
+    '''
+        Returns the UTC time of the first and last sample of a signal as ISO 8601 strings, for the report and metadata file.
+    '''
+    return {
+        "min_time": str(np.datetime64(startTime + int(round(firstTimestamp * 1e9)), "ns")) + "Z",
+        "max_time": str(np.datetime64(startTime + int(round(lastTimestamp * 1e9)), "ns")) + "Z",
+    }
+
+def extractSignalsByType(decodedSignal, rawSignal, longValues=False):
     '''
         Extracts the signals from the MDF-4 file and converts them to a numeric or string representation
         Takes into consideration numbers, strings and records (rendered as a string) 
@@ -60,6 +249,7 @@ def extractSignalsByType(decodedSignal, rawSignal):
 
         ADX real datatype is a 64 bit float.
         This means that all integer types except uint64 and int64 can be stored without loss of precision        
+        uint64 and int64 are stored as string, unless longValues is set because they are exported with extractLongValues.
 
     '''   
     numberOfSamples = len(decodedSignal.timestamps)
@@ -69,10 +259,14 @@ def extractSignalsByType(decodedSignal, rawSignal):
     stringSignals = np.empty(numberOfSamples, dtype=str)
 
     try:
-        # If it is a record we will decompose its contents on the string field
+        # If it is a record we will decompose its contents on the string field as JSON
         # we will not store a value in floatSignals
-        if np.issubdtype(decodedSignal.samples.dtype, np.record):
-            stringSignals = [record.pprint() for record in decodedSignal.samples]
+        if decodedSignal.samples.dtype.names is not None:
+            stringSignals = renderRecords(decodedSignal.samples)
+
+        # Byte arrays (for example CAN or ethernet payloads) are rendered as hexadecimal, other arrays as JSON
+        elif decodedSignal.samples.ndim > 1:
+            stringSignals = renderArrays(decodedSignal.samples)
 
         # If the value can be represented as a float is the only thing we need.
         # String will be empty
@@ -82,7 +276,8 @@ def extractSignalsByType(decodedSignal, rawSignal):
         # Check if decodedSignal.samples.dtype is a uint64 or uint. If it is, we will only store it as string
         # Floats will not be stored as there is a loss of precision
         elif np.issubdtype(decodedSignal.samples.dtype, np.uint64) or np.issubdtype(decodedSignal.samples.dtype, np.int64):        
-            stringSignals = decodedSignal.samples.astype(str)   
+            if not longValues:
+                stringSignals = pc.cast(pa.array(decodedSignal.samples), pa.string())
     
         # We will store all ints smaller or equal to 32 bits in floats only, as we have no loss of precision
         elif np.issubdtype(decodedSignal.samples.dtype, np.integer):
@@ -90,13 +285,13 @@ def extractSignalsByType(decodedSignal, rawSignal):
         
         # If we have a pure string as raw signal, we will store it as a string
         elif np.issubdtype(rawSignal.samples.dtype, np.string_) or np.issubdtype(rawSignal.samples.dtype, np.unicode_):
-            stringSignals = rawSignal.samples.view(np.chararray).decode('utf-8') 
+            stringSignals = decodeStrings(rawSignal.samples)
 
         # For everything else use the previous approach but we will use decode with utf-8 to make sure we get the correct representation for text tables
         # astype(string) was causing issues with special characters, and S32 would have truncated results.
         else:
             floatSignals = rawSignal.samples.astype(float)
-            stringSignals = decodedSignal.samples.view(np.chararray).decode('utf-8') 
+            stringSignals = decodeStrings(decodedSignal.samples)
             
 
     except Exception as e:
@@ -104,4 +299,134 @@ def extractSignalsByType(decodedSignal, rawSignal):
         print(traceback.print_exc())        
         raise e
 
-    return floatSignals, stringSignals
\ No newline at end of file
+    return floatSignals, stringSignals
+
+def extractLongValues(decodedSignal):
+    '''
+        Extracts the integer samples of a signal without loss of precision.
+
+        Returns:
+            the value_long column, with the integer samples as int64 (int64 samples are used without copy),
+            and the value_decimal column, with the uint64 samples above the int64 range as decimal(20, 0).
+            Samples that are not stored in a column are null.
+    '''
+    samples = decodedSignal.samples
+    numberOfSamples = len(samples)
+    decimalSignals = pa.nulls(numberOfSamples, pa.decimal128(20, 0))
+
+    if samples.ndim > 1 or not np.issubdtype(samples.dtype, np.integer):
+        return pa.nulls(numberOfSamples, pa.int64()), decimalSignals
+
+    # Arrow only converts arrays in the native byte order
+    if not samples.dtype.isnative:
+        samples = samples.astype(samples.dtype.newbyteorder("="))
+
+    if np.issubdtype(samples.dtype, np.uint64):
+        aboveRange = samples > np.iinfo(np.int64).max
+        if aboveRange.any():
+            return pa.array(samples.view(np.int64), mask=aboveRange), pa.array(samples, mask=~aboveRange).cast(pa.decimal128(20, 0))
+        return pa.array(samples.view(np.int64)), decimalSignals
+
+    return pa.array(samples.astype(np.int64, copy=False)), decimalSignals
+
+def rawColumn(rawSignal, stringSignals):
+    '''
+        Returns the raw samples to export for a signal. Records and arrays don't fit in a single column value,
+        their raw value is the rendered string returned by extractSignalsByType.
+    '''
+    if rawSignal.samples.dtype.names is not None or rawSignal.samples.ndim > 1:
+        return stringSignals
+
+    return rawSignal.samples
+
+# Two hexadecimal digits for each byte value, used to render byte arrays without creating a string per sample
+HEX_DIGITS = np.array([f"{value:02x}".encode() for value in range(256)], dtype="S2")
+
+def decodeStrings(samples):
+    '''
+        Converts fixed size byte strings (null padded) to an arrow string array, validating them as utf-8.
+    '''
+    return pa.array(samples).cast(pa.string())
+
+def fixedWidthStrings(characters):
+    '''
+        Creates an arrow string array from a 2D uint8 array with one row of characters per sample,
+        using the array as the data buffer of the strings.
+    '''
+    numberOfSamples, width = characters.shape
+    offsetsType, stringType = (np.int32, pa.string()) if numberOfSamples * width < 2**31 else (np.int64, pa.large_string())
+    offsets = np.arange(numberOfSamples + 1, dtype=offsetsType) * width
+
+    return pa.Array.from_buffers(stringType, numberOfSamples, [None, pa.py_buffer(offsets), pa.py_buffer(np.ascontiguousarray(characters))])
+
+def renderHex(samples):
+    '''
+        Renders each sample of a byte array, or of a fixed size bytes type, as a hexadecimal string.
+    '''
+    width = samples.dtype.itemsize * int(np.prod(samples.shape[1:]))
+    samples = np.ascontiguousarray(samples).view(np.uint8).reshape(len(samples), width)
+
+    return fixedWidthStrings(HEX_DIGITS[samples].view(np.uint8).reshape(len(samples), 2 * width))
+
+def renderArrays(samples):
+    '''
+        Renders each sample of an array channel: byte arrays as hexadecimal strings, other arrays as JSON arrays.
+    '''
+    if samples.dtype.itemsize == 1 and samples.dtype.kind in "ui":
+        return renderHex(samples)
+
+    return renderJsonValues(samples)
+
+def renderRecords(samples):
+    '''
+        Renders each sample of a record channel as a JSON object with a member per field.
+        The fields are converted column by column with arrow compute functions, no object is created per sample.
+    '''
+    parts = []
+    for index, name in enumerate(samples.dtype.names):
+        parts.append(("{" if index == 0 else ",") + json.dumps(name) + ":")
+        parts.append(renderJsonValues(samples[name]))
+    parts.append("}")
+
+    return pc.binary_join_element_wise(*parts, "")
+
+def renderJsonValues(samples):
+    '''
+        Renders each sample as a JSON value. Byte arrays and byte strings are rendered as hexadecimal strings,
+        which need no escaping, and non finite floats as null.
+    '''
+    if samples.dtype.names is not None:
+        return renderRecords(samples)
+
+    if samples.ndim > 1:
+        if samples.dtype.itemsize == 1 and samples.dtype.kind in "ui":
+            return pc.binary_join_element_wise('"', renderHex(samples), '"', "")
+
+        elements = samples.reshape(len(samples), -1)
+        parts = ["["]
+        for index in range(elements.shape[1]):
+            if index > 0:
+                parts.append(",")
+            parts.append(renderJsonValues(elements[:, index]))
+        parts.append("]")
+
+        return pc.binary_join_element_wise(*parts, "")
+
+    if samples.dtype.kind in "SV":
+        return pc.binary_join_element_wise('"', renderHex(samples), '"', "")
+
+    if samples.dtype.kind == "U":
+        strings = pc.replace_substring(pc.replace_substring(pa.array(samples), "\\", "\\\\"), '"', '\\"')
+        return pc.binary_join_element_wise('"', strings, '"', "")
+
+    # Arrow only converts arrays in the native byte order
+    if not samples.dtype.isnative:
+        samples = samples.astype(samples.dtype.newbyteorder("="))
+
+    values = pa.array(samples)
+    strings = pc.cast(values, pa.string())
+
+    if pa.types.is_floating(values.type):
+        strings = pc.if_else(pc.is_finite(values), strings, "null")
+
+    return strings
\ No newline at end of file
@@ -0,0 +1,268 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import os
+import re
+from DecodeUtils import extractSignalsByType, selectDecodedAndRaw, iterRecordWindows, getRecordsCount, getStartTime, absoluteTimestampColumn, timeRange
+from MdfCache import getMdf, releaseMdf
+from Telemetry import stage, setSignal, withTelemetry
+from OutputSink import commitOutput, withOutputSink
+from OutputFormats import ParquetFormat
+
+# ADX type of the columns of the wide parquet files
+KUSTO_TYPES = {
+    pa.bool_(): "bool",
+    pa.int64(): "long",
+    pa.float64(): "real",
+    pa.decimal128(20, 0): "decimal",
+    pa.string(): "string",
+    pa.timestamp("ns", tz="UTC"): "datetime",
+}
+
+@withTelemetry
+@withOutputSink
+def processGroupAsWideParquet(counters, filename, signalsMetadata, uuid, targetdir, blacklistedSignals, chunkRecords=None, absoluteTimestamps=False, reduction=None, fileFormat=None):
+    '''
+        Creates a wide parquet export for the signals of a channel group: a table with the timestamp column of the channel
+        group and one typed column per signal, so the timestamps are stored once and not for every signal.
+
+        The file is written in the group-{group index} folder of targetdir, which holds the files of a single channel group
+        and can be used as the location of an external table (see MetadataTools.writeExternalTables).
+
+        Args:
+            counters: the position of each signal of the batch in the file metadata
+            filename: the MDF-4 file to process
+            signalsMetadata: the metadata of each signal of the batch, in the same order as counters
+            uuid: the UUID that identifies this decoding run
+            targetdir: the directory where the parquet files are written
+            blacklistedSignals: the list of signals to skip
+            chunkRecords: if set, channel groups with more records are decoded and written in windows of chunkRecords records
+            absoluteTimestamps: if set, the timestamp column is the UTC time of each sample and the results include the time range of each signal
+            reduction: the time window and downsampling of the signals (see SampleReduction), None to export all samples
+            fileFormat: the encoding options of the file (see OutputFormats.ParquetFormat), the defaults if None
+            outputSink: keyword argument, the sink that uploads the file of the task (see OutputSink.withOutputSink)
+        Returns:
+            a list with one result per signal, with an additional element with the file, row groups, column and type of the signal
+    '''
+
+    print(f"pid {os.getpid()}: Launched wide task for {len(counters)} signals of group index {signalsMetadata[0]['group_index']}")
+
+    results = []
+    selected = []
+
+    # If the signal is blacklisted, we skip it and return 0 samples
+    for counter, signalMetadata in zip(counters, signalsMetadata):
+        if signalMetadata["name"] in blacklistedSignals:
+            results.append((f"pid {os.getpid()}", True, counter, f"Skipped: {signalMetadata}", 0))
+        else:
+            selected.append((counter, signalMetadata))
+
+    if len(selected) == 0:
+        return results
+
+    group_index = selected[0][1]["group_index"]
+    writer = None
+    with stage("open"):
+        mdf = getMdf(filename)
+
+    try:
+        start_group_time = time.time()
+
+        # The start time of the file is used to calculate the absolute timestamps
+        startTime = getStartTime(mdf) if absoluteTimestamps else None
+
+        reductions = [reduction.forSignal(signalMetadata) for _, signalMetadata in selected] if reduction is not None else None
+        channels = [(None, group_index, signalMetadata["channel_index"]) for _, signalMetadata in selected]
+
+        writer = WideParquetWriter(os.path.join(targetdir, f"group-{group_index}"), f"{group_index}-{selected[0][0]}", selected, startTime, fileFormat)
+
+        # Long channel groups are decoded in windows to bound the memory used, each window is a row group
+        if chunkRecords and getRecordsCount(mdf, group_index) > chunkRecords:
+            windows = iterRecordWindows(mdf, channels, chunkRecords, reductions)
+        else:
+            windows = [selectDecodedAndRaw(mdf, channels, reductions)]
+
+        for window in windows:
+            writer.write(window)
+            del window
+
+        writer.close()
+
+        results.extend(writer.results(time.time() - start_group_time))
+
+    except Exception as e:
+        # If the channel group cannot be read or written, every signal without a result is reported as failed
+        for counter, signalMetadata in selected:
+            results.append((f"pid {os.getpid()}", False, counter, f"Signal {counter}: {signalMetadata['name']} failed: {str(e)}", 0))
+
+    finally:
+        if writer is not None:
+            writer.close()
+        releaseMdf(mdf)
+        del mdf
+
+    return results
+
+def wideColumn(decodedSignal, rawSignal):
+    '''
+        Converts the samples of a signal to a typed arrow column: integers as int64 (uint64 as decimal(20, 0), so no
+        value loses precision), floats as double, booleans as bool and every other signal as the string returned by
+        extractSignalsByType (text, records as JSON and byte arrays as hexadecimal).
+    '''
+    samples = decodedSignal.samples
+
+    if samples.ndim == 1 and samples.dtype.kind in "biuf":
+        # Arrow only converts arrays in the native byte order
+        if not samples.dtype.isnative:
+            samples = samples.astype(samples.dtype.newbyteorder("="))
+
+        if samples.dtype.kind == "b":
+            return pa.array(samples)
+
+        if samples.dtype.kind == "f":
+            return pa.array(samples.astype(np.float64, copy=False))
+
+        if samples.dtype == np.uint64:
+            return pa.array(samples).cast(pa.decimal128(20, 0))
+
+        return pa.array(samples.astype(np.int64, copy=False))
+
+    _, stringSignals = extractSignalsByType(decodedSignal=decodedSignal, rawSignal=rawSignal)
+
+    return pa.array(stringSignals).cast(pa.string())
+
+class WideParquetWriter:
+    '''
+        Writes the signals of a channel group, decoded at once or in windows, as the columns of a parquet file.
+
+        The timestamps of the first signal are the time base of the file. Signals with other timestamps (for example
+        downsampled with min or max, which keep a different sample of each interval) are reported as failed. The schema
+        is defined by the first window, a signal that fails in a later window is stored as null from then on.
+    '''
+
+    def __init__(self, targetdir, prefix, selected, startTime=None, fileFormat=None):
+        self.targetdir = targetdir
+        self.prefix = prefix
+        self.fileFormat = fileFormat if isinstance(fileFormat, ParquetFormat) else ParquetFormat()
+        self.counters = [counter for counter, _ in selected]
+        self.names = {counter: signalMetadata["name"] for counter, signalMetadata in selected}
+        self.startTime = startTime
+        self.columns = {}
+        self.errors = {}
+        self.fileName = None
+        self.writer = None
+        self.schema = None
+        self.schemaCounters = []
+        self.numberOfSamples = 0
+        self.rowGroups = 0
+        self.firstTimestamp = None
+        self.lastTimestamp = None
+
+        # Column names only use alphanumeric characters and underscore, a channel index is added to repeated names
+        for counter, signalMetadata in selected:
+            column = re.sub(r"[^a-zA-Z0-9_]", "_", signalMetadata["name"])
+            if column == "timestamp" or column in self.columns.values():
+                column = f"{column}_{signalMetadata['channel_index']}"
+            self.columns[counter] = column
+
+    def write(self, window):
+        timestamps = window[0][0].timestamps
+
+        if len(timestamps) == 0:
+            return
+
+        arrays = {}
+        for counter, (decodedSignal, rawSignal) in zip(self.counters, window):
+            if counter in self.errors:
+                continue
+            try:
+                setSignal(counter)
+                if not np.array_equal(decodedSignal.timestamps, timestamps):
+                    raise ValueError("the timestamps are not the time base of the channel group")
+                with stage("extract"):
+                    arrays[counter] = wideColumn(decodedSignal, rawSignal)
+            except Exception as e:
+                self.errors[counter] = f"Signal {counter}: {decodedSignal.name} failed: {str(e)}"
+            finally:
+                setSignal(None)
+
+        if self.writer is None:
+            self.open(arrays)
+
+        columns = [pa.array(timestamps) if self.startTime is None else absoluteTimestampColumn(timestamps, self.startTime)]
+        for field, counter in zip(list(self.schema)[1:], self.schemaCounters):
+            if counter in arrays:
+                columns.append(arrays[counter].cast(field.type))
+            else:
+                columns.append(pa.nulls(len(timestamps), field.type))
+
+        # The columns are written together, the time is shared by all signals of the file
+        with stage("build"):
+            table = pa.Table.from_arrays(columns, schema=self.schema)
+
+        with stage("write"):
+            self.writer.write_table(table, row_group_size=len(timestamps))
+        self.numberOfSamples += len(timestamps)
+        self.rowGroups += 1
+
+        self.firstTimestamp = min(timestamps.min(), self.firstTimestamp if self.firstTimestamp is not None else np.inf)
+        self.lastTimestamp = max(timestamps.max(), self.lastTimestamp if self.lastTimestamp is not None else -np.inf)
+
+    def open(self, arrays):
+        '''
+            Creates the file with a column for each signal of the first window that did not fail.
+        '''
+        os.makedirs(self.targetdir, exist_ok=True)
+
+        self.schemaCounters = [counter for counter in self.counters if counter in arrays]
+        timestampType = pa.float64() if self.startTime is None else pa.timestamp("ns", tz="UTC")
+        self.schema = pa.schema([("timestamp", timestampType)] + [(self.columns[counter], arrays[counter].type) for counter in self.schemaCounters])
+
+        # Files of a previous run can hold signals that are not decoded again when resuming, they are never overwritten
+        fileCounter = 0
+        while os.path.exists(os.path.join(self.targetdir, f"{self.prefix}-{fileCounter}.parquet")):
+            fileCounter += 1
+        self.fileName = f"{self.prefix}-{fileCounter}.parquet"
+
+        self.writer = pq.ParquetWriter(os.path.join(self.targetdir, self.fileName), self.schema, **self.fileFormat.writerOptions(self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            with stage("write"):
+                self.writer.close()
+            self.writer = None
+            commitOutput(os.path.join(self.targetdir, self.fileName))
+
+    def results(self, elapsed):
+        '''
+            Returns the result of each signal, with the file (relative to the output directory of the file), row groups,
+            column and ADX type of the signal.
+        '''
+        results = []
+        fieldTypes = {counter: field.type for counter, field in zip(self.schemaCounters, list(self.schema)[1:])} if self.schema is not None else {}
+
+        for counter in self.counters:
+            if counter in self.errors:
+                results.append((f"pid {os.getpid()}", False, counter, self.errors[counter], 0))
+
+            elif self.numberOfSamples == 0:
+                results.append((f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {self.names[counter]} - no samples in file", 0))
+
+            else:
+                details = {
+                    "file": f"{os.path.basename(self.targetdir)}/{self.fileName}",
+                    "row_groups": [0, self.rowGroups - 1],
+                    "column": self.columns[counter],
+                    "type": KUSTO_TYPES[fieldTypes[counter]],
+                    "timestamp_type": KUSTO_TYPES[self.schema.field("timestamp").type],
+                }
+
+                if self.startTime is not None:
+                    details.update(timeRange(self.firstTimestamp, self.lastTimestamp, self.startTime))
+
+                results.append((f"pid {os.getpid()}", True, counter, f"Processed signal {counter}: {self.names[counter]} with {self.numberOfSamples} entries in column {self.columns[counter]} in {elapsed}", self.numberOfSamples, details))
+
+        return results
@@ -0,0 +1,206 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from Benchmark import generateFile, SIGNAL_TYPES
+from DecodeParquet import buildSignalTable
+from DecodeUtils import iterChannelBlocks, selectDecodedAndRaw, getStartTime
+from OutputFormats import ParquetFormat, PROFILES, loadProfile
+from RemoteInput import openMdf
+
+# Version of the structure of the results file
+SWEEP_VERSION = "1.0"
+
+def decodeTables(filename, maxSignals=None, longValues=False, absoluteTimestamps=False):
+    '''
+        Decodes the signals of a MDF-4 file once and returns the table of each signal, as written by the parquet export.
+
+        Args:
+            filename: the MDF-4 file, a path or URL
+            maxSignals: the maximum number of signals to decode, None for all signals
+            longValues: if set, the tables have the value_long and value_decimal columns (see buildSignalTable)
+            absoluteTimestamps: if set, the timestamp column is the UTC time of each sample
+    '''
+    mdf = openMdf(filename)
+
+    try:
+        startTime = getStartTime(mdf) if absoluteTimestamps else None
+        channels = [(None, group_index, channel_index) for group_index, channel_index, _ in iterChannelBlocks(mdf)][:maxSignals]
+        tables = []
+
+        # The signals of a channel group are selected together, so its records are read once
+        for group_index in sorted(set(channel[1] for channel in channels)):
+            groupChannels = [channel for channel in channels if channel[1] == group_index]
+
+            for (_, _, channel_index), (decodedSignal, rawSignal) in zip(groupChannels, selectDecodedAndRaw(mdf, groupChannels)):
+                if len(decodedSignal.timestamps) == 0:
+                    continue
+                try:
+                    tables.append(buildSignalTable(decodedSignal, rawSignal, group_index, channel_index, "sweep", longValues, startTime))
+                except Exception as e:
+                    print(f"Signal {decodedSignal.name} is not included: {e}")
+
+    finally:
+        mdf.close()
+
+    return tables
+
+def sweepPoints(profiles, codecs=None):
+    '''
+        Returns the label and the options of ParquetFormat of each point of the sweep: each profile, with each codec if
+        codecs are given.
+
+        Args:
+            profiles: the names or files of the encoding profiles (see OutputFormats.loadProfile)
+            codecs: codecs that replace the codec of the profiles, as codec or codec:level, None to keep the codec of the profiles
+    '''
+    points = []
+
+    for profile in profiles:
+        for codec in codecs or [None]:
+            options = loadProfile(profile)
+            label = os.path.splitext(os.path.basename(profile))[0]
+
+            if codec is not None:
+                compression, _, level = codec.partition(":")
+                options["compression"] = compression
+                options["compressionLevel"] = int(level) if level else None
+                label = f"{label} {codec}"
+
+            points.append((label, {key: value for key, value in options.items() if value is not None}))
+
+    return points
+
+def measurePoint(tables, options, repeat=1):
+    '''
+        Writes the tables with the options and measures the size and the time to encode and to read the files.
+        The files are written to memory, so the time does not depend on the disk.
+
+        Returns:
+            the size of the files, the size of each column, and the shortest encode and read time of the repetitions
+    '''
+    fileFormat = ParquetFormat(**options)
+    encodeSeconds = None
+    readSeconds = None
+
+    for _ in range(repeat):
+        buffers = []
+        start_time = time.perf_counter()
+        for table in tables:
+            sink = pa.BufferOutputStream()
+            writer = fileFormat.open(sink, table.schema)
+            writer.write(table)
+            writer.close()
+            buffers.append(sink.getvalue())
+        seconds = time.perf_counter() - start_time
+        encodeSeconds = seconds if encodeSeconds is None else min(encodeSeconds, seconds)
+
+        start_time = time.perf_counter()
+        for buffer in buffers:
+            pq.read_table(pa.BufferReader(buffer))
+        seconds = time.perf_counter() - start_time
+        readSeconds = seconds if readSeconds is None else min(readSeconds, seconds)
+
+    # Size of each column over all files, to choose the encoding of the columns that dominate the size
+    columnBytes = {}
+    for buffer in buffers:
+        metadata = pq.ParquetFile(pa.BufferReader(buffer)).metadata
+        for rowGroup in range(metadata.num_row_groups):
+            for column in range(metadata.num_columns):
+                columnChunk = metadata.row_group(rowGroup).column(column)
+                columnBytes[columnChunk.path_in_schema] = columnBytes.get(columnChunk.path_in_schema, 0) + columnChunk.total_compressed_size
+
+    return {
+        "output_bytes": sum(buffer.size for buffer in buffers),
+        "column_bytes": columnBytes,
+        "encode_seconds": encodeSeconds,
+        "read_seconds": readSeconds,
+    }
+
+def runSweep(filename, points, maxSignals=None, longValues=False, absoluteTimestamps=False, repeat=1):
+    '''
+        Decodes the file once and measures each point of the sweep (see sweepPoints).
+
+        Returns:
+            the number of signals, samples and bytes of the tables in memory, and the measurements of each point with
+            the size relative to the tables in memory and the encoding throughput in MB of tables per second
+    '''
+    start_time = time.perf_counter()
+    tables = decodeTables(filename, maxSignals, longValues, absoluteTimestamps)
+    print(f"Decoded {len(tables)} signals in {time.perf_counter() - start_time:.2f} s")
+
+    tableBytes = sum(table.nbytes for table in tables)
+    pointResults = []
+
+    for label, options in points:
+        result = measurePoint(tables, options, repeat)
+        result.update(
+            point=label,
+            options=options,
+            ratio=result["output_bytes"] / tableBytes,
+            encode_mb_per_second=tableBytes / 2**20 / result["encode_seconds"],
+        )
+        pointResults.append(result)
+
+        print(f"{label}: {result['output_bytes'] / 2**20:.2f} MB ({result['ratio']:.1%} of the tables), encoded in {result['encode_seconds']:.2f} s ({result['encode_mb_per_second']:.0f} MB/s), read in {result['read_seconds']:.2f} s")
+
+    return {
+        "signals": len(tables),
+        "samples": sum(table.num_rows for table in tables),
+        "table_bytes": tableBytes,
+        "points": pointResults,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the size and the encoding time of the parquet export of a MDF-4 file with each encoding profile and codec.")
+    parser.add_argument("--file", dest="file", default=None, help="Path or URL of the MDF-4 file. Default generates a file as Benchmark.py does.")
+    parser.add_argument("--profiles", dest="profiles", nargs="+", default=list(PROFILES), help=f"Encoding profiles to measure, names ({', '.join(PROFILES)}) or JSON files. Default is all named profiles")
+    parser.add_argument("--codecs", dest="codecs", nargs="+", default=None, help="Codecs to measure with each profile, as codec or codec:level, for example snappy zstd:1 zstd:3 zstd:9 lz4. Default uses the codec of each profile.")
+    parser.add_argument("--max-signals", dest="maxSignals", type=int, default=None, help="Measure only the first signals of the file. Default is all signals")
+    parser.add_argument("--long-values", dest="longValues", action="store_true", help="Write the value_long and value_decimal columns, as with --long-values of MDF2AnalyticsFormat.")
+    parser.add_argument("--absolute-timestamps", dest="absoluteTimestamps", action="store_true", help="Write the UTC time of each sample, as with --absolute-timestamps of MDF2AnalyticsFormat.")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=1, help="Number of times each point is measured, the shortest time is reported. Default is 1")
+    parser.add_argument("--signals", dest="numberOfSignals", type=int, default=100, help="Number of signals of the generated file. Default is 100")
+    parser.add_argument("--samples", dest="numberOfSamples", type=int, default=100000, help="Number of samples of each signal of the generated file. Default is 100000")
+    parser.add_argument("--types", dest="typeMix", default="float=4,int=2,uint64=1,string=1,text=1,record=1", help=f"Signal types of the generated file with their weights, from {', '.join(SIGNAL_TYPES)}. Default is float=4,int=2,uint64=1,string=1,text=1,record=1")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Seed of the random samples of the generated file. Default is 0")
+    parser.add_argument("--output", dest="output", default=None, help="JSON file with the results. Default is encoding-sweep-<date>.json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="mdf42adx-sweep-")
+
+    try:
+        filename = args.file
+
+        if filename is None:
+            filename = os.path.join(workdir, "sweep.mf4")
+            generateFile(filename, args.numberOfSignals, args.numberOfSamples, args.typeMix, seed=args.seed)
+            print(f"Generated {filename} with {args.numberOfSignals} signals of {args.numberOfSamples} samples")
+
+        results = {
+            "sweep_version": SWEEP_VERSION,
+            "date": datetime.utcnow().isoformat() + "Z",
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "pyarrow": pa.__version__,
+            "parameters": vars(args).copy(),
+        }
+        results.update(runSweep(filename, sweepPoints(args.profiles, args.codecs), args.maxSignals, args.longValues, args.absoluteTimestamps, args.repeat))
+
+        output = args.output or f"encoding-sweep-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json"
+        with open(output, "w") as outputFile:
+            outputFile.write(json.dumps(results, indent=2))
+
+        print(f"Results written to {output}")
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
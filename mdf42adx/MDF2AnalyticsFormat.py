@@ -4,15 +4,26 @@ import argparse
 import json
 import os
 from   pathlib import Path
+from datetime import datetime
 import time 
 import multiprocessing as mp
 from multiprocessing import get_context
 import uuid
+from functools import partial
 
-from MDF2AnalyticsFormatProcessing import processSignals
-from DecodeParquet import processSignalAsParquet
-from DecodeCSV import processSignalAsCsv
-from MetadataTools import calculateMetadata, writeMetadata, dumpSignals
+from MDF2AnalyticsFormatProcessing import processSignals, processFiles, prepareFile
+from DecodeParquet import processSignalAsParquet, processGroupAsParquet
+from DecodeWideParquet import processGroupAsWideParquet
+from DecodeCSV import processSignalAsCsv, processGroupAsCsv, CSV_CHUNK_SIZE, CSV_COMPRESSION_LEVEL
+from MetadataTools import writeMetadata, dumpSignals
+from ResumeTools import findCompletedSignals
+from SignalFilter import readSignalFilter
+from SampleReduction import readSampleReduction, DOWNSAMPLING_METHODS
+from MetricsSampler import MetricsSampler
+from RemoteInput import inputBasename
+from OutputSink import openOutputSink
+from DecodePipeline import DecodePipeline
+from OutputFormats import FORMATS, PROFILES, ENCODINGS, createFormat, readEncodingOptions
 
 # This implementation just sends the result to the console
 def log_result(result):
@@ -22,18 +33,23 @@ def log_result(result):
 def log_error(error):
     print(f"{error}")
 
-# This implementation just sends completition status to the console on 10% increments
-updates = 0
+# Samples the machine and worker metrics with --metrics-interval, None when disabled
+metricsSampler = None
 
-def log_completition(result):
-    global updates
+# Uploads the files of the main process (report, metadata, manifest) with --output-url, None when they stay in the target
+outputSink = None
+
+# Writer processes of the parquet files with --pipeline-writers, None when the decoding workers write them
+pipeline = None
 
-    if divmod(int(result), 10) == (updates, 0):
-        updates += 1
-        print(f"Completed {result:9.0f}%")
+# This implementation just sends completition status to the console, on 10% increments of each file (see SignalsDecoding)
+def log_completition(result):
+    print(f"Completed {result:9.0f}%")
+    if metricsSampler is not None:
+        metricsSampler.progress(result)
     
 # This implementation writes the report to the disk    
-def createReport(basename, target, uuid, signalsMetadata, finishedSignals, errorSignals, timeoutSignals, vEntriesCount):
+def createReport(basename, target, uuid, signalsMetadata, finishedSignals, errorSignals, timeoutSignals, vEntriesCount, skippedSignals=None, telemetry=None):
     '''
          Write a JSON file with the results
 
@@ -44,22 +60,115 @@ def createReport(basename, target, uuid, signalsMetadata, finishedSignals, error
                 finishedSignals: the list of signals that were processed successfully
                 errorSignals: the list of signals that were processed with an error
                 timeoutSignals: the list of signals that were processed with a timeout
+                skippedSignals: the list of signals excluded by the signal filter
+                telemetry: the time, bytes and memory of the decoding stages (see Telemetry.summarizeTelemetry)
 
     '''
     with open(os.path.join(target, f"{basename}-{uuid}.report.json"), 'w') as reportFile:
         report = {
             "finished": finishedSignals,
             "error": errorSignals,
-            "timeout": timeoutSignals
+            "timeout": timeoutSignals,
+            "skipped": skippedSignals or [],
+            "telemetry": telemetry
         }
         reportFile.write(json.dumps(report))
 
+    if outputSink is not None:
+        outputSink.commit(os.path.join(target, f"{basename}-{uuid}.report.json"))
+
     
 def readBlacklistedSignals():
-    # Future implementation can use this method to return a list of blacklisted signals from a file.
+    # Workers skip the blacklisted signals after opening the file, use the signal filter (see SignalFilter) to skip signals before decoding.
     return [
     ]
 
+def selectMethod():
+    '''
+        Selects the method to process the signals based on the format and options.
+
+        Returns:
+            the method, the group batch size to use with processSignals and the output format (see OutputFormats),
+            the method is None if the format is not valid
+    '''
+    # Use the right method based on the format, decoding a single signal or a batch of the same channel group per task
+    groupBatchSize = args.groupBatchSize
+    reduction = readSampleReduction(args.startTime, args.stopTime, args.downsampling)
+    encodingOptions = readEncodingOptions(args.parquetProfile, args.compression, args.compressionLevel, False if args.noDictionary else None, args.rowGroupSize, args.columnEncodings, args.dictionaryPageSize, args.dataPageSize, args.statistics, True if args.pageIndex else None)
+    fileFormat = createFormat(args.exportFormat, **encodingOptions)
+
+    # The wide layout and coalesced files are parquet only, the other columnar formats write a file per signal
+    parquetOnly = args.parquetLayout == "wide" or args.parquetFileSizeMB is not None
+    if fileFormat is not None and fileFormat.columnar and fileFormat.name != "parquet" and parquetOnly:
+        print(f"--parquet-layout wide and --parquet-file-size are only used with --format parquet, {fileFormat.name} writes a file per signal")
+        parquetOnly = False
+
+    # Delta files are committed to the transaction log in the target directory, so they are not uploaded
+    sink = outputSink if fileFormat is None or fileFormat.name != "delta" else None
+    if outputSink is not None and sink is None:
+        print("--output-url does not upload the Delta table, which is written to the target directory")
+
+    if fileFormat is None:
+        method = None
+        print(f"Incorrect format selected, use argument --format with {', '.join(FORMATS)}")
+    elif (pipeline is not None and fileFormat.columnar and not parquetOnly):
+        # The decoding workers stage batches of signals for the writers, by default whole channel groups
+        groupBatchSize = groupBatchSize if groupBatchSize is not None else 0
+        method = pipeline.method(longValues=args.longValues, absoluteTimestamps=args.absoluteTimestamps, reduction=reduction, outputSink=sink, fileFormat=fileFormat)
+        if args.chunkRecords:
+            print("--chunk-records is not used with --pipeline-writers, the signals are decoded at once")
+        return method, groupBatchSize, fileFormat
+    elif (fileFormat.columnar and args.parquetLayout == "wide" and parquetOnly):
+        # A wide file has the columns of a whole channel group
+        groupBatchSize = 0
+        method = partial(processGroupAsWideParquet, chunkRecords=args.chunkRecords, absoluteTimestamps=args.absoluteTimestamps, reduction=reduction, fileFormat=fileFormat)
+    elif (fileFormat.columnar and parquetOnly):
+        # Coalesced files contain the signals of a batch, so batches default to whole channel groups
+        groupBatchSize = groupBatchSize if groupBatchSize is not None else 0
+        method = partial(processGroupAsParquet, targetFileSize=args.parquetFileSizeMB * 2**20, rowGroupSize=args.parquetRowGroupSize, longValues=args.longValues, absoluteTimestamps=args.absoluteTimestamps, reduction=reduction, fileFormat=fileFormat)
+    elif (fileFormat.columnar):         
+        method = processSignalAsParquet if groupBatchSize is None else processGroupAsParquet
+        method = partial(method, chunkRecords=args.chunkRecords, longValues=args.longValues, absoluteTimestamps=args.absoluteTimestamps, reduction=reduction, fileFormat=fileFormat)
+    else:         
+        method = processSignalAsCsv if groupBatchSize is None else processGroupAsCsv
+        method = partial(method, chunkSize=args.csvChunkSize, compressionLevel=args.csvCompressionLevel, compressionThreads=args.csvCompressionThreads, chunkRecords=args.chunkRecords, reduction=reduction)
+
+    if pipeline is not None:
+        print("--pipeline-writers is only used with the columnar formats with a file per signal, the decoding workers write the files")
+
+    # The workers upload the files of each task before returning its results
+    if method is not None and sink is not None:
+        if fileFormat.columnar:
+            method = partial(method, outputSink=sink)
+        else:
+            print("--output-url uploads the columnar formats only, the CSV files stay in the target directory")
+
+    return method, groupBatchSize, fileFormat
+
+def startMetrics():
+    '''
+        Starts sampling the machine and worker metrics in the background if --metrics-interval is set.
+    '''
+    global metricsSampler
+
+    if args.metricsInterval is not None:
+        metricsSampler = MetricsSampler(args.metricsInterval, args.target)
+        metricsSampler.start()
+
+def stopMetrics(metricsFile):
+    '''
+        Stops the sampling and writes the series of samples and progress events to metricsFile.
+    '''
+    global metricsSampler
+
+    if metricsSampler is not None:
+        metricsSampler.stop()
+        metricsSampler.write(metricsFile)
+        metricsSampler = None
+
+        if outputSink is not None:
+            outputSink.commit(metricsFile)
+
 def processFile(filename):
     '''Processes a single MDF file.'''
 
@@ -72,46 +181,110 @@ def processFile(filename):
         
     # Otherwise export to the desired format
     else:        
-        basename = Path(filename).stem
-        file_uuid = uuid.uuid4()          
+        basename = inputBasename(filename)
 
-        # Reads the MDF file metadata with all the file and signal information
-        metadata = calculateMetadata(filename, basename, file_uuid)
+        # Reads the MDF file metadata with all the file and signal information, resuming requires the content run ID
+        file_uuid, metadata = prepareFile(filename, basename, "content" if args.resume else args.runId)
         signalsMetadata = metadata["signals"]
         numberOfSignals = len(signalsMetadata)
 
-        # Use the right method based on the format
-        if (args.exportFormat == "parquet"):         
-            processSignals(filename, basename, file_uuid, args.target, signalsMetadata, readBlacklistedSignals(), processSignalAsParquet, numberOfSignals, log_result, log_error, log_completition, createReport)
-        elif (args.exportFormat == "csv"):         
-            processSignals(filename, basename, file_uuid, args.target, signalsMetadata, readBlacklistedSignals(), processSignalAsCsv, numberOfSignals, log_result, log_error, log_completition, createReport)
-        else:
-            print("Incorrect format selected, use argument --format with parquet or csv")     
+        method, groupBatchSize, fileFormat = selectMethod()
+
+        # Signals exported by a previous run of the same file are skipped
+        completedSignals = findCompletedSignals(basename, file_uuid, args.target, signalsMetadata) if args.resume else None
+
+        if method is not None:
+            startMetrics()
+            processSignals(filename, basename, file_uuid, args.target, signalsMetadata, readBlacklistedSignals(), method, numberOfSignals, log_result, log_error, log_completition, createReport, groupBatchSize=groupBatchSize, cacheSize=args.cacheSize, cacheMemoryMB=args.cacheMemoryMB, completedSignals=completedSignals, signalFilter=readSignalFilter(args.signalFilterFile, args.includeSignals, args.excludeSignals), outputSink=outputSink, pipeline=pipeline, fileFormat=fileFormat)
+            stopMetrics(os.path.join(args.target, f"{basename}-{file_uuid}.metrics.json"))
 
         # Writes the calculated metadata
-        writeMetadata(metadata, basename, file_uuid, args.target)           
+        writeMetadata(metadata, basename, file_uuid, args.target, outputSink)           
 
     end_time = time.time() - start_time
     print (f"Processing {filename} took {end_time} and has {numberOfSignals} signals")
 
 def processDirectory(directoryname):
     '''Processes a complete directoy containing several MDF-4 files.'''
-    for path in os.listdir(directoryname):
-        if os.path.isfile(os.path.join(directoryname, path)):
-            processFile(os.path.join(directoryname, path))
+    filenames = [os.path.join(directoryname, path) for path in os.listdir(directoryname) if os.path.isfile(os.path.join(directoryname, path))]
+
+    if (args.dump):
+        for filename in filenames:
+            processFile(filename)
+        return
+
+    # All files share one pool of workers, which decodes the signals of several files at the same time
+    method, groupBatchSize, fileFormat = selectMethod()
+
+    if method is not None:
+        start_time = time.time()
+        startMetrics()
+        processFiles(filenames, args.target, readBlacklistedSignals(), method, log_result, log_error, log_completition, createReport, groupBatchSize=groupBatchSize, cacheSize=args.cacheSize, cacheMemoryMB=args.cacheMemoryMB, runId="content" if args.resume else args.runId, resume=args.resume, maxOpenFiles=args.maxOpenFiles, signalFilter=readSignalFilter(args.signalFilterFile, args.includeSignals, args.excludeSignals), outputSink=outputSink, pipeline=pipeline, fileFormat=fileFormat)
+        # The files of a directory are decoded together, so they share a single series
+        stopMetrics(os.path.join(args.target, f"metrics-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json"))
+        print (f"Processing {directoryname} took {time.time() - start_time} and has {len(filenames)} files")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process a single MDF-4 or directory with MDF-4 files into CSV or Parquet Files.")
-    parser.add_argument("-f", "--file", dest="file", help="Path to a single MDF-4 file.")
+    parser.add_argument("-f", "--file", dest="file", help="Path or URL of a single MDF-4 file. http(s) URLs (e.g. a blob with a SAS token) are read with range requests, other URLs (az://, abfs://) with fsspec.")
     parser.add_argument("-d", "--directory", dest="directory", help="Path to a directory with MDF-4 files.")
     parser.add_argument("-t", "--target", dest="target", default=".", help="Location where the processed files will be stored.")
     parser.add_argument("--dump", dest="dump", action="store_true", help="Shows the signals contained in the file. No export will be made.")
-    parser.add_argument("--format", dest="exportFormat", default="parquet", help="Use csv or parquet to select your export format. Default is parquet")
+    parser.add_argument("--format", dest="exportFormat", default="parquet", choices=list(FORMATS), help="The export format: parquet, arrow (Arrow IPC / Feather V2 files), delta (parquet files appended to a Delta Lake table in the target directory) or csv. Default is parquet")
+    parser.add_argument("--parquet-profile", dest="parquetProfile", default=None, help=f"Encoding profile of the parquet and delta files: {', '.join(PROFILES)} or a JSON file with the encoding options. The options below replace those of the profile. Default is default")
+    parser.add_argument("--compression", dest="compression", default=None, help="Compression codec of the columnar formats: snappy (default of parquet and delta), zstd, gzip, brotli, lz4 (default of arrow) or none.")
+    parser.add_argument("--compression-level", dest="compressionLevel", type=int, default=None, help="Level of the zstd, gzip, brotli or lz4 compression. Default is the default of the codec.")
+    parser.add_argument("--no-dictionary", dest="noDictionary", action="store_true", help="Columnar formats only. Writes the columns without dictionary encoding.")
+    parser.add_argument("--row-group-size", dest="rowGroupSize", type=int, default=None, help="Columnar formats only. Maximum number of rows per row group (parquet, delta) or record batch (arrow). Default is the default of the format.")
+    parser.add_argument("--column-encoding", dest="columnEncodings", action="append", default=None, help=f"Parquet and delta only. Encoding of a column as column=encoding, or a list of encodings of which the first one that supports the type of the column is used, from {', '.join(ENCODINGS)}. Encoded columns are not dictionary encoded. Can be repeated.")
+    parser.add_argument("--dictionary-page-size", dest="dictionaryPageSize", type=int, default=None, help="Parquet and delta only. Size in bytes of the dictionary of a column chunk above which the rest of the chunk is written without dictionary. Default is 1 MB")
+    parser.add_argument("--data-page-size", dest="dataPageSize", type=int, default=None, help="Parquet and delta only. Size in bytes of the data pages. Default is 1 MB")
+    parser.add_argument("--statistics", dest="statistics", default=None, help="Parquet and delta only. Columns with min/max statistics: all, none or a comma separated list of columns. Default is all")
+    parser.add_argument("--page-index", dest="pageIndex", action="store_true", help="Parquet and delta only. Writes the column and offset indexes of the pages, so readers can skip pages within a row group. Needs pyarrow 13 or later.")
+    parser.add_argument("--group-batch", dest="groupBatchSize", type=int, default=None, help="Decode the signals of a channel group together, with at most this number of signals per task. Use 0 for whole channel groups. Default decodes one signal per task.")
+    parser.add_argument("--mdf-cache", dest="cacheSize", type=int, default=0, help="Number of parsed MDF files each worker keeps open between tasks. Default 0 opens the file in every task.")
+    parser.add_argument("--mdf-cache-memory", dest="cacheMemoryMB", type=int, default=None, help="Worker memory in MB above which the cached MDF files are closed. Default is no limit.")
+    parser.add_argument("--chunk-records", dest="chunkRecords", type=int, default=None, help="Decode and write signals with more records than this in windows of this number of records, to bound the memory used by each worker. Default decodes each signal at once.")
+    parser.add_argument("--parquet-file-size", dest="parquetFileSizeMB", type=int, default=None, help="Coalesce the signals of each task into parquet files of about this size in MB, with a manifest of the file and row groups of each signal. Default writes one file per signal.")
+    parser.add_argument("--parquet-row-group-size", dest="parquetRowGroupSize", type=int, default=None, help="Maximum number of rows per row group of the coalesced parquet files.")
+    parser.add_argument("--parquet-layout", dest="parquetLayout", choices=["narrow", "wide"], default="narrow", help="narrow writes a row per sample with the signal name and value. wide writes a file per channel group with a timestamp column and a typed column per signal, and the KQL commands to create its external tables. Default is narrow")
+    parser.add_argument("--long-values", dest="longValues", action="store_true", help="Parquet only. Writes integer signals to a value_long (int64) column and uint64 values above the int64 range to a value_decimal column, instead of rendering 64 bit integers as strings.")
+    parser.add_argument("--absolute-timestamps", dest="absoluteTimestamps", action="store_true", help="Parquet only. Writes the timestamp column as the UTC time of each sample (start time of the file plus the relative timestamp) instead of the seconds since the start of the recording, and adds the time range of each signal to the metadata file.")
+    parser.add_argument("--csv-chunk-size", dest="csvChunkSize", type=int, default=CSV_CHUNK_SIZE, help=f"Number of rows formatted and compressed at a time by the CSV export. Default is {CSV_CHUNK_SIZE}")
+    parser.add_argument("--csv-compression-level", dest="csvCompressionLevel", type=int, default=CSV_COMPRESSION_LEVEL, help=f"Gzip compression level of the CSV export. Default is {CSV_COMPRESSION_LEVEL}")
+    parser.add_argument("--csv-compression-threads", dest="csvCompressionThreads", type=int, default=1, help="Compression threads per CSV file, more than one requires python-isal (levels 0 to 3). Default is 1")
+    parser.add_argument("--run-id", dest="runId", choices=["random", "content"], default="random", help="Use a random UUID for each run, or a UUID derived from the file content and decoder version that is the same for every run of the file. Default is random")
+    parser.add_argument("--resume", dest="resume", action="store_true", help="Uses the content run ID and skips the signals that a previous run of the same file already exported. Failed and timed out signals are decoded again.")
+    parser.add_argument("--max-open-files", dest="maxOpenFiles", type=int, default=2, help="Number of files of a directory decoded at the same time by the shared pool of workers. Default is 2")
+    parser.add_argument("--include-signals", dest="includeSignals", action="append", default=[], help="Decode only the signals that match this rule: a glob on the signal name, or field:glob or field~regex with field name, bus, source or group. Can be repeated.")
+    parser.add_argument("--exclude-signals", dest="excludeSignals", action="append", default=[], help="Skip the signals that match this rule (see --include-signals). Can be repeated.")
+    parser.add_argument("--signal-filter", dest="signalFilterFile", default=None, help="File with a signal filter rule per line. Lines starting with + include signals, other lines exclude them.")
+    parser.add_argument("--start-time", dest="startTime", type=float, default=None, help="Export only the samples from this time, in seconds since the start of the recording.")
+    parser.add_argument("--stop-time", dest="stopTime", type=float, default=None, help="Export only the samples until this time, in seconds since the start of the recording.")
+    parser.add_argument("--downsample", dest="downsampling", action="append", default=[], help=f"Export one sample per interval: [signal rule=]interval[:method], with the interval in seconds, a signal rule as in --include-signals and the method {', '.join(DOWNSAMPLING_METHODS)} (default mean). The first matching rule is used. Can be repeated.")
+    parser.add_argument("--output-url", dest="outputUrl", default=None, help="Upload the parquet export, metadata and report to this location and delete them from the target directory, which is used as a bounded staging area. A container URL with a SAS token (http(s)://), a fsspec URL (az://, abfs://) or a file:// directory. Default keeps the files in the target directory.")
+    parser.add_argument("--upload-concurrency", dest="uploadConcurrency", type=int, default=4, help="Uploads at a time of each worker with --output-url. Default is 4")
+    parser.add_argument("--upload-staging-mb", dest="uploadStagingMB", type=int, default=1024, help="Size in MB of the files waiting for upload above which each worker waits for the uploads before writing more files. Default is 1024")
+    parser.add_argument("--pipeline-writers", dest="pipelineWriters", type=int, default=None, help="Parquet narrow layout with a file per signal only. The decoding workers hand the decoded signals over in shared memory to this number of writer processes, which build and write the parquet files. Default decodes and writes each signal in the same worker.")
+    parser.add_argument("--pipeline-staging-mb", dest="pipelineStagingMB", type=int, default=1024, help="Size in MB of the decoded signals waiting for the writers above which no more tasks start decoding. Default is 1024")
+    parser.add_argument("--metrics-interval", dest="metricsInterval", type=float, default=None, help="Sample the CPU, memory, disk and worker memory every this number of seconds in the background, and write the series with the progress events to a .metrics.json file next to the report. Default does not sample.")
     args = parser.parse_args()
 
+    if args.outputUrl is not None:
+        outputSink = openOutputSink(args.target, args.outputUrl, args.uploadConcurrency, args.uploadStagingMB)
+
+    if args.pipelineWriters is not None:
+        pipeline = DecodePipeline(args.pipelineWriters, args.pipelineStagingMB)
+
     if(args.file):
         processFile(args.file)
     elif(args.directory):
         processDirectory(args.directory)
 
+    if pipeline is not None:
+        pipeline.close()
+
+    if outputSink is not None:
+        outputSink.close()
+
 
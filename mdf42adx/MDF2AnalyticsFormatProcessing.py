@@ -5,15 +5,388 @@ import json
 import os
 from   pathlib import Path
 import time 
+import heapq
+import itertools
+import queue
 import multiprocessing as mp
 from multiprocessing import get_context
 import uuid
 from DecodeParquet import processSignalAsParquet
 from DecodeCSV import processSignalAsCsv
-from MetadataTools import writeMetadata, dumpSignals
+from MetadataTools import calculateMetadata, calculateRunId, writeMetadata, writeManifest, writeExternalTables, dumpSignals
+from MdfCache import initializeWorker
+from ResumeTools import findCompletedSignals
+from Telemetry import summarizeTelemetry
+from RemoteInput import inputBasename
 
+# Estimated cost of decoding and writing a sample, compared to reading a byte of its record.
+# Numeric samples are converted and written as arrays, text and byte samples are converted one by one.
+NUMERIC_SAMPLE_COST = 16
+TEXT_SAMPLE_COST = 256
 
-def processSignals(filename, basename, uuid, target, signalsMetadata, blacklistedSignals, method, numberOfSignals, log_result, log_error, log_completition, createReport):
+# Minimum rate at which a task is expected to process its estimated cost, used to scale the timeouts with the size of the signals
+TIMEOUT_COST_PER_SECOND = 2**20
+
+# Timeout in seconds of the smallest tasks, and of the preparation of a file
+MIN_TIMEOUT = 60*6
+
+
+def groupSignals(signalsMetadata, maxSignalsPerTask=0, counters=None):
+    '''
+        Splits the signals into batches where all signals of a batch belong to the same channel group.
+        Each batch can be decoded by a single task that reads the channel group only once.
+
+        Args:
+            signalsMetadata: the list of signals to process
+            maxSignalsPerTask: the maximum number of signals in a batch, 0 to use the whole channel group
+            counters: the signal counters to include, None for all signals
+        Returns:
+            a list of batches, each one being the list of signal counters that belong to it
+    '''
+    groups = {}
+    for counter in (counters if counters is not None else range(len(signalsMetadata))):
+        groups.setdefault(signalsMetadata[counter]["group_index"], []).append(counter)
+
+    batches = []
+    for counters in groups.values():
+        batchSize = maxSignalsPerTask if maxSignalsPerTask > 0 else len(counters)
+        for start in range(0, len(counters), batchSize):
+            batches.append(counters[start:start + batchSize])
+
+    return batches
+
+def estimateCost(signalsMetadata, counters):
+    '''
+        Estimates the cost of a task from the sample count, record size and data type of its signals (see calculateMetadata).
+        The records of the channel group are read once per task, and each signal adds the cost of decoding and writing its samples.
+
+        Args:
+            signalsMetadata: the list of signals of the file
+            counters: the signal counters processed by the task
+        Returns:
+            the estimated cost, in bytes of record data
+    '''
+    samples = max(signalsMetadata[counter].get("samples_count", 0) for counter in counters)
+    recordSize = max(signalsMetadata[counter].get("record_size", 0) for counter in counters)
+
+    sampleCost = 0
+    for counter in counters:
+        datatype = signalsMetadata[counter].get("datatype", "")
+        sampleCost += TEXT_SAMPLE_COST if datatype.startswith(("bytes", "str", "void", "object")) else NUMERIC_SAMPLE_COST
+
+    return samples * (recordSize + sampleCost)
+
+def estimateTimeout(signalsMetadata, counters):
+    '''
+        Returns the timeout in seconds of a task: the time to process its estimated cost at a conservative rate, and at least MIN_TIMEOUT.
+    '''
+    return max(MIN_TIMEOUT, estimateCost(signalsMetadata, counters) / TIMEOUT_COST_PER_SECOND)
+
+def createPool(cacheSize=0, cacheMemoryMB=None, pipeline=None):
+    '''
+        Creates the pool of worker processes that decode the signals.
+        With a pipeline (see DecodePipeline), the results of the workers are written by its writer processes.
+
+        Returns:
+            the pool and its number of workers
+    '''
+    # Create a pool of worker processes with all available CPUs -1
+    # To avoid potential memory leaks with the MDF library, we will restart the process after a certain number of processes (maxtasks per child)
+    # We also use the spawn context to avoid problems with fork()
+    # With the MDF cache the workers are long lived and keep the parsed files open, the memory ceiling replaces the restarts
+    workers = max(1, mp.cpu_count()-1)
+    if cacheSize > 0:
+        pool = get_context("spawn").Pool(workers, initializer=initializeWorker, initargs=(cacheSize, cacheMemoryMB))
+    else:
+        pool = get_context("spawn").Pool(workers, maxtasksperchild=10)
+
+    if pipeline is not None:
+        pool = pipeline.createPool(pool)
+
+    return pool, workers
+
+class TaskScheduler:
+    '''
+        Submits tasks to a pool and returns their outcomes in the order in which they complete.
+
+        Each task has a timeout. A task can only start once the tasks submitted before it leave a worker free,
+        so its deadline includes its share of the timeouts of the pending tasks on top of its own timeout.
+        Results arriving after the deadline are ignored, and timedOut is set as the task may still hold its worker.
+    '''
+
+    def __init__(self, pool, workers):
+        self.pool = pool
+        self.workers = workers
+        self.completedTasks = queue.Queue()
+        self.pendingTasks = {}
+        self.pendingSeconds = 0
+        self.deadlines = [] # Heap of (deadline, submission number, key), it can include tasks that are no longer pending
+        self.submissions = itertools.count()
+        self.timedOut = False
+
+    def submit(self, key, method, args, timeout, log_result, log_error):
+        '''
+            Submits a task identified by key. The pool callbacks log the outcome and queue it to be returned by next.
+        '''
+        deadline = time.monotonic() + self.pendingSeconds / self.workers + timeout
+        self.pendingTasks[key] = (deadline, timeout)
+        self.pendingSeconds += timeout
+        heapq.heappush(self.deadlines, (deadline, next(self.submissions), key))
+
+        self.pool.apply_async(
+            method, 
+            args=args,
+            callback=lambda value: (log_result(value), self.completedTasks.put((key, value, None))),
+            error_callback=lambda error: (log_error(error), self.completedTasks.put((key, None, error)))
+        )
+
+    def hasPending(self):
+        return len(self.pendingTasks) > 0
+
+    def next(self):
+        '''
+            Waits for the next task to complete or to reach its deadline.
+
+            Returns:
+                the key, value and error of the task. The error is a TimeoutError if the deadline passed.
+        '''
+        while True:
+            while self.deadlines[0][2] not in self.pendingTasks:
+                heapq.heappop(self.deadlines)
+
+            deadline, _, key = self.deadlines[0]
+            timeout = self.pendingTasks[key][1]
+
+            try:
+                key, value, error = self.completedTasks.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                self.remove(key)
+                self.timedOut = True
+                return key, None, mp.TimeoutError(f"no result after {timeout:.0f} seconds")
+
+            if key in self.pendingTasks:
+                self.remove(key)
+                return key, value, error
+
+    def remove(self, key):
+        self.pendingSeconds -= self.pendingTasks.pop(key)[1]
+
+class SignalsDecoding:
+    '''
+        Decoding of the signals of a MDF-4 file: creates its tasks, records their results and writes the report.
+        See processSignals for the arguments.
+    '''
+
+    def __init__(self, filename, basename, uuid, target, signalsMetadata, blacklistedSignals, method, numberOfSignals, log_completition, createReport, groupBatchSize=None, completedSignals=None, signalFilter=None, outputSink=None, fileFormat=None):
+        self.filename = filename
+        self.basename = basename
+        self.uuid = uuid
+        self.target = target
+        self.signalsMetadata = signalsMetadata
+        self.blacklistedSignals = blacklistedSignals
+        self.method = method
+        self.numberOfSignals = numberOfSignals
+        self.log_completition = log_completition
+        self.createReport = createReport
+        self.groupBatchSize = groupBatchSize
+        self.outputSink = outputSink
+        self.fileFormat = fileFormat
+        self.pendingTasks = 0
+
+        # The progress is reported on 10% increments, separately for each file
+        self.previousStep = -10
+
+        self.finishedSignals = []
+        self.errorSignals = []
+        self.timeoutSignals = []
+        self.skippedSignals = []
+        self.vEntriesCount = 0 # Capture TOTAL( no. of entries per signal )
+        self.manifest = [] # Location of the signals written to coalesced files
+        
+        self.targetdir = os.path.join(target, f"{basename}-{uuid}")
+
+        # Signals exported by a previous run are reported with their previous result and not decoded again
+        completedSignals = completedSignals or {}
+        self.resumedCounters = set(completedSignals)
+        for counter in sorted(completedSignals):
+            self.recordFinished(completedSignals[counter])
+
+        pendingCounters = [counter for counter in range(len(signalsMetadata)) if counter not in completedSignals]
+
+        # Signals excluded by the filter are reported as skipped and never sent to a worker
+        if signalFilter is not None:
+            for counter in pendingCounters:
+                if not signalFilter.isSelected(signalsMetadata[counter]):
+                    self.recordSkipped(counter)
+
+            pendingCounters = [counter for counter in pendingCounters if "signal_skipped" not in signalsMetadata[counter]]
+
+        # Each task processes a single signal, or a batch of signals of the same channel group
+        if groupBatchSize is None:
+            self.tasks = [[counter] for counter in pendingCounters]
+        else:
+            self.tasks = groupSignals(signalsMetadata, groupBatchSize, pendingCounters)
+
+        # The most expensive tasks are submitted first, so a long signal doesn't start at the end and leave the other workers idle
+        self.tasks.sort(key=lambda counters: estimateCost(signalsMetadata, counters), reverse=True)
+
+    def submit(self, scheduler, log_result, log_error):
+        '''
+            Submits the tasks to the scheduler, identified by (self, task index).
+        '''
+        # Iterate over the signals contained in the MDF-4 file.
+        # We will apply the method given as an argument with the callback for both success and error.
+        for index, counters in enumerate(self.tasks):
+
+            if self.groupBatchSize is None:
+                args = (counters[0], self.filename, self.signalsMetadata[counters[0]], self.uuid, self.targetdir, self.blacklistedSignals)
+            else:
+                args = (counters, self.filename, [self.signalsMetadata[counter] for counter in counters], self.uuid, self.targetdir, self.blacklistedSignals)
+
+            # Apply the processSignal function to each signal or batch asynchronously
+            scheduler.submit((self, index), self.method, args, estimateTimeout(self.signalsMetadata, counters), log_result, log_error)
+
+        self.pendingTasks = len(self.tasks)
+
+    def collect(self, index, value, error):
+        '''
+            Records the outcome of a task returned by the scheduler.
+        '''
+        counters = self.tasks[index]
+        self.pendingTasks -= 1
+
+        if isinstance(error, mp.TimeoutError):
+            self.recordTimeout(counters, error)
+        elif error is not None:
+            self.recordError(counters, error)
+        else:
+            # Batches return one value per signal
+            values = [value] if self.groupBatchSize is None else value
+
+            for value in values:
+                self.recordFinished(value)
+
+    def recordFinished(self, value):
+        counter = value[2]
+
+        #Append the value to signalsMetadata json file
+        self.signalsMetadata[counter]["signal_decoded_status"] = value[1]
+        self.signalsMetadata[counter]["records_count"] = value[4]
+        self.signalsMetadata[counter]["message"] = value[3]
+        
+        self.finishedSignals.append(
+            {
+                "counter": counter,
+                "name": self.signalsMetadata[counter]["name"],
+                "value": value
+            }
+        )
+
+        # Methods with absolute timestamps add the time range of the signal
+        if len(value) > 5 and "min_time" in value[5]:
+            self.signalsMetadata[counter]["min_time"] = value[5]["min_time"]
+            self.signalsMetadata[counter]["max_time"] = value[5]["max_time"]
+
+        # Methods writing coalesced or wide files add the file and row groups used by the signal
+        if len(value) > 5 and "file" in value[5]:
+            entry = {
+                "counter": counter,
+                "name": self.signalsMetadata[counter]["name"],
+                "file": value[5]["file"],
+                "row_groups": value[5]["row_groups"]
+            }
+
+            # Wide files also add the column of the signal, used to define their external tables
+            if "column" in value[5]:
+                entry["column"] = value[5]["column"]
+                entry["type"] = value[5]["type"]
+                entry["timestamp_type"] = value[5]["timestamp_type"]
+
+            self.manifest.append(entry)
+
+        # Capture finishedSignals with no errors, i.e. with 'True' from Decoding so we can add it to the total entries counts:      
+        self.vEntriesCount = self.vEntriesCount + value[4]
+            
+        # Log the percentage of signals processed. It rarely is an exact multiple of 10, so the first result of each step is reported
+        completion = (len(self.finishedSignals) / self.numberOfSignals)*100
+        step = int(completion // 10) * 10
+
+        if step > self.previousStep:
+            self.previousStep = step
+            self.log_completition(completion)
+
+    def recordSkipped(self, counter):
+        self.signalsMetadata[counter]["signal_decoded_status"] = False
+        self.signalsMetadata[counter]["signal_skipped"] = True
+        self.signalsMetadata[counter]["records_count"] = 0
+        self.signalsMetadata[counter]["message"] = "Skipped by the signal filter"
+
+        self.skippedSignals.append(
+            {
+                "counter": counter,
+                "name": self.signalsMetadata[counter]["name"]
+            }
+        )
+
+    def recordTimeout(self, counters, te):
+        for counter in counters:
+            print(f"TimeoutError for {counter} - {self.signalsMetadata[counter]['name']}: {te}")
+
+            self.signalsMetadata[counter]["signal_decoded_status"] = False
+            self.signalsMetadata[counter]["records_count"] = 0
+            self.signalsMetadata[counter]["message"] = f"TimeoutError {te}"
+
+            self.timeoutSignals.append(
+                {
+                    "counter": counter,
+                    "name": self.signalsMetadata[counter]["name"],
+                    "value": f"TimeoutError {te}"
+                }                    
+            )
+
+    def recordError(self, counters, e):
+        for counter in counters:
+            print(f"Exception for {counter} - {self.signalsMetadata[counter]['name']}: {e}")
+
+            self.signalsMetadata[counter]["signal_decoded_status"] = False
+            self.signalsMetadata[counter]["records_count"] = 0
+            self.signalsMetadata[counter]["message"] = f"Exception {e}"
+
+            self.errorSignals.append(
+                {
+                    "counter": counter,
+                    "name": self.signalsMetadata[counter]['name'],
+                    "value": f"Exception {e}"
+                }               
+            ) 
+
+    def finish(self):
+        '''
+            Writes the report and the manifest of the file, and commits its files to the output format.
+        '''
+        # We create a report that contains all signals.
+        print (f"Finished. Tasks total/finished/errors/timeout/skipped: {len(self.signalsMetadata)} / {len(self.finishedSignals)} / {len(self.errorSignals)} / {len(self.timeoutSignals)} / {len(self.skippedSignals)}")
+        print (f"Finished: {self.finishedSignals}")
+        print (f"Errors: {self.errorSignals}")
+        print (f"Timeout signals: {self.timeoutSignals}")
+        print(f'Total Cumulative Signal entries count: {self.vEntriesCount}')
+
+        # The telemetry of the signals resumed from a previous run belongs to that run, as do their files
+        telemetry = summarizeTelemetry([signal for signal in self.finishedSignals if signal["counter"] not in self.resumedCounters])
+
+        if self.fileFormat is not None:
+            try:
+                self.fileFormat.commit(self.target, self.basename, self.uuid, [signal["value"] for signal in self.finishedSignals if signal["counter"] not in self.resumedCounters])
+            except Exception as e:
+                print(f"Error committing the {self.fileFormat.name} files of {self.basename}-{self.uuid}: {e}")
+
+        self.createReport(self.basename, self.target, self.uuid, self.signalsMetadata, self.finishedSignals, self.errorSignals, self.timeoutSignals, self.vEntriesCount, self.skippedSignals, telemetry)
+        if len(self.manifest) > 0:
+            writeManifest(self.manifest, self.basename, self.uuid, self.target, self.outputSink)
+        if any("column" in entry for entry in self.manifest):
+            writeExternalTables(self.manifest, self.basename, self.uuid, self.target, self.outputSink)
+
+def processSignals(filename, basename, uuid, target, signalsMetadata, blacklistedSignals, method, numberOfSignals, log_result, log_error, log_completition, createReport, groupBatchSize=None, cacheSize=0, cacheMemoryMB=None, completedSignals=None, signalFilter=None, outputSink=None, pipeline=None, fileFormat=None):
     '''
         Writes the MDF-4 file to a file that can be used by ADX.
         Each signal will be processed in parallel.
@@ -28,106 +401,156 @@ def processSignals(filename, basename, uuid, target, signalsMetadata, blackliste
             method: the method to use to process the signals
             log_result: the callback to use when a signal is processed successfully
             log_error: the callback to use when a signal is processed with an error
+            log_completition: the callback that gets the percentage of signals processed, once per 10% step
+            groupBatchSize: if set, method processes a batch of signals of the same channel group per task
+                            (see groupSignals) instead of a single signal. 0 uses the whole channel group.
+            cacheSize: the number of MDF files each worker keeps open between tasks, 0 to open the file in every task
+            cacheMemoryMB: the worker memory above which cached MDF files are closed, None for no limit
+            completedSignals: the results of a previous run for the signals that are already exported (see ResumeTools.findCompletedSignals).
+                              These signals are not decoded again but are included in the report and metadata.
+            signalFilter: the SignalFilter that selects the signals to decode, None to decode all signals.
+                          The other signals are reported as skipped.
+            outputSink: the sink that uploads the manifest and external tables files (see OutputSink.openOutputSink),
+                        the files of the signals are uploaded by the workers with the sink given to method.
+            pipeline: the DecodePipeline whose writer processes write the results of method, None when method writes the files.
+            fileFormat: the output format written by method (see OutputFormats), whose commit records the files once the
+                        signals are processed. None when there is nothing to commit.
     '''   
 
-    finishedSignals = []
-    errorSignals = []
-    timeoutSignals = []
-    
-    targetdir = os.path.join(target, f"{basename}-{uuid}")
-    
-    try:
-        # Create a pool of worker processes with all available CPUs -1
-        # To avoid potential memory leaks with the MDF library, we will restart the process after a certain number of processes (maxtasks per child)
-        # We also use the spawn context to avoid problems with fork()
-        pool = get_context("spawn").Pool(mp.cpu_count()-1, maxtasksperchild=10)
-        
+    decoding = SignalsDecoding(filename, basename, uuid, target, signalsMetadata, blacklistedSignals, method, numberOfSignals, log_completition, createReport, groupBatchSize, completedSignals, signalFilter, outputSink, fileFormat)
+    pool = None
 
-        # Iterate over the signals contained in the MDF-4 file.
-        # We will apply the method given as an argument with the callback for both success and error.
-        results = []
-        for counter, signalMetadata in enumerate(signalsMetadata):
-
-            # Apply the processSignal function to each signal asynchronously
-            result = pool.apply_async(
-                method, 
-                args=(counter, filename, signalMetadata, uuid, targetdir, blacklistedSignals),
-                callback=log_result,
-                error_callback=log_error
-            )
+    try:
+        pool, workers = createPool(cacheSize, cacheMemoryMB, pipeline)
+        scheduler = TaskScheduler(pool, workers)
 
-            results.append(result)
+        decoding.submit(scheduler, log_result, log_error)
 
         # All tasks have been submitted, no more tasks will be added to this pool.
         pool.close()
 
-        vEntriesCount = 0 # Capture TOTAL( no. of entries per signal )
-        # get the task result with a timeout defined as 3 minutes per signal.
-        # This is a blocking call, so we will check the results in the order in which the tasks are submitted
-        for counter, result in enumerate(results):
+        while scheduler.hasPending():
+            (_, index), value, error = scheduler.next()
+            decoding.collect(index, value, error)
 
-            try:
-                #print(f"Waiting for value for {counter} - {signalsMetadata[counter]['name']}")
-                value = result.get(timeout=60*6) # Wait for the value for 6 minutes, if it is not ready, it will probably never be   
-
-                #Append the value to signalsMetadata json file
-                signalsMetadata[counter]["signal_decoded_status"] = value[1]
-                signalsMetadata[counter]["records_count"] = value[4]
-                signalsMetadata[counter]["message"] = value[3]
-                
-                finishedSignals.append(
-                    {
-                        "counter": counter,
-                        "name": signalsMetadata[counter]["name"],
-                        "value": value
-                    }
-                )
-
-                # Capture finishedSignals with no errors, i.e. with 'True' from Decoding so we can add it to the total entries counts:      
-                vEntriesCount = vEntriesCount + value[4]
-                    
-                log_completition( (len(finishedSignals) / numberOfSignals)*100 ) # Log the percentage of signals processed
-                
-            except mp.TimeoutError as te:
-                print(f"TimeoutError for {counter} - {signalsMetadata[counter]['name']}: {te}")
-
-                signalsMetadata[counter]["signal_decoded_status"] = False
-                signalsMetadata[counter]["records_count"] = 0
-                signalsMetadata[counter]["message"] = f"TimeoutError {te}"
-
-                timeoutSignals.append(
-                    {
-                        "counter": counter,
-                        "name": signalsMetadata[counter]["name"],
-                        "value": f"TimeoutError {te}"
-                    }                    
-                )
-                continue
-            except Exception as e:
-                print(f"Exception for {counter} - {signalsMetadata[counter]['name']}: {e}")
+        # The workers finish the uploads of their files when they exit, unless a task that timed out keeps them running
+        if not scheduler.timedOut:
+            pool.join()
 
-                signalsMetadata[counter]["signal_decoded_status"] = False
-                signalsMetadata[counter]["records_count"] = 0
-                signalsMetadata[counter]["message"] = f"Exception {e}"
+    except Exception as e:
+        print(f"Critical error {e}")
+    finally:
+        decoding.finish()
+        if pool is not None:
+            pool.terminate()
 
-                errorSignals.append(
-                    {
-                        "counter": counter,
-                        "name": signalsMetadata[counter]['name'],
-                        "value": f"Exception {e}"
-                    }               
-                ) 
-                continue
+def prepareFile(filename, basename, runId="random"):
+    '''
+        Calculates the run ID and the metadata of a MDF-4 file.
+
+        Args:
+            filename: the MDF-4 file to process
+            basename: the base name of the metadata file
+            runId: random for a new UUID, or content for a UUID derived from the file content (see calculateRunId)
+        Returns:
+            the UUID of the run and the metadata of the file
+    '''
+    # A content-addressed run ID is stable for the same file and decoder version, which is required to resume a previous run
+    if runId == "content":
+        file_uuid = calculateRunId(filename)
+    else:
+        file_uuid = uuid.uuid4()
+
+    return file_uuid, calculateMetadata(filename, basename, file_uuid)
+
+def processFiles(filenames, target, blacklistedSignals, method, log_result, log_error, log_completition, createReport, groupBatchSize=None, cacheSize=0, cacheMemoryMB=None, runId="random", resume=False, maxOpenFiles=2, signalFilter=None, outputSink=None, pipeline=None, fileFormat=None):
+    '''
+        Writes several MDF-4 files with a single pool of workers, which is kept for the whole run.
+
+        The metadata of each file is calculated by the pool and its signals are submitted once it is available, so the
+        metadata of a file is calculated while the signals of other files are decoded. At most maxOpenFiles files are in
+        progress at the same time, the next file starts when one of them is finished. Each file gets the same report and
+        metadata file as with processSignals.
+
+        Args:
+            filenames: the MDF-4 files to process
+            runId: random or content, see prepareFile
+            resume: skip the signals that a previous run of the same file already exported, requires the content run ID
+            maxOpenFiles: the maximum number of files in progress
+            See processSignals for the other arguments.
+    '''
+    pendingFiles = list(filenames)
+    openFiles = {} # The decoding of each file in progress, None while its metadata is calculated
+    filesMetadata = {}
+    startTimes = {}
+    pool = None
+
+    def startFiles():
+        while len(pendingFiles) > 0 and len(openFiles) < maxOpenFiles:
+            filename = pendingFiles.pop(0)
+            openFiles[filename] = None
+            startTimes[filename] = time.time()
+            scheduler.submit((filename, None), prepareFile, (filename, inputBasename(filename), runId), MIN_TIMEOUT, log_result, log_error)
+
+    def finishFile(filename):
+        decoding = openFiles.pop(filename)
+
+        if decoding is not None:
+            decoding.finish()
+
+            # Writes the calculated metadata
+            writeMetadata(filesMetadata.pop(filename), decoding.basename, decoding.uuid, target, outputSink)
+            print (f"Processing {filename} took {time.time() - startTimes[filename]} and has {decoding.numberOfSignals} signals")
+
+    try:
+        pool, workers = createPool(cacheSize, cacheMemoryMB, pipeline)
+        scheduler = TaskScheduler(pool, workers)
+
+        startFiles()
+
+        while scheduler.hasPending():
+            (owner, index), value, error = scheduler.next()
+
+            if isinstance(owner, SignalsDecoding):
+                owner.collect(index, value, error)
+
+                if owner.pendingTasks == 0:
+                    finishFile(owner.filename)
+
+            # The metadata of a file is ready, submit its signals
+            elif error is not None:
+                print(f"Error calculating metadata of {owner}: {error}")
+                finishFile(owner)
+
+            else:
+                basename = inputBasename(owner)
+                file_uuid, metadata = value
+                signalsMetadata = metadata["signals"]
+
+                # Signals exported by a previous run of the same file are skipped
+                completedSignals = findCompletedSignals(basename, file_uuid, target, signalsMetadata) if resume else None
+
+                decoding = SignalsDecoding(owner, basename, file_uuid, target, signalsMetadata, blacklistedSignals, method, len(signalsMetadata), log_completition, createReport, groupBatchSize, completedSignals, signalFilter, outputSink, fileFormat)
+                openFiles[owner] = decoding
+                filesMetadata[owner] = metadata
+
+                decoding.submit(scheduler, log_result, log_error)
+
+                if decoding.pendingTasks == 0:
+                    finishFile(owner)
+
+            startFiles()
+
+        # The workers finish the uploads of their files when they exit, unless a task that timed out keeps them running
+        pool.close()
+        if not scheduler.timedOut:
+            pool.join()
 
     except Exception as e:
         print(f"Critical error {e}")
     finally:
-        # We create a report that contains all signals.
-        print (f"Finished. Tasks total/finished/errors/timeout: {len(signalsMetadata)} / {len(finishedSignals)} / {len(errorSignals)} / {len(timeoutSignals)}")
-        print (f"Finished: {finishedSignals}")
-        print (f"Errors: {errorSignals}")
-        print (f"Timeout signals: {timeoutSignals}")
-        print(f'Total Cumulative Signal entries count: {vEntriesCount}')
-        createReport(basename, target, uuid, signalsMetadata, finishedSignals, errorSignals, timeoutSignals, vEntriesCount)
-        pool.terminate()
-
+        # Files in progress get the report and metadata of the signals that finished
+        for filename in list(openFiles):
+            finishFile(filename)
+        if pool is not None:
+            pool.terminate()
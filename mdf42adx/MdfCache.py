@@ -0,0 +1,101 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+from collections import OrderedDict
+import gc
+import os
+from RemoteInput import openMdf, isRemote
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Open MDF files of the current worker process, keyed by (path, mtime) and ordered from least to most recently used.
+# The cache is disabled (maxCachedFiles = 0) until the pool initializer configures it, so every task opens and closes the file.
+cachedFiles = OrderedDict()
+maxCachedFiles = 0
+maxMemoryBytes = None
+
+def initializeWorker(maxFiles, maxMemoryMB=None):
+    '''
+        Pool initializer that enables the MDF cache for a worker process.
+
+        Args:
+            maxFiles: the maximum number of MDF files kept open by the worker
+            maxMemoryMB: the worker memory (RSS) above which cached files are closed, None for no limit
+    '''
+    global maxCachedFiles, maxMemoryBytes
+
+    maxCachedFiles = maxFiles
+    maxMemoryBytes = maxMemoryMB * 2**20 if maxMemoryMB else None
+
+def getMdf(filename):
+    '''
+        Returns an open MDF object for filename, reusing the one parsed by a previous task of this worker if the file did not change.
+        Every call must be paired with releaseMdf once the task is done with the object.
+    '''
+    if maxCachedFiles <= 0:
+        return openMdf(filename)
+
+    # Remote files are not expected to change while they are decoded
+    if isRemote(filename):
+        path = filename
+        key = (path, None)
+    else:
+        path = os.path.abspath(filename)
+        key = (path, os.path.getmtime(path))
+
+    if key in cachedFiles:
+        cachedFiles.move_to_end(key)
+        return cachedFiles[key]
+
+    # A different version of the same file will not be used again
+    for staleKey in [cachedKey for cachedKey in cachedFiles if cachedKey[0] == path]:
+        closeCachedFile(staleKey)
+
+    mdf = openMdf(filename)
+    cachedFiles[key] = mdf
+
+    while len(cachedFiles) > maxCachedFiles:
+        closeCachedFile(next(iter(cachedFiles)))
+
+    return mdf
+
+def releaseMdf(mdf):
+    '''
+        Ends the use of an MDF object obtained with getMdf.
+        Without cache the file is closed, otherwise the least recently used files are closed while the worker is above its memory ceiling.
+    '''
+    if maxCachedFiles <= 0:
+        mdf.close()
+        return
+
+    if maxMemoryBytes is None:
+        return
+
+    while len(cachedFiles) > 0 and currentMemory() > maxMemoryBytes:
+        closeCachedFile(next(iter(cachedFiles)))
+        gc.collect()
+
+def closeCachedFile(key):
+    '''
+        Removes a file from the cache and closes it.
+    '''
+    mdf = cachedFiles.pop(key)
+    try:
+        mdf.close()
+    except Exception as e:
+        print(f"pid {os.getpid()}: Error closing cached file {key[0]}: {e}")
+
+def currentMemory():
+    '''
+        Returns the resident memory of the current process in bytes, or 0 if it cannot be determined.
+    '''
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
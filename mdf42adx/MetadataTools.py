@@ -1,10 +1,35 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
-from asammdf import MDF
 from datetime import datetime
+import hashlib
 import json
 import os
-from DecodeUtils import getSource
+import re
+import uuid as uuidlib
+from DecodeUtils import getSource, iterChannelBlocks, getChannelDatatype, getRecordsCount, getRecordSize
+from RemoteInput import openMdf, openInput
+
+# Version of the decoding logic. Change it when the exported data changes, so files are decoded again with a new run ID.
+# 2.1: the datatype of variable length channels in the metadata is bytes, without the size of the longest value
+DECODER_VERSION = "2.1"
+
+def calculateRunId(filename):
+    '''
+        Calculates a content-addressed run ID for a MDF-4 file: the same file decoded with the same decoder version
+        always gets the same ID, so the output of a previous run can be found and reused.
+
+        Args:
+            filename: the MDF-4 file to process, a local path or a URL
+        Returns:
+            a UUID derived from the SHA-256 of the file and the decoder version
+    '''
+    sha256 = hashlib.sha256()
+
+    with openInput(filename) as mdfFile:
+        for block in iter(lambda: mdfFile.read(2**20), b''):
+            sha256.update(block)
+
+    return uuidlib.uuid5(uuidlib.NAMESPACE_URL, f"mdf42adx:{sha256.hexdigest()}:{DECODER_VERSION}")
 
 def dumpSignals(filename):
     '''
@@ -13,11 +38,12 @@ def dumpSignals(filename):
         Args:
             filename: the MDF-4 file to process
     '''
-    mdf = MDF(filename)
+    mdf = openMdf(filename)
 
-    for counter, signal in enumerate(mdf.iter_channels(raw=True)):        
-        source_name, source_type, bus_type, channel_group_acq_name, acq_source_name, acq_source_path = getSource(mdf, signal)
-        print(f"Gr_I: {signal.group_index}, CH_I: {signal.channel_index}, {signal.name}, unit: {signal.unit}, dt: {signal.samples.dtype}, src: {source_name}, gr_name: {channel_group_acq_name}, {acq_source_name}, path: {acq_source_path}, type: {source_type}, bus: {bus_type}")
+    counter = 0
+    for counter, (group_index, channel_index, channel) in enumerate(iterChannelBlocks(mdf), start=1):        
+        source_name, source_type, bus_type, channel_group_acq_name, acq_source_name, acq_source_path, *_ = getSource(mdf, group_index, channel.source)
+        print(f"Gr_I: {group_index}, CH_I: {channel_index}, {channel.name}, unit: {channel.unit}, dt: {getChannelDatatype(channel)}, samples: {getRecordsCount(mdf, group_index)}, src: {source_name}, gr_name: {channel_group_acq_name}, {acq_source_name}, path: {acq_source_path}, type: {source_type}, bus: {bus_type}")
 
     mdf.close()
     del mdf
@@ -38,7 +64,7 @@ def calculateMetadata(filename, basename, uuid):
             the number of signals in the file
     '''
 
-    mdf = MDF(filename)
+    mdf = openMdf(filename)
 
     print(f"Generating metadata file {basename}-{uuid}")
 
@@ -52,32 +78,37 @@ def calculateMetadata(filename, basename, uuid):
         "group_comment": [],
         "comments": mdf.header.comment,
         "mdf_start_time": str(mdf.start_time),
+        "decoder_version": DECODER_VERSION,
     }
     
-    for signal in mdf.iter_channels(raw=True):
+    # The metadata is built from the channel, channel group, source and conversion blocks, no samples are read
+    for group_index, channel_index, channel in iterChannelBlocks(mdf):
 
-        source_name, source_type, bus_type, channel_group_acq_name, acq_source_name, acq_source_path, channel_group_acq_source_comment, channel_group_comment, signal_source_path = getSource(mdf, signal)
+        source_name, source_type, bus_type, channel_group_acq_name, acq_source_name, acq_source_path, channel_group_acq_source_comment, channel_group_comment, signal_source_path = getSource(mdf, group_index, channel.source)
 
         metadata["signals"].append(
             {
-                "name": signal.name,
-                "unit": signal.unit,
-                "group_index": signal.group_index,
-                "channel_index": signal.channel_index,
+                "name": channel.name,
+                # As in asammdf, the unit of the conversion replaces the unit of the channel
+                "unit": channel.conversion and channel.conversion.unit or channel.unit,
+                "group_index": group_index,
+                "channel_index": channel_index,
                 "channel_group_acq_name": channel_group_acq_name,
                 "acq_source_name": acq_source_name,
                 "acq_source_path": acq_source_path,
                 "source" : source_name,
                 "source_type": source_type,
                 "bus_type": bus_type,
-                "datatype": signal.samples.dtype.name,
+                "datatype": getChannelDatatype(channel),
                 "signal_source_path": signal_source_path,
+                "samples_count": getRecordsCount(mdf, group_index),
+                "record_size": getRecordSize(mdf, group_index),
             }          
         )
 
-        metadata["signals_comment"].append(signal.comment)
+        metadata["signals_comment"].append(channel.comment)
 
-        metadata["signals_decoding"].append(str(signal.conversion))
+        metadata["signals_decoding"].append(str(channel.conversion))
 
         metadata["group_comment"].append(
             {
@@ -94,12 +125,74 @@ def calculateMetadata(filename, basename, uuid):
 
     return metadata
 
-def writeMetadata(metadata, basename, uuid, target):
+def writeMetadata(metadata, basename, uuid, target, outputSink=None):
     '''
        Writes the metadata file to disk. 
+       If the signals have a time range (absolute timestamps), the file gets the time range of all of its signals.
+       With an outputSink (see OutputSink.openOutputSink), the file is then handed to it for upload.
     '''
+    timedSignals = [signal for signal in metadata["signals"] if "min_time" in signal]
+
+    # ISO 8601 strings with the same format sort as the times they represent
+    if timedSignals:
+        metadata["min_time"] = min(signal["min_time"] for signal in timedSignals)
+        metadata["max_time"] = max(signal["max_time"] for signal in timedSignals)
+
     print(f"Writing metadata file {basename}-{uuid} with {len(metadata['signals'])} signals")
 
     with open(os.path.join(target, f"{basename}-{uuid}.metadata.json"), 'w') as metadataFile:
         metadataFile.write(json.dumps(metadata))
-        print(f"Finished writing metadata file {basename}-{uuid} with {len(metadata['signals'])} signals")
\ No newline at end of file
+        print(f"Finished writing metadata file {basename}-{uuid} with {len(metadata['signals'])} signals")
+
+    if outputSink is not None:
+        outputSink.commit(os.path.join(target, f"{basename}-{uuid}.metadata.json"))
+
+def writeManifest(manifest, basename, uuid, target, outputSink=None):
+    '''
+       Writes the manifest of the coalesced parquet files to disk.
+       Each entry maps a signal to its file and the first and last row group that contain it.
+       With an outputSink, the file is then handed to it for upload.
+    '''
+    print(f"Writing manifest file {basename}-{uuid} with {len(manifest)} signals")
+
+    with open(os.path.join(target, f"{basename}-{uuid}.manifest.json"), 'w') as manifestFile:
+        manifestFile.write(json.dumps(manifest))
+
+    if outputSink is not None:
+        outputSink.commit(os.path.join(target, f"{basename}-{uuid}.manifest.json"))
+
+def writeExternalTables(manifest, basename, uuid, target, outputSink=None):
+    '''
+       Writes the KQL commands that create an external table for the wide parquet files of each channel group.
+       Each table has the timestamp column and the columns of all signals of the channel group, and its location is the
+       folder of the channel group, which has to be completed with the storage account, container and path.
+       With an outputSink, the file is then handed to it for upload.
+    '''
+    tables = {}
+    for entry in manifest:
+        if "column" in entry:
+            folder = os.path.dirname(entry["file"])
+            columns = tables.setdefault(folder, {"timestamp": entry["timestamp_type"]})
+            columns[entry["column"]] = entry["type"]
+
+    escapedName = re.sub(r"[^a-zA-Z0-9_]", "_", basename)
+    commands = []
+
+    for folder, columns in sorted(tables.items()):
+        schema = ",".join(f"['{column}']:{kustoType}" for column, kustoType in columns.items())
+        commands.append(
+            f".create-or-alter external table ['{escapedName}_{folder.replace('-', '_')}'] ({schema})\n"
+            f"kind=storage\n"
+            f"dataformat=parquet\n"
+            f"(\n"
+            f"    h@\"https://<storage>/<container>/<path>/{basename}-{uuid}/{folder};impersonate\"\n"
+            f")\n"
+        )
+
+    print(f"Writing external tables file {basename}-{uuid} with {len(tables)} tables")
+
+    with open(os.path.join(target, f"{basename}-{uuid}.external_tables.kql"), 'w') as kqlFile:
+        kqlFile.write("\n".join(commands))
+
+    if outputSink is not None:
+        outputSink.commit(os.path.join(target, f"{basename}-{uuid}.external_tables.kql"))
@@ -0,0 +1,169 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+from datetime import datetime
+import json
+import os
+import shutil
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+class MetricsSampler:
+    '''
+        Samples the CPU, memory and disk of the machine and the memory of the decoding workers in a background thread,
+        so the thread that collects the results of the workers never waits for a measurement.
+
+        The samples and the progress events form a time series that is written next to the report (see write), to find
+        out afterwards whether a run was bound by CPU, memory or disk.
+
+        Can be used as a context manager, which starts and stops the sampling.
+    '''
+
+    def __init__(self, interval=5.0, path="/"):
+        '''
+            Args:
+                interval: the seconds between two samples
+                path: a path on the disk whose free space is sampled, usually the output directory
+        '''
+        self.interval = interval
+        self.path = path
+        self.start_time = time.time()
+        self.samples = []
+        self.events = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.previousDiskCounters = None
+        self.previousTime = None
+
+        # The first call of cpu_percent starts the measurement, the next ones return the usage since the previous call
+        if psutil is not None:
+            psutil.cpu_percent(interval=None)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name="MetricsSampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            self.sample()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                # A failed measurement never stops the decoding
+                print(f"Metrics sampling failed: {e}")
+
+    def sample(self):
+        '''
+            Takes a sample and adds it to the series. The CPU usage is the average since the previous sample.
+
+            Returns:
+                the sample
+        '''
+        now = time.time()
+        sample = {"elapsed": now - self.start_time}
+
+        total, used, free = shutil.disk_usage(self.path)
+        sample["disk_used_gb"] = used / 2**30
+        sample["disk_free_gb"] = free / 2**30
+
+        if psutil is not None:
+            memory = psutil.virtual_memory()
+            sample["cpu_percent"] = psutil.cpu_percent(interval=None)
+            sample["memory_percent"] = memory.percent
+            sample["memory_available_mb"] = memory.available / 2**20
+
+            # Disk throughput since the previous sample
+            diskCounters = psutil.disk_io_counters()
+            if diskCounters is not None and self.previousDiskCounters is not None and now > self.previousTime:
+                sample["disk_read_mb_s"] = (diskCounters.read_bytes - self.previousDiskCounters.read_bytes) / 2**20 / (now - self.previousTime)
+                sample["disk_write_mb_s"] = (diskCounters.write_bytes - self.previousDiskCounters.write_bytes) / 2**20 / (now - self.previousTime)
+            self.previousDiskCounters = diskCounters
+            self.previousTime = now
+
+            sample["workers_rss_mb"] = workersMemoryMB()
+
+        with self.lock:
+            self.samples.append(sample)
+
+        return sample
+
+    def latest(self):
+        '''
+            Returns the last sample without measuring again, None before the first one.
+        '''
+        with self.lock:
+            return self.samples[-1] if self.samples else None
+
+    def progress(self, percent):
+        '''
+            Adds a progress event to the series and logs it with the last sample, without waiting for a measurement.
+        '''
+        event = {"elapsed": time.time() - self.start_time, "progress": percent}
+
+        with self.lock:
+            self.events.append(event)
+
+        print(f"DECODING PROGRESS {percent}%... {formatSample(self.latest())}")
+
+    def write(self, filename):
+        '''
+            Writes the samples and progress events to a JSON file.
+        '''
+        with self.lock:
+            series = {
+                "start": datetime.utcfromtimestamp(self.start_time).isoformat() + "Z",
+                "interval": self.interval,
+                "samples": list(self.samples),
+                "events": list(self.events),
+            }
+
+        with open(filename, "w") as metricsFile:
+            metricsFile.write(json.dumps(series))
+
+def workersMemoryMB():
+    '''
+        Returns the resident memory in MB of each child process (the pool workers) of the current process, by pid.
+    '''
+    workers = {}
+
+    for child in psutil.Process().children(recursive=True):
+        try:
+            workers[str(child.pid)] = child.memory_info().rss / 2**20
+        except psutil.Error:
+            # The worker finished between listing and measuring it
+            continue
+
+    return workers
+
+def formatSample(sample):
+    '''
+        Returns a one line summary of a sample for the logs.
+    '''
+    if sample is None:
+        return "No metrics sampled yet"
+
+    summary = f"Disk Space: Used: {sample['disk_used_gb']:.2f} GB, Free: {sample['disk_free_gb']:.2f} GB"
+
+    if "cpu_percent" in sample:
+        summary = f"CPU Usage: {sample['cpu_percent']:.2f}%, Memory Usage: {sample['memory_percent']:.2f}%, Workers: {len(sample['workers_rss_mb'])} using {sum(sample['workers_rss_mb'].values()):.0f} MB, {summary}"
+
+    return summary
@@ -0,0 +1,486 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+import json
+import os
+import re
+import time
+import uuid as uuidlib
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Output formats by the name used with --format, see registerFormat
+FORMATS = {}
+
+def registerFormat(formatClass):
+    '''
+        Registers an output format under its name. A format is a class with the options of the format as constructor
+        arguments, which opens a FormatWriter for each output file (see OutputFormat).
+    '''
+    FORMATS[formatClass.name] = formatClass
+    return formatClass
+
+def createFormat(name, **options):
+    '''
+        Returns the output format registered under name with the given options, None if there is no such format.
+        Options that are None use the default of the format, the options the format does not have are ignored.
+    '''
+    if name not in FORMATS:
+        return None
+
+    formatClass = FORMATS[name]
+    unused = [key for key, value in options.items() if value is not None and key not in formatClass.options]
+    if len(unused) > 0:
+        print(f"The {', '.join(unused)} options are not used by the {name} format")
+
+    return formatClass(**{key: value for key, value in options.items() if value is not None and key in formatClass.options})
+
+class OutputFormat:
+    '''
+        A format of the files of the signals, written from the arrow tables of the signals (see DecodeParquet.buildSignalTable).
+
+        The tables of a file are written with open, then write for each table (a row group or record batch) and close.
+        Formats that keep a log of their files (Delta Lake) record the files written for a MDF-4 file with commit, which
+        runs in the main process once its signals are processed.
+    '''
+
+    name = None
+    extension = None
+    # Formats written from the arrow tables of the signals, the others have their own methods (see DecodeCSV)
+    columnar = True
+    defaultCompression = None
+    # Constructor arguments, see createFormat
+    options = ("compression", "compressionLevel", "dictionary", "rowGroupSize")
+
+    def __init__(self, compression=None, compressionLevel=None, dictionary=True, rowGroupSize=None):
+        '''
+            Args:
+                compression: the compression codec, the default of the format if None
+                compressionLevel: the level of the codec (zstd, gzip, brotli, lz4), None for the default of the codec
+                dictionary: True or False for all columns, or the list of the columns that are dictionary encoded where
+                            the format supports it
+                rowGroupSize: the maximum number of rows of a row group (parquet) or record batch (arrow), None for the
+                              default of the format
+        '''
+        self.compression = compression if compression is not None else self.defaultCompression
+        self.compressionLevel = compressionLevel
+        self.dictionary = dictionary
+        self.rowGroupSize = rowGroupSize
+
+        # Invalid options are reported before any signal is decoded
+        if self.compression is not None and self.compression != "none" and not pa.Codec.is_available(self.compression):
+            raise ValueError(f"Compression {self.compression} is not available")
+        if compressionLevel is not None and (self.compression in (None, "none") or not pa.Codec.supports_compression_level(self.compression)):
+            raise ValueError(f"Compression {self.compression} has no compression level")
+
+    def codec(self):
+        '''
+            Returns the compression of the files, None for uncompressed files.
+        '''
+        return self.compression if self.compression != "none" else None
+
+    def fileName(self, prefix):
+        return f"{prefix}.{self.extension}"
+
+    def open(self, path, schema):
+        raise NotImplementedError
+
+    def commit(self, target, basename, uuid, results):
+        '''
+            Records the files written for a MDF-4 file, given the results of its signals. Does nothing by default.
+        '''
+        pass
+
+class FormatWriter:
+    '''
+        Writes the tables of a signal to a file, with the schema of the first table.
+    '''
+
+    def __init__(self, schema):
+        self.schema = schema
+
+    def write(self, table):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+# Parquet encodings that can be set per column, with the arrow types they support
+ENCODINGS = {
+    "PLAIN": lambda arrowType: True,
+    "BYTE_STREAM_SPLIT": pa.types.is_floating,
+    "DELTA_BINARY_PACKED": lambda arrowType: pa.types.is_integer(arrowType) or pa.types.is_timestamp(arrowType),
+    "DELTA_LENGTH_BYTE_ARRAY": lambda arrowType: pa.types.is_string(arrowType) or pa.types.is_binary(arrowType),
+}
+
+# Encoding profiles of the parquet files by name, see loadProfile
+PROFILES = {
+    # The encoding of the previous versions: snappy with dictionaries and statistics for all columns
+    "default": {},
+    # The bytes of the doubles are split in streams, which compress better with ZSTD, and the integer timestamps (with
+    # --absolute-timestamps) are delta encoded. The columns that identify the signal and value_string keep their dictionary
+    "compact": {
+        "compression": "zstd",
+        "compressionLevel": 3,
+        "columnEncoding": {
+            "timestamp": ["DELTA_BINARY_PACKED", "BYTE_STREAM_SPLIT"],
+            "value": ["BYTE_STREAM_SPLIT"],
+            "valueRaw": ["BYTE_STREAM_SPLIT"],
+        },
+    },
+    # As compact with a higher ZSTD level, for files that are written once and kept
+    "archive": {
+        "compression": "zstd",
+        "compressionLevel": 9,
+        "columnEncoding": {
+            "timestamp": ["DELTA_BINARY_PACKED", "BYTE_STREAM_SPLIT"],
+            "value": ["BYTE_STREAM_SPLIT"],
+            "valueRaw": ["BYTE_STREAM_SPLIT"],
+        },
+    },
+}
+
+@registerFormat
+class ParquetFormat(OutputFormat):
+    '''
+        Parquet files, the format of the ADX external tables. Besides the codec, dictionaries and row groups, the encoding
+        of each column, the size of the pages, the statistics and the page index are set with an encoding profile
+        (see PROFILES and loadProfile).
+    '''
+
+    name = "parquet"
+    extension = "parquet"
+    defaultCompression = "snappy"
+    options = OutputFormat.options + ("columnEncoding", "dictionaryPageSize", "dataPageSize", "statistics", "pageIndex")
+
+    def __init__(self, columnEncoding=None, dictionaryPageSize=None, dataPageSize=None, statistics=True, pageIndex=False, **options):
+        '''
+            Args:
+                columnEncoding: the encodings of the columns by column name, each a list of encodings (see ENCODINGS) of
+                                which the first one that supports the type of the column is used. The columns of a signal
+                                have different types, for example timestamp is an integer with absolute timestamps.
+                                Encoded columns are not dictionary encoded
+                dictionaryPageSize: the size in bytes of the dictionary of a column chunk above which the rest of the
+                                    chunk is written without dictionary, None for the pyarrow default (1 MB)
+                dataPageSize: the size in bytes of the data pages, None for the pyarrow default (1 MB)
+                statistics: True or False for all columns, or the list of the columns with statistics
+                pageIndex: if set, the column and offset indexes of the pages are written, which needs pyarrow 13 or later
+                See OutputFormat for the other options.
+        '''
+        super().__init__(**options)
+        self.columnEncoding = {column: [encodings] if isinstance(encodings, str) else list(encodings) for column, encodings in (columnEncoding or {}).items()}
+        self.dictionaryPageSize = dictionaryPageSize
+        self.dataPageSize = dataPageSize
+        self.statistics = statistics
+        self.pageIndex = pageIndex
+
+        for column, encodings in self.columnEncoding.items():
+            for encoding in encodings:
+                if encoding not in ENCODINGS:
+                    raise ValueError(f"Unknown encoding {encoding} of column {column}, use one of {', '.join(ENCODINGS)}")
+        if pageIndex and int(pa.__version__.split(".")[0]) < 13:
+            raise ValueError(f"Writing the page index needs pyarrow 13 or later, pyarrow {pa.__version__} is installed")
+
+    def open(self, path, schema):
+        return ParquetFileWriter(path, schema, self)
+
+    def columnEncodings(self, schema):
+        '''
+            Returns the encoding of each column of the schema that has an encoding supporting its type.
+        '''
+        encodings = {}
+        for field in schema:
+            arrowType = field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+            for encoding in self.columnEncoding.get(field.name, []):
+                if ENCODINGS[encoding](arrowType):
+                    encodings[field.name] = encoding
+                    break
+
+        return encodings
+
+    def writerOptions(self, schema):
+        '''
+            Returns the arguments of the pyarrow ParquetWriter of a file with the schema.
+        '''
+        encodings = self.columnEncodings(schema)
+
+        dictionary = self.dictionary
+        if len(encodings) > 0:
+            # pyarrow does not combine a dictionary with another encoding
+            columns = schema.names if dictionary is True else (dictionary or [])
+            dictionary = [column for column in columns if column not in encodings]
+
+        options = dict(
+            compression=self.codec(),
+            compression_level=self.compressionLevel,
+            use_dictionary=dictionary,
+            column_encoding=encodings or None,
+            write_statistics=self.statistics,
+            dictionary_pagesize_limit=self.dictionaryPageSize,
+            data_page_size=self.dataPageSize,
+            # Absolute timestamps have nanosecond resolution, which needs format version 2.6
+            version="2.6")
+
+        if self.pageIndex:
+            options["write_page_index"] = True
+
+        return options
+
+class ParquetFileWriter(FormatWriter):
+
+    def __init__(self, path, schema, fileFormat):
+        super().__init__(schema)
+        self.rowGroupSize = fileFormat.rowGroupSize
+        self.writer = pq.ParquetWriter(path, schema, **fileFormat.writerOptions(schema))
+
+    def write(self, table):
+        # Without a row group size, pyarrow writes row groups of up to 1M rows
+        self.writer.write_table(table, row_group_size=self.rowGroupSize)
+
+    def close(self):
+        self.writer.close()
+
+@registerFormat
+class ArrowFormat(OutputFormat):
+    '''
+        Arrow IPC files (Feather V2), which are read without conversion by pyarrow, pandas or polars and can be memory mapped.
+        The record batches are compressed with LZ4 by default, or ZSTD.
+    '''
+
+    name = "arrow"
+    extension = "arrow"
+    defaultCompression = "lz4"
+
+    def open(self, path, schema):
+        return ArrowFileWriter(path, schema, self)
+
+class ArrowFileWriter(FormatWriter):
+
+    def __init__(self, path, schema, fileFormat):
+        self.rowGroupSize = fileFormat.rowGroupSize
+        super().__init__(decodedSchema(schema, schema.names if fileFormat.dictionary is True else (fileFormat.dictionary or [])))
+        self.decoded = self.schema != schema
+        codec = fileFormat.codec()
+        if codec is not None and fileFormat.compressionLevel is not None:
+            codec = pa.Codec(codec, compression_level=fileFormat.compressionLevel)
+        self.writer = pa.ipc.new_file(path, self.schema, options=pa.ipc.IpcWriteOptions(compression=codec))
+
+    def write(self, table):
+        if self.decoded:
+            table = table.cast(self.schema)
+        self.writer.write_table(table, max_chunksize=self.rowGroupSize)
+
+    def close(self):
+        self.writer.close()
+
+def decodedSchema(schema, dictionaryColumns=()):
+    '''
+        Returns the schema with the dictionary encoded columns replaced by their values, except dictionaryColumns.
+    '''
+    return pa.schema([pa.field(field.name, field.type.value_type) if pa.types.is_dictionary(field.type) and field.name not in dictionaryColumns else field for field in schema])
+
+@registerFormat
+class DeltaFormat(ParquetFormat):
+    '''
+        A Delta Lake table in the target directory: the parquet files of each MDF-4 file are appended to the table with a
+        single commit to its transaction log (_delta_log), so readers such as a Fabric lakehouse see all files of a MDF-4
+        file at once and find them in the log instead of listing the directory.
+
+        All files of a table share the same schema: value and valueRaw are stored as double (raw values that are not
+        numeric are left empty, their text is in value_string) and absolute timestamps have microsecond resolution.
+    '''
+
+    name = "delta"
+
+    # Types of the columns of the table, the other columns keep the type of the signal tables
+    COLUMN_TYPES = {
+        "group_index": pa.int32(),
+        "channel_index": pa.int32(),
+        "timestamp": pa.float64(),
+        "value": pa.float64(),
+        "value_string": pa.string(),
+        "valueRaw": pa.float64(),
+        "value_long": pa.int64(),
+        "value_decimal": pa.decimal128(20, 0),
+    }
+
+    def open(self, path, schema):
+        return DeltaFileWriter(path, self.tableSchema(schema), self)
+
+    def tableSchema(self, schema):
+        fields = []
+        for field in schema:
+            if field.name == "timestamp" and pa.types.is_timestamp(field.type):
+                fields.append(pa.field("timestamp", pa.timestamp("us", tz="UTC")))
+            else:
+                fields.append(pa.field(field.name, self.COLUMN_TYPES.get(field.name, field.type)))
+
+        return pa.schema(fields)
+
+    def commit(self, target, basename, uuid, results):
+        '''
+            Appends the files of the successful signals of a MDF-4 file to the table with a new commit.
+            Commits are created exclusively, so several runs can append to the same table.
+        '''
+        files = [f"{basename}-{uuid}/{value[5]['output']}" for value in results if value[1] == True and len(value) > 5 and "output" in value[5]]
+
+        if len(files) == 0:
+            return
+
+        logDir = os.path.join(target, "_delta_log")
+        os.makedirs(logDir, exist_ok=True)
+
+        now = int(time.time() * 1000)
+        schemaString = deltaSchemaString(pq.read_schema(os.path.join(target, files[0])))
+        adds = [{"add": {
+            "path": path,
+            "partitionValues": {},
+            "size": os.path.getsize(os.path.join(target, path)),
+            "modificationTime": now,
+            "dataChange": True,
+            "stats": json.dumps({"numRecords": pq.read_metadata(os.path.join(target, path)).num_rows}),
+        }} for path in files]
+        commitInfo = {"commitInfo": {"timestamp": now, "operation": "WRITE", "operationParameters": {"mode": "Append"}, "engineInfo": "mdf42adx"}}
+
+        while True:
+            versions = [int(name[:-5]) for name in os.listdir(logDir) if re.fullmatch(r"\d{20}\.json", name)]
+            version = max(versions) + 1 if versions else 0
+
+            if version == 0:
+                actions = [
+                    {"protocol": {"minReaderVersion": 1, "minWriterVersion": 2}},
+                    {"metaData": {"id": str(uuidlib.uuid4()), "format": {"provider": "parquet", "options": {}}, "schemaString": schemaString, "partitionColumns": [], "configuration": {}, "createdTime": now}},
+                ]
+            else:
+                # The table keeps the schema of its first commit, the files of a run with other options are not added
+                tableSchema = readTableSchema(logDir)
+                if tableSchema != schemaString:
+                    print(f"Delta table {target} has a different schema, the files of {basename}-{uuid} are not added. Use another target directory for --long-values or --absolute-timestamps runs.")
+                    return
+                actions = []
+
+            commitFile = os.path.join(logDir, f"{version:020d}.json")
+            temporaryFile = os.path.join(logDir, f".{version:020d}.json.{os.getpid()}.tmp")
+
+            with open(temporaryFile, "w") as logFile:
+                logFile.write("\n".join(json.dumps(action) for action in [commitInfo] + actions + adds) + "\n")
+
+            # The link fails if another run created the same version, which then retries with the next version
+            try:
+                os.link(temporaryFile, commitFile)
+                break
+            except FileExistsError:
+                continue
+            finally:
+                os.remove(temporaryFile)
+
+        print(f"Added {len(files)} files of {basename}-{uuid} to the Delta table {target} in version {version}")
+
+class DeltaFileWriter(ParquetFileWriter):
+    '''
+        Writes the parquet files of a Delta table, casting the tables of the signals to the schema of the table.
+    '''
+
+    def write(self, table):
+        columns = []
+        for field in self.schema:
+            column = table.column(field.name)
+            if field.name == "valueRaw" and not (pa.types.is_integer(column.type) or pa.types.is_floating(column.type) or pa.types.is_boolean(column.type)):
+                column = pa.nulls(table.num_rows, pa.float64())
+            # 64 bit integers above 2^53 lose precision as double, their exact value is kept in value_string
+            columns.append(column.cast(field.type, safe=False))
+
+        super().write(pa.Table.from_arrays(columns, schema=self.schema))
+
+def deltaSchemaString(schema):
+    '''
+        Returns the schema of a Delta table with the columns of an arrow schema, as stored in its transaction log.
+    '''
+    def deltaType(arrowType):
+        if pa.types.is_dictionary(arrowType):
+            return deltaType(arrowType.value_type)
+        if pa.types.is_decimal(arrowType):
+            return f"decimal({arrowType.precision},{arrowType.scale})"
+        if pa.types.is_timestamp(arrowType):
+            return "timestamp"
+        return {
+            pa.int8(): "byte", pa.int16(): "short", pa.int32(): "integer", pa.int64(): "long",
+            pa.float32(): "float", pa.float64(): "double", pa.bool_(): "boolean",
+            pa.string(): "string", pa.large_string(): "string", pa.binary(): "binary",
+        }[arrowType]
+
+    return json.dumps({
+        "type": "struct",
+        "fields": [{"name": field.name, "type": deltaType(field.type), "nullable": True, "metadata": {}} for field in schema],
+    })
+
+def readTableSchema(logDir):
+    '''
+        Returns the schema string of the first commit of a Delta table.
+    '''
+    with open(os.path.join(logDir, f"{0:020d}.json")) as logFile:
+        for line in logFile:
+            action = json.loads(line)
+            if "metaData" in action:
+                return action["metaData"]["schemaString"]
+
+    return None
+
+@registerFormat
+class CsvFormat(OutputFormat):
+    '''
+        Gzip compressed CSV files, written by the methods of DecodeCSV with their own options.
+    '''
+
+    name = "csv"
+    extension = "csv.gz"
+    columnar = False
+    options = ()
+
+def loadProfile(profile):
+    '''
+        Returns the options of an encoding profile: the name of a profile of PROFILES, or a JSON file with the options of
+        ParquetFormat, for example {"compression": "zstd", "compressionLevel": 3, "columnEncoding": {"value": ["BYTE_STREAM_SPLIT"]}}.
+    '''
+    if profile in PROFILES:
+        return json.loads(json.dumps(PROFILES[profile]))
+
+    with open(profile) as profileFile:
+        options = json.load(profileFile)
+
+    unknown = [key for key in options if key not in ParquetFormat.options]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown options {', '.join(unknown)} in the encoding profile {profile}, use {', '.join(ParquetFormat.options)}")
+
+    return options
+
+def readEncodingOptions(profile=None, compression=None, compressionLevel=None, dictionary=None, rowGroupSize=None, columnEncodings=None, dictionaryPageSize=None, dataPageSize=None, statistics=None, pageIndex=None):
+    '''
+        Creates the options of the output format from an encoding profile and the command line options, which replace
+        the options of the profile.
+
+        Args:
+            profile: the name or file of the encoding profile (see loadProfile), None for the defaults of the format
+            columnEncodings: a list of column=encoding[,encoding...], replacing the encodings of the profile for these columns
+            statistics: all, none or a comma separated list of columns
+            See ParquetFormat for the other options.
+        Returns:
+            the options for createFormat
+    '''
+    options = loadProfile(profile) if profile is not None else {}
+
+    if columnEncodings:
+        options["columnEncoding"] = dict(options.get("columnEncoding", {}))
+        for rule in columnEncodings:
+            column, separator, encodings = rule.partition("=")
+            if separator == "" or column == "" or encodings == "":
+                raise ValueError(f"Invalid column encoding {rule}, use column=encoding")
+            options["columnEncoding"][column] = [encoding.strip().upper() for encoding in encodings.split(",")]
+
+    if statistics is not None:
+        options["statistics"] = True if statistics == "all" else False if statistics == "none" else [column.strip() for column in statistics.split(",")]
+
+    for key, value in (("compression", compression), ("compressionLevel", compressionLevel), ("dictionary", dictionary), ("rowGroupSize", rowGroupSize), ("dictionaryPageSize", dictionaryPageSize), ("dataPageSize", dataPageSize), ("pageIndex", pageIndex)):
+        if value is not None:
+            options[key] = value
+
+    return options
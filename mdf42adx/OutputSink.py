@@ -0,0 +1,275 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+import base64
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
+from multiprocessing import util
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+# fsspec uploads to other object stores (az://, abfs://, s3://...), if it is not installed only http(s) and file URLs can be used
+try:
+    import fsspec
+except ImportError:
+    fsspec = None
+
+# Sink of the task running in the current worker process, None when the files stay in the target directory
+currentSink = None
+
+# Upload sinks of the current process by key, so all tasks of a worker share its queue (see workerSink)
+processSinks = {}
+
+class FileSystemSink:
+    '''
+        Keeps the output files in the target directory, where they are written.
+    '''
+
+    def commit(self, localPath):
+        pass
+
+    def flush(self):
+        return []
+
+    def close(self):
+        return []
+
+class UploadSink:
+    '''
+        Uploads the output files to an object store once they are written, and deletes them from the local staging
+        directory (the target directory) when the upload is confirmed.
+
+        The uploads run in a background queue with at most concurrency uploads at a time, so they overlap with the
+        decoding. When the files waiting for upload reach maxStagedMB, commit waits for uploads to finish, which bounds the
+        disk used by the staging directory. Failed uploads are retried with exponential backoff, and the file is kept
+        locally if they still fail.
+
+        Each process (the main process and each worker) has its own queue. The uploads of a worker continue while it
+        decodes its next tasks and are waited for once, when the worker exits (see workerSink), so a signal is reported
+        as processed once its file is written.
+    '''
+
+    def __init__(self, stagingDir, store, concurrency=4, maxStagedMB=1024, retries=3, key=None):
+        self.stagingDir = stagingDir
+        self.store = store
+        self.concurrency = concurrency
+        self.maxStagedMB = maxStagedMB
+        self.retries = retries
+        self.key = key or uuid.uuid4().hex
+        self.executor = None
+        self.uploads = []
+        self.stagedBytes = 0
+        self.condition = threading.Condition()
+
+    def __reduce__(self):
+        # The tasks sent to a worker get the queue of the worker, not a queue of their own
+        return (workerSink, (self.key, self.stagingDir, self.store, self.concurrency, self.maxStagedMB, self.retries))
+
+    def commit(self, localPath):
+        '''
+            Queues the upload of a finished file, waiting while the staged files are above maxStagedMB.
+        '''
+        size = os.path.getsize(localPath)
+        key = os.path.relpath(localPath, self.stagingDir).replace(os.sep, "/")
+
+        with self.condition:
+            # A single file above the limit is uploaded once the others are done
+            while self.stagedBytes > 0 and self.stagedBytes + size > self.maxStagedMB * 2**20:
+                self.condition.wait()
+            self.stagedBytes += size
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="UploadSink")
+
+        # Finished uploads are only kept if they failed, to be reported when the sink is flushed
+        self.uploads = [(path, future) for path, future in self.uploads if not future.done() or future.exception() is not None]
+        self.uploads.append((localPath, self.executor.submit(self.upload, localPath, key, size)))
+
+    def upload(self, localPath, key, size):
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.store.put(localPath, key)
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        raise
+                    print(f"pid {os.getpid()}: Upload of {key} failed, retrying: {e}")
+                    time.sleep(2 ** attempt)
+
+            os.remove(localPath)
+
+        finally:
+            with self.condition:
+                self.stagedBytes -= size
+                self.condition.notify_all()
+
+    def flush(self):
+        '''
+            Waits for the queued uploads.
+
+            Returns:
+                a list of (file, error) for each file that could not be uploaded
+        '''
+        wait([future for _, future in self.uploads])
+
+        failures = [(localPath, future.exception()) for localPath, future in self.uploads if future.exception() is not None]
+        self.uploads = []
+
+        return failures
+
+    def close(self):
+        failures = self.flush()
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+        for localPath, error in failures:
+            print(f"Upload of {localPath} failed, the file is kept locally: {error}")
+
+        return failures
+
+class LocalDirectoryStore:
+    '''
+        Stores the files in a local directory, as an object store emulator to test the uploads without a storage account.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, localPath, key):
+        destination = os.path.join(self.directory, *key.split("/"))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        # Readers never see a partial file, as with an object store
+        shutil.copyfile(localPath, destination + ".uploading")
+        os.replace(destination + ".uploading", destination)
+
+class HttpBlobStore:
+    '''
+        Uploads the files to an Azure Blob Storage container (or Azurite) with the REST API, using a container URL with
+        a SAS token, e.g. https://<storage>.blob.core.windows.net/<container>/<path>?<sas>.
+        Files up to BLOCK_SIZE are uploaded with a single request, larger files in blocks.
+    '''
+
+    BLOCK_SIZE = 64 * 2**20
+    API_VERSION = "2021-08-06"
+
+    def __init__(self, containerUrl, timeout=300):
+        url = urllib.parse.urlparse(containerUrl)
+        self.base = urllib.parse.urlunparse(url._replace(path=url.path.rstrip("/"), query=""))
+        self.query = url.query
+        self.timeout = timeout
+
+    def url(self, key, parameters=""):
+        query = "&".join(part for part in (parameters, self.query) if part)
+        return f"{self.base}/{urllib.parse.quote(key)}?{query}"
+
+    def request(self, url, data, headers):
+        headers = dict(headers, **{"x-ms-version": self.API_VERSION, "Content-Length": str(len(data))})
+
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers, method="PUT"), timeout=self.timeout) as response:
+            return response.status
+
+    def put(self, localPath, key):
+        size = os.path.getsize(localPath)
+
+        with open(localPath, "rb") as localFile:
+            if size <= self.BLOCK_SIZE:
+                self.request(self.url(key), localFile.read(), {"x-ms-blob-type": "BlockBlob"})
+                return
+
+            blockIds = []
+            for block in iter(lambda: localFile.read(self.BLOCK_SIZE), b""):
+                blockId = base64.b64encode(f"{len(blockIds):08d}".encode()).decode()
+                self.request(self.url(key, f"comp=block&blockid={urllib.parse.quote(blockId)}"), block, {})
+                blockIds.append(blockId)
+
+        blockList = "".join(f"<Latest>{blockId}</Latest>" for blockId in blockIds)
+        self.request(self.url(key, "comp=blocklist"), f'<?xml version="1.0" encoding="utf-8"?><BlockList>{blockList}</BlockList>'.encode(), {"Content-Type": "application/xml"})
+
+class FsspecStore:
+    '''
+        Uploads the files to any fsspec file system, such as az:// or abfs:// with adlfs.
+    '''
+
+    def __init__(self, url):
+        self.url = url
+
+    def put(self, localPath, key):
+        fs, root = fsspec.core.url_to_fs(self.url)
+        fs.put_file(localPath, f"{root.rstrip('/')}/{key}")
+
+def workerSink(key, stagingDir, store, concurrency, maxStagedMB, retries):
+    '''
+        Returns the upload sink of the current process for the sink with this key, created the first time a task of the
+        process gets it. The sink is closed when the process exits, which waits for its uploads: the pool must be closed
+        and joined (see processSignals), as the workers of a terminated pool do not finish their uploads.
+    '''
+    if key not in processSinks:
+        sink = UploadSink(stagingDir, store, concurrency, maxStagedMB, retries, key)
+        util.Finalize(sink, sink.close, exitpriority=10)
+        processSinks[key] = sink
+
+    return processSinks[key]
+
+def openOutputSink(target, outputUrl=None, concurrency=4, maxStagedMB=1024):
+    '''
+        Creates the sink of the output files written to target.
+
+        Args:
+            target: the directory where the files are written, the staging directory of the uploads
+            outputUrl: None to keep the files in target, a file:// URL to copy them to a local directory (emulator),
+                       an http(s) container URL with a SAS token, or a fsspec URL (az://, abfs://...)
+            concurrency: the maximum number of uploads at a time of each process
+            maxStagedMB: the size of the files waiting for upload above which each process waits for the uploads
+    '''
+    if outputUrl is None:
+        return FileSystemSink()
+
+    scheme = urllib.parse.urlparse(outputUrl).scheme
+
+    if scheme == "file":
+        store = LocalDirectoryStore(urllib.request.url2pathname(urllib.parse.urlparse(outputUrl).path))
+    elif scheme in ("http", "https"):
+        store = HttpBlobStore(outputUrl)
+    elif fsspec is None:
+        raise ValueError(f"Uploading to {outputUrl} requires fsspec and the package of its protocol, for example adlfs for az:// URLs")
+    else:
+        store = FsspecStore(outputUrl)
+
+    return UploadSink(target, store, concurrency, maxStagedMB)
+
+def commitOutput(localPath):
+    '''
+        Hands a finished output file of the current task to its sink, does nothing outside of a task with a sink.
+    '''
+    if currentSink is not None:
+        currentSink.commit(localPath)
+
+def withOutputSink(method):
+    '''
+        Decorates a worker method so the files it writes are handed to the sink given in its outputSink keyword argument
+        (see commitOutput). The task returns without waiting for its uploads, which overlap with the next tasks of the
+        worker and are finished when it exits (see workerSink). Files that cannot be uploaded are logged and kept in the
+        target directory.
+    '''
+    @functools.wraps(method)
+    def uploadingMethod(*args, outputSink=None, **kwargs):
+        global currentSink
+
+        if outputSink is None:
+            return method(*args, **kwargs)
+
+        currentSink = outputSink
+        try:
+            return method(*args, **kwargs)
+        finally:
+            currentSink = None
+
+    return uploadingMethod
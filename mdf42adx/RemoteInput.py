@@ -0,0 +1,295 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+from asammdf import MDF
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+from pathlib import Path, PurePosixPath
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# fsspec reads from other object stores (az://, abfs://, s3://...), if it is not installed only http(s) URLs can be read
+try:
+    import fsspec
+except ImportError:
+    fsspec = None
+
+# Size of the blocks read from a remote file, number of blocks kept in memory and number of blocks read ahead of a
+# sequential read, configured with the REMOTE_BLOCK_SIZE_MB, REMOTE_CACHE_BLOCKS and REMOTE_READAHEAD_BLOCKS environment
+# variables so they also apply to the pool workers
+DEFAULT_BLOCK_SIZE_MB = 4
+DEFAULT_CACHE_BLOCKS = 32
+DEFAULT_READAHEAD_BLOCKS = 4
+
+# Threads of the current process that read blocks ahead, shared by all remote files
+readaheadExecutor = None
+
+def isRemote(location):
+    '''
+        Returns True if the location is a URL (http(s)://, az://, abfs://...) instead of a local path.
+    '''
+    return re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]+://", str(location)) is not None and not str(location).startswith("file://")
+
+def inputBasename(location):
+    '''
+        Returns the name of a local or remote MDF-4 file without extension, ignoring the query of a URL (e.g. a SAS token).
+    '''
+    if isRemote(location):
+        return PurePosixPath(urllib.parse.unquote(urllib.parse.urlparse(location).path)).stem
+
+    return Path(location).stem
+
+def openMdf(location):
+    '''
+        Opens a local MDF-4 file, or a remote one that is read with ranged reads (see RangedReader), so only the
+        blocks that are needed are downloaded and the decoding starts without waiting for the whole file.
+    '''
+    if not isRemote(location):
+        return MDF(location)
+
+    return MDF(MdfInputStream(openRangedReader(location)))
+
+def openInput(location):
+    '''
+        Opens a local or remote MDF-4 file as a binary file object.
+    '''
+    if not isRemote(location):
+        return open(location, 'rb')
+
+    return io.BufferedReader(openRangedReader(location), buffer_size=2**20)
+
+def openRangedReader(location):
+    '''
+        Creates the RangedReader of a remote file, with the block size, cache and readahead of the environment variables.
+    '''
+    return RangedReader(
+        rangeSource(location),
+        blockSize=int(float(os.environ.get('REMOTE_BLOCK_SIZE_MB', DEFAULT_BLOCK_SIZE_MB)) * 2**20),
+        cacheBlocks=int(os.environ.get('REMOTE_CACHE_BLOCKS', DEFAULT_CACHE_BLOCKS)),
+        readahead=int(os.environ.get('REMOTE_READAHEAD_BLOCKS', DEFAULT_READAHEAD_BLOCKS)),
+    )
+
+def rangeSource(location):
+    '''
+        Returns the source of the ranged reads of a URL: http(s) URLs (including Azure Blob Storage URLs with a SAS token)
+        are read with HTTP range requests, other protocols with fsspec.
+    '''
+    if urllib.parse.urlparse(location).scheme in ("http", "https"):
+        return HttpRangeSource(location)
+
+    if fsspec is None:
+        raise ValueError(f"Reading {location} requires fsspec and the package of its protocol, for example adlfs for az:// URLs")
+
+    return FsspecRangeSource(location)
+
+class HttpRangeSource:
+    '''
+        Reads byte ranges of a file served over HTTP, such as an Azure Blob Storage URL with a SAS token.
+        Failed requests are retried with exponential backoff.
+    '''
+
+    def __init__(self, url, timeout=60, retries=3):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+
+    def request(self, headers, method="GET"):
+        for attempt in range(self.retries + 1):
+            try:
+                with urllib.request.urlopen(urllib.request.Request(self.url, headers=headers, method=method), timeout=self.timeout) as response:
+                    return response.status, response.headers, response.read()
+
+            except urllib.error.HTTPError as e:
+                # Client errors (not found, forbidden, expired SAS token) will not succeed when retried
+                if e.code < 500 or attempt == self.retries:
+                    raise
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                if attempt == self.retries:
+                    raise
+
+            time.sleep(2 ** attempt)
+
+    def size(self):
+        _, headers, _ = self.request({}, method="HEAD")
+
+        return int(headers["Content-Length"])
+
+    def fetch(self, start, end):
+        '''
+            Returns the bytes from start to end (excluded).
+        '''
+        status, _, data = self.request({"Range": f"bytes={start}-{end - 1}"})
+
+        # A server without range support returns the whole file
+        if status != 206:
+            raise IOError(f"{self.url} does not support range requests (status {status})")
+
+        if len(data) != end - start:
+            raise IOError(f"Incomplete range {start}-{end - 1} of {self.url}: received {len(data)} bytes")
+
+        return data
+
+class FsspecRangeSource:
+    '''
+        Reads byte ranges of a file of any fsspec file system, such as az:// or abfs:// with adlfs.
+    '''
+
+    def __init__(self, url):
+        self.fs, self.path = fsspec.core.url_to_fs(url)
+
+    def size(self):
+        return self.fs.size(self.path)
+
+    def fetch(self, start, end):
+        return self.fs.cat_file(self.path, start=start, end=end)
+
+class RangedReader(io.RawIOBase):
+    '''
+        Reads a remote file in fixed size blocks fetched on demand from a range source.
+
+        The last cacheBlocks blocks that were used are kept in memory, so the blocks of the MDF-4 structure that are read
+        many times (header, channel groups) are downloaded once. When the blocks are read in order (the data blocks of a
+        channel group), the next readahead blocks are fetched in the background while the current ones are decoded.
+    '''
+
+    def __init__(self, source, blockSize=DEFAULT_BLOCK_SIZE_MB * 2**20, cacheBlocks=DEFAULT_CACHE_BLOCKS, readahead=DEFAULT_READAHEAD_BLOCKS):
+        self.source = source
+        self.blockSize = blockSize
+        self.cacheBlocks = max(cacheBlocks, 1)
+        self.readahead = readahead
+        self.length = source.size()
+        self.position = 0
+        self.blocks = OrderedDict() # block index -> bytes, from least to most recently used
+        self.pending = {} # block index -> future of the blocks read ahead
+        self.lastBlock = None
+        self.bytesFetched = 0
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.length + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+
+        return self.position
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+
+        end = min(self.position + size, self.length)
+        chunks = []
+
+        while self.position < end:
+            index, offset = divmod(self.position, self.blockSize)
+            block = self.block(index)
+            chunk = block[offset:offset + end - self.position]
+            chunks.append(chunk)
+            self.position += len(chunk)
+
+        return b"".join(chunks)
+
+    def block(self, index):
+        '''
+            Returns a block from the cache, the blocks read ahead or the source, and reads the next blocks ahead if the
+            blocks are read in order.
+        '''
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+            data = self.blocks[index]
+        else:
+            future = self.pending.pop(index, None)
+            data = future.result() if future is not None else self.fetch(index)
+
+            self.blocks[index] = data
+            while len(self.blocks) > self.cacheBlocks:
+                self.blocks.popitem(last=False)
+
+        if self.readahead > 0 and self.lastBlock is not None and index == self.lastBlock + 1:
+            self.readAhead(index)
+        self.lastBlock = index
+
+        return data
+
+    def readAhead(self, index):
+        global readaheadExecutor
+
+        if readaheadExecutor is None:
+            readaheadExecutor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="RangedReader")
+
+        for nextIndex in range(index + 1, min(index + 1 + self.readahead, -(-self.length // self.blockSize))):
+            if nextIndex not in self.blocks and nextIndex not in self.pending:
+                self.pending[nextIndex] = readaheadExecutor.submit(self.fetch, nextIndex)
+
+        # The data of a channel group is read in order, but the reads can jump to a data list and back, so the blocks read
+        # ahead are kept until they are used, and only the oldest ones are dropped when there are more than the cache holds
+        while len(self.pending) > self.cacheBlocks:
+            self.pending.pop(next(iter(self.pending))).cancel()
+
+    def fetch(self, index):
+        start = index * self.blockSize
+        data = self.source.fetch(start, min(start + self.blockSize, self.length))
+
+        self.bytesFetched += len(data)
+        self.requests += 1
+
+        return data
+
+    def close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = {}
+        self.blocks = OrderedDict()
+        super().close()
+
+class MdfInputStream(io.BytesIO):
+    '''
+        Adapts a RangedReader to the streams accepted by asammdf, which reads file objects that are a BytesIO (or an
+        fsspec file) with read, seek and tell. The BytesIO buffer itself is never used.
+    '''
+
+    def __init__(self, reader):
+        super().__init__()
+        self.reader = reader
+
+    def read(self, size=-1):
+        return self.reader.read(size)
+
+    def read1(self, size=-1):
+        return self.reader.read(size)
+
+    def readinto(self, buffer):
+        return self.reader.readinto(buffer)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.reader.seek(offset, whence)
+
+    def tell(self):
+        return self.reader.tell()
+
+    def close(self):
+        self.reader.close()
+        super().close()
@@ -0,0 +1,121 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+import json
+import os
+import re
+import pyarrow.parquet as pq
+
+def findCompletedSignals(basename, uuid, target, signalsMetadata):
+    '''
+        Finds the signals that a previous run with the same run ID already exported, so they don't need to be decoded again.
+
+        A signal is completed if the report (or metadata) of the previous run marks it as processed and its output file
+        is in the output directory. If the previous run did not finish and wrote no report, the parquet files with a valid
+        footer are considered complete. Failed and timed out signals are never completed.
+        Coalesced files that hold no completed signal are removed, as their signals will be written again.
+
+        Args:
+            basename: the base name of the metadata file
+            uuid: the content-addressed run ID (see MetadataTools.calculateRunId)
+            target: the target directory of the previous run
+            signalsMetadata: the list of signals of the file
+        Returns:
+            a dictionary with the result of the previous run for each completed signal counter
+    '''
+    targetdir = os.path.join(target, f"{basename}-{uuid}")
+
+    if not os.path.isdir(targetdir):
+        return {}
+
+    # Wide files are written in a folder per channel group, files are listed with their path relative to targetdir
+    outputFiles = set(os.path.relpath(os.path.join(folder, file), targetdir).replace(os.sep, "/") for folder, _, files in os.walk(targetdir) for file in files)
+    previousResults = readPreviousResults(basename, uuid, target)
+
+    completedSignals = {}
+    for counter, signalMetadata in enumerate(signalsMetadata):
+        value = previousResults.get(counter)
+
+        if value is not None:
+            if value[1] == True and hasOutput(value, counter, signalMetadata, uuid, outputFiles):
+                completedSignals[counter] = value
+
+        elif previousResults == {}:
+            numberOfSamples = readParquetOutput(targetdir, signalMetadata, outputFiles)
+            if numberOfSamples is not None:
+                completedSignals[counter] = (f"pid {os.getpid()}", True, counter, f"Found existing output for signal {counter}: {signalMetadata['name']}", numberOfSamples)
+
+    removeOrphanFiles(targetdir, completedSignals, outputFiles)
+
+    print(f"Found {len(completedSignals)} of {len(signalsMetadata)} signals already exported in {targetdir}")
+
+    return completedSignals
+
+def readPreviousResults(basename, uuid, target):
+    '''
+        Reads the results of a previous run from its report, or from its metadata file if there is no report.
+
+        Returns:
+            a dictionary with the result of each signal counter that finished, empty if the run left no report
+    '''
+    reportFile = os.path.join(target, f"{basename}-{uuid}.report.json")
+    metadataFile = os.path.join(target, f"{basename}-{uuid}.metadata.json")
+
+    if os.path.isfile(reportFile):
+        with open(reportFile) as report:
+            return {entry["counter"]: entry["value"] for entry in json.load(report)["finished"]}
+
+    if os.path.isfile(metadataFile):
+        with open(metadataFile) as metadata:
+            signals = json.load(metadata)["signals"]
+
+        return {
+            counter: ("metadata", signal["signal_decoded_status"], counter, signal["message"], signal["records_count"])
+            for counter, signal in enumerate(signals) if "signal_decoded_status" in signal
+        }
+
+    return {}
+
+def hasOutput(value, counter, signalMetadata, uuid, outputFiles):
+    '''
+        Checks that the output file of a processed signal exists, signals without samples have no output.
+    '''
+    if value[4] == 0:
+        return True
+
+    # Coalesced and wide files are listed in the result, as are the files of a signal since they can have other formats
+    if len(value) > 5 and "file" in value[5]:
+        return value[5]["file"] in outputFiles
+    if len(value) > 5 and "output" in value[5]:
+        return value[5]["output"] in outputFiles
+
+    escapedName = re.sub(r"[^a-zA-Z0-9_]", "_", signalMetadata["name"])
+
+    return f"{signalMetadata['group_index']}-{signalMetadata['channel_index']}-{escapedName}-0.parquet" in outputFiles or f"{escapedName}-{uuid}-{counter}.csv.gz" in outputFiles
+
+def removeOrphanFiles(targetdir, completedSignals, outputFiles):
+    '''
+        Removes the coalesced and wide parquet files that contain no completed signal, written by a run that did not finish.
+        Their signals are decoded again, so keeping them would duplicate the data in the external table.
+    '''
+    referencedFiles = {value[5]["file"] for value in completedSignals.values() if len(value) > 5 and "file" in value[5]}
+
+    for outputFile in outputFiles:
+        # Coalesced files are named {group}-{first counter}-{file counter}.parquet, wide files are in a group-{group} folder
+        if re.fullmatch(r"(group-\d+/)?\d+-\d+-\d+\.parquet", outputFile) and outputFile not in referencedFiles:
+            print(f"Removing incomplete output {outputFile}")
+            os.remove(os.path.join(targetdir, outputFile))
+
+def readParquetOutput(targetdir, signalMetadata, outputFiles):
+    '''
+        Returns the number of rows of the parquet file of a signal, or None if there is no file or it is incomplete.
+    '''
+    escapedName = re.sub(r"[^a-zA-Z0-9_]", "_", signalMetadata["name"])
+    parquetFile = f"{signalMetadata['group_index']}-{signalMetadata['channel_index']}-{escapedName}-0.parquet"
+
+    if parquetFile not in outputFiles:
+        return None
+
+    try:
+        return pq.read_metadata(os.path.join(targetdir, parquetFile)).num_rows
+    except Exception:
+        return None
@@ -0,0 +1,218 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+import numpy as np
+from asammdf import Signal
+from SignalFilter import SignalFilter
+
+DOWNSAMPLING_METHODS = ["mean", "min", "max", "last"]
+
+class SampleReduction:
+    '''
+        The time window and the downsampling of a run, resolved into a SignalReduction for each signal.
+
+        A downsampling rule is [signal filter rule=]interval[:method], e.g. 0.1:mean for all signals or bus:CAN=1:last,
+        with the interval in seconds and one of the DOWNSAMPLING_METHODS (mean by default). The signal filter rule has the
+        syntax of SignalFilter. The first rule that matches a signal is used.
+    '''
+
+    def __init__(self, start=None, stop=None, downsamplingRules=None):
+        self.start = start
+        self.stop = stop
+        self.downsamplingRules = [self.parseRule(rule) for rule in downsamplingRules or []]
+
+    @staticmethod
+    def parseRule(rule):
+        '''
+            Returns the signal filter, interval and method of a downsampling rule, raises ValueError if the rule is not valid.
+        '''
+        signalRule, separator, downsampling = rule.rpartition("=")
+        interval, _, method = downsampling.partition(":")
+        method = method or "mean"
+
+        try:
+            interval = float(interval)
+        except ValueError:
+            raise ValueError(f"Invalid interval in downsampling rule {rule}")
+
+        if interval <= 0:
+            raise ValueError(f"Invalid interval in downsampling rule {rule}, it must be greater than 0")
+
+        if method not in DOWNSAMPLING_METHODS:
+            raise ValueError(f"Invalid method in downsampling rule {rule}, use one of {', '.join(DOWNSAMPLING_METHODS)}")
+
+        return SignalFilter([signalRule]) if separator else None, interval, method
+
+    def forSignal(self, signalMetadata):
+        '''
+            Returns the SignalReduction of a signal, or None if all of its samples are exported.
+        '''
+        interval, method = None, None
+
+        for signalFilter, ruleInterval, ruleMethod in self.downsamplingRules:
+            if signalFilter is None or signalFilter.isSelected(signalMetadata):
+                interval, method = ruleInterval, ruleMethod
+                break
+
+        if self.start is None and self.stop is None and interval is None:
+            return None
+
+        return SignalReduction(self.start, self.stop, interval, method)
+
+class SignalReduction:
+    '''
+        Reduces the samples of a signal to a time window (in seconds since the start of the recording), and optionally
+        to one sample per interval.
+
+        The buckets of the interval are aligned to multiples of the interval, so signals of the same file share the same
+        time grid. mean averages the samples of each bucket and uses the start of the bucket as timestamp. min, max and
+        last keep the sample of the bucket with the minimum, maximum or last value, with its timestamp and raw value.
+        Signals that are not numeric (text, byte arrays, records) always keep the last sample of each bucket.
+    '''
+
+    def __init__(self, start=None, stop=None, interval=None, method="mean"):
+        self.start = start
+        self.stop = stop
+        self.interval = interval
+        self.method = method
+
+    def crop(self, rawSignal):
+        '''
+            Returns the samples of the raw signal in the time window, without interpolating samples at its ends.
+        '''
+        if self.start is None and self.stop is None:
+            return rawSignal
+
+        return rawSignal.cut(self.start, self.stop, include_ends=False)
+
+    def splitOpenBucket(self, rawSignal):
+        '''
+            Splits a raw signal decoded in windows into the samples of its complete buckets and the samples of its last
+            bucket, which can continue in the next window. The last bucket is downsampled with the samples of the next
+            window, so a window boundary does not split a bucket.
+
+            Returns:
+                the raw signal with the complete buckets, and the raw signal of the last bucket or None
+        '''
+        timestamps = rawSignal.timestamps
+
+        if self.interval is None or len(timestamps) == 0:
+            return rawSignal, None
+
+        buckets = np.floor(timestamps / self.interval).astype(np.int64)
+        split = int(np.searchsorted(buckets, buckets[-1]))
+
+        return sliceSignal(rawSignal, 0, split), sliceSignal(rawSignal, split, len(timestamps))
+
+    def downsample(self, decodedSignal, rawSignal):
+        '''
+            Returns the decoded and raw signals with one sample per interval.
+        '''
+        timestamps = decodedSignal.timestamps
+
+        if self.interval is None or len(timestamps) == 0:
+            return decodedSignal, rawSignal
+
+        # The timestamps are sorted, so each bucket is a contiguous range of samples
+        buckets = np.floor(timestamps / self.interval).astype(np.int64)
+        boundaries = np.flatnonzero(np.diff(buckets)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(timestamps)])) - 1
+
+        samples = decodedSignal.samples
+        method = self.method if isNumeric(samples) else "last"
+
+        if method == "mean":
+            counts = ends - starts + 1
+            bucketTimestamps = buckets[starts] * self.interval
+
+            rawSamples = rawSignal.samples
+            if isNumeric(rawSamples):
+                rawSamples = np.add.reduceat(rawSamples.astype(np.float64), starts) / counts
+            else:
+                rawSamples = rawSamples[ends]
+
+            return (
+                replaceSamples(decodedSignal, np.add.reduceat(samples.astype(np.float64), starts) / counts, bucketTimestamps),
+                replaceSamples(rawSignal, rawSamples, bucketTimestamps),
+            )
+
+        if method == "last":
+            indexes = ends
+        else:
+            # Sorted by bucket and value, the first sample of each bucket has the minimum and the last one the maximum
+            order = np.lexsort((samples, buckets))
+            indexes = order[starts] if method == "min" else order[ends]
+
+        return (
+            replaceSamples(decodedSignal, samples[indexes], timestamps[indexes], indexes),
+            replaceSamples(rawSignal, rawSignal.samples[indexes], timestamps[indexes], indexes),
+        )
+
+def isNumeric(samples):
+    return samples.ndim == 1 and samples.dtype.kind in "biuf"
+
+def sliceSignal(signal, start, end):
+    '''
+        Returns a copy of the samples from start to end (excluded) of the signal.
+    '''
+    return replaceSamples(signal, signal.samples[start:end], signal.timestamps[start:end], slice(start, end))
+
+def concatenateSignals(first, second):
+    '''
+        Returns a signal with the samples of first followed by the samples of second, two consecutive parts of a signal.
+    '''
+    invalidation_bits = None
+    if first.invalidation_bits is not None or second.invalidation_bits is not None:
+        invalidation_bits = np.concatenate([
+            signal.invalidation_bits if signal.invalidation_bits is not None else np.zeros(len(signal.timestamps), dtype=bool)
+            for signal in (first, second)
+        ])
+
+    # Byte arrays of different lengths are concatenated with the length of the longest one
+    signal = replaceSamples(second, np.concatenate((first.samples, second.samples)), np.concatenate((first.timestamps, second.timestamps)))
+    signal.invalidation_bits = invalidation_bits
+
+    return signal
+
+def replaceSamples(signal, samples, timestamps, indexes=None):
+    '''
+        Returns a copy of the signal with other samples, indexes selects their invalidation bits.
+    '''
+    invalidation_bits = None
+    if signal.invalidation_bits is not None and indexes is not None:
+        invalidation_bits = signal.invalidation_bits[indexes]
+
+    return Signal(
+        samples,
+        timestamps,
+        unit=signal.unit,
+        name=signal.name,
+        conversion=signal.conversion,
+        comment=signal.comment,
+        raw=signal.raw,
+        master_metadata=signal.master_metadata,
+        display_names=signal.display_names,
+        attachment=signal.attachment,
+        source=signal.source,
+        invalidation_bits=invalidation_bits,
+        encoding=signal.encoding,
+        group_index=signal.group_index,
+        channel_index=signal.channel_index,
+        flags=signal.flags,
+    )
+
+def readSampleReduction(start=None, stop=None, downsamplingRules=None):
+    '''
+        Creates the sample reduction of a run from the command line options.
+
+        Args:
+            start: the start of the time window in seconds since the start of the recording, None for the first sample
+            stop: the end of the time window in seconds since the start of the recording, None for the last sample
+            downsamplingRules: the downsampling rules (see SampleReduction)
+        Returns:
+            the SampleReduction, or None if all samples are exported
+    '''
+    if start is None and stop is None and not downsamplingRules:
+        return None
+
+    return SampleReduction(start, stop, downsamplingRules)
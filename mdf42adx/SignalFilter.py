@@ -0,0 +1,104 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+from fnmatch import fnmatchcase
+import re
+
+class SignalFilter:
+    '''
+        Selects the signals of a MDF-4 file that are decoded, using their metadata (see MetadataTools.calculateMetadata).
+
+        A rule is a glob pattern on the signal name, or [field]:[glob] or [field]~[regex] for one of the fields:
+            - name: the name of the signal, e.g. name~^Engine(RPM|Power)$
+            - bus: the bus type of the signal source, e.g. bus:CAN
+            - source: the name of the signal source or of the acquisition source (ECU) of its channel group, e.g. source:ECU_*
+            - group: the channel group index, e.g. group:3
+
+        A signal is selected if it matches one of the include rules (or there are none) and none of the exclude rules.
+    '''
+
+    FIELDS = {
+        "name": lambda signal: [signal["name"]],
+        "bus": lambda signal: [signal["bus_type"]],
+        "source": lambda signal: [signal["source"], signal["acq_source_name"]],
+        "group": lambda signal: [str(signal["group_index"])],
+    }
+
+    def __init__(self, includeRules=None, excludeRules=None):
+        self.rules = (list(includeRules or []), list(excludeRules or []))
+        self.includeRules = [self.parseRule(rule) for rule in includeRules or []]
+        self.excludeRules = [self.parseRule(rule) for rule in excludeRules or []]
+
+    def __reduce__(self):
+        # The matching functions can't be pickled, workers parse the rules again
+        return (SignalFilter, self.rules)
+
+    @classmethod
+    def parseRule(cls, rule):
+        '''
+            Returns the field and the matching function of a rule, raises ValueError if the regular expression is not valid.
+        '''
+        match = re.fullmatch(r"(name|bus|source|group)([:~])(.*)", rule)
+
+        if match is None:
+            return cls.FIELDS["name"], lambda value: fnmatchcase(value, rule)
+
+        field, operator, pattern = match.groups()
+
+        if operator == "~":
+            try:
+                expression = re.compile(pattern)
+            except re.error as e:
+                raise ValueError(f"Invalid regular expression in signal filter rule {rule}: {e}")
+
+            return cls.FIELDS[field], lambda value: expression.search(value) is not None
+
+        return cls.FIELDS[field], lambda value: fnmatchcase(value, pattern)
+
+    @staticmethod
+    def matches(rules, signalMetadata):
+        return any(matcher(value) for field, matcher in rules for value in field(signalMetadata) if value is not None)
+
+    def isSelected(self, signalMetadata):
+        '''
+            Returns True if the signal has to be decoded.
+        '''
+        if self.includeRules and not self.matches(self.includeRules, signalMetadata):
+            return False
+
+        return not self.matches(self.excludeRules, signalMetadata)
+
+def readSignalFilter(filterFile=None, includeRules=None, excludeRules=None):
+    '''
+        Creates the signal filter from a file and the rules given in the command line.
+
+        The file has a rule per line. Lines starting with + are include rules, other lines are exclude rules (optionally
+        starting with -), so a list of signal names is a blacklist. Empty lines and lines starting with # are ignored.
+
+        Args:
+            filterFile: the path of the filter file, None for no file
+            includeRules: the additional include rules
+            excludeRules: the additional exclude rules
+        Returns:
+            the SignalFilter, or None if there are no rules and all signals are decoded
+    '''
+    includeRules = list(includeRules or [])
+    excludeRules = list(excludeRules or [])
+
+    if filterFile is not None:
+        with open(filterFile) as rules:
+            for line in rules:
+                rule = line.strip()
+
+                if rule == "" or rule.startswith("#"):
+                    continue
+                elif rule.startswith("+"):
+                    includeRules.append(rule[1:].strip())
+                elif rule.startswith("-"):
+                    excludeRules.append(rule[1:].strip())
+                else:
+                    excludeRules.append(rule)
+
+    if not includeRules and not excludeRules:
+        return None
+
+    return SignalFilter(includeRules, excludeRules)
@@ -0,0 +1,265 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+from contextlib import contextmanager
+import functools
+import numpy as np
+import os
+import sys
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Stages of the decoding of a signal, in the order in which they happen
+STAGES = ["open", "select", "decode", "extract", "share", "build", "write"]
+
+# Telemetry of the task running in the current worker process, None outside of a task
+currentTask = None
+
+class TaskTelemetry:
+    '''
+        Time and bytes of each stage of a task. Stages run while a signal of the task is being processed are attributed
+        to that signal, the others (opening the file, reading a channel group) are shared by all signals of the task.
+
+        The memory of a signal is the growth of the resident memory of the worker from the start of its first stage to
+        the highest one at the end of its stages, with the shared stages for a task with a single signal. The peak memory of the worker (worker_peak_rss_mb) is the peak of
+        the whole life of the process, which includes the signals decoded before by the same worker.
+    '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.signal = None
+        self.stages = {} # (counter, stage) -> [seconds, bytes read, bytes written], counter None for the shared stages
+        self.memory = {} # counter -> [resident memory before its first stage, highest resident memory after its stages]
+        self.process = psutil.Process() if psutil is not None else None
+
+    def ioCounters(self):
+        '''
+            Returns the bytes read and written by the process, including the reads served by the page cache.
+        '''
+        if self.process is None:
+            return None, None
+
+        try:
+            counters = self.process.io_counters()
+            return counters.read_chars, counters.write_chars
+        except (AttributeError, psutil.Error):
+            # io_counters is not available on macOS
+            return None, None
+
+    def residentMemory(self):
+        '''
+            Returns the current resident memory of the process in bytes.
+        '''
+        if self.process is None:
+            return None
+
+        try:
+            return self.process.memory_info().rss
+        except psutil.Error:
+            return None
+
+    def add(self, name, seconds, bytesRead, bytesWritten, memoryBefore=None, memoryAfter=None):
+        totals = self.stages.setdefault((self.signal, name), [0.0, 0, 0])
+        totals[0] += seconds
+        totals[1] += bytesRead or 0
+        totals[2] += bytesWritten or 0
+
+        if memoryBefore is not None and memoryAfter is not None:
+            memory = self.memory.setdefault(self.signal, [memoryBefore, memoryAfter])
+            memory[1] = max(memory[1], memoryAfter)
+
+    def signalTelemetry(self, counter, numberOfSignals):
+        '''
+            Returns the telemetry of a signal, with its share of the shared stages.
+        '''
+        timings = {}
+        bytesRead = 0
+        bytesWritten = 0
+        # The stages of a task with a single signal may not be attributed to it, their memory is the memory of the signal
+        memory = [self.memory[signal] for signal in ((counter, None) if numberOfSignals == 1 else (counter,)) if signal in self.memory]
+
+        for (signal, name), (seconds, read, written) in self.stages.items():
+            if signal is None:
+                seconds, read, written = seconds / numberOfSignals, read / numberOfSignals, written / numberOfSignals
+            elif signal != counter:
+                continue
+            timings[name] = timings.get(name, 0.0) + seconds
+            bytesRead += read
+            bytesWritten += written
+
+        return {
+            "pid": os.getpid(),
+            "seconds": sum(timings.values()),
+            "timings": timings,
+            "bytes_read": int(bytesRead),
+            "bytes_written": int(bytesWritten),
+            "rss_growth_mb": max(max(after for _, after in memory) - min(before for before, _ in memory), 0) / 2**20 if memory else None,
+            "worker_peak_rss_mb": peakMemoryMB(),
+            "task_seconds": time.perf_counter() - self.start,
+            "task_signals": numberOfSignals,
+        }
+
+def peakMemoryMB():
+    '''
+        Returns the peak resident memory of the current process in MB, or the current one if the peak is not available.
+    '''
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes and macOS bytes
+        return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+
+    return None
+
+@contextmanager
+def stage(name):
+    '''
+        Measures a stage of the current task, does nothing outside of a task.
+    '''
+    task = currentTask
+
+    if task is None:
+        yield
+        return
+
+    readBefore, writtenBefore = task.ioCounters()
+    memoryBefore = task.residentMemory()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        readAfter, writtenAfter = task.ioCounters()
+        task.add(name, seconds, readAfter - readBefore if readBefore is not None else None, writtenAfter - writtenBefore if writtenBefore is not None else None, memoryBefore, task.residentMemory())
+
+def setSignal(counter):
+    '''
+        Attributes the next stages of the current task to a signal, None for the stages shared by the signals of the task.
+    '''
+    if currentTask is not None:
+        currentTask.signal = counter
+
+def withTelemetry(method):
+    '''
+        Decorates a worker method that processes a signal or a batch of signals: the telemetry of each signal is added
+        to the details element of its result (see processSignals) under "telemetry".
+    '''
+    @functools.wraps(method)
+    def measuredMethod(*args, **kwargs):
+        global currentTask
+
+        currentTask = TaskTelemetry()
+        try:
+            result = method(*args, **kwargs)
+
+            results = result if isinstance(result, list) else [result]
+            # Skipped signals can have a shorter result, without number of samples, they are returned unchanged
+            measured = [addTelemetry(value, currentTask.signalTelemetry(value[2], len(results))) if len(value) >= 5 else value for value in results]
+
+            return measured if isinstance(result, list) else measured[0]
+        finally:
+            currentTask = None
+
+    return measuredMethod
+
+def addTelemetry(value, telemetry):
+    details = dict(value[5]) if len(value) > 5 else {}
+    # A signal processed by two processes (see DecodePipeline) has the telemetry of both
+    details["telemetry"] = mergeTelemetry(details["telemetry"], telemetry) if "telemetry" in details else telemetry
+
+    return tuple(value[:5]) + (details,)
+
+def mergeTelemetry(first, second):
+    '''
+        Returns the telemetry of a signal processed by a task in a process and then by a task in another process,
+        identified by the pid of the first one.
+    '''
+    timings = dict(first["timings"])
+    for name, seconds in second["timings"].items():
+        timings[name] = timings.get(name, 0.0) + seconds
+
+    # The processes hold the signal one after the other, its memory is the highest growth of the two
+    growths = [telemetry.get("rss_growth_mb") for telemetry in (first, second) if telemetry.get("rss_growth_mb") is not None]
+
+    return dict(first,
+        seconds=first["seconds"] + second["seconds"],
+        timings=timings,
+        bytes_read=first["bytes_read"] + second["bytes_read"],
+        bytes_written=first["bytes_written"] + second["bytes_written"],
+        rss_growth_mb=max(growths) if growths else None,
+        task_seconds=first["task_seconds"] + second["task_seconds"],
+        writer_pid=second["pid"],
+        writer_peak_rss_mb=second["worker_peak_rss_mb"],
+    )
+
+def summarizeTelemetry(finishedSignals, top=10):
+    '''
+        Aggregates the telemetry of the finished signals for the report: percentiles of the time of each stage and of
+        the memory of each signal, totals of bytes read and written, the peak memory of each worker and the slowest signals.
+
+        Args:
+            finishedSignals: the finished signals, as recorded by SignalsDecoding
+            top: the number of slowest signals to list
+    '''
+    measured = [signal for signal in finishedSignals if len(signal["value"]) > 5 and "telemetry" in signal["value"][5]]
+
+    if len(measured) == 0:
+        return None
+
+    telemetries = [signal["value"][5]["telemetry"] for signal in measured]
+
+    def percentiles(values):
+        values = np.array(values, dtype=np.float64)
+        return {
+            "sum": float(values.sum()),
+            "p50": float(np.percentile(values, 50)),
+            "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)),
+            "max": float(values.max()),
+        }
+
+    stages = {name: percentiles([telemetry["timings"].get(name, 0.0) for telemetry in telemetries]) for name in STAGES if any(name in telemetry["timings"] for telemetry in telemetries)}
+
+    slowest = sorted(zip(measured, telemetries), key=lambda item: item[1]["seconds"], reverse=True)[:top]
+    growths = [telemetry["rss_growth_mb"] for telemetry in telemetries if telemetry.get("rss_growth_mb") is not None]
+
+    # The peak of a worker is reported by each of its signals, the last one is the peak of its whole life
+    workerPeaks = {}
+    for telemetry in telemetries:
+        for pid, peak in ((telemetry["pid"], telemetry["worker_peak_rss_mb"]), (telemetry.get("writer_pid"), telemetry.get("writer_peak_rss_mb"))):
+            if pid is not None and peak is not None:
+                workerPeaks[pid] = max(workerPeaks.get(pid, 0.0), peak)
+
+    return {
+        "signals": len(measured),
+        "seconds": percentiles([telemetry["seconds"] for telemetry in telemetries]),
+        "stages": stages,
+        "bytes_read": sum(telemetry["bytes_read"] for telemetry in telemetries),
+        "bytes_written": sum(telemetry["bytes_written"] for telemetry in telemetries),
+        "rss_growth_mb": percentiles(growths) if growths else None,
+        "worker_peak_rss_mb": max(workerPeaks.values()) if workerPeaks else None,
+        "workers_peak_rss_mb": {str(pid): peak for pid, peak in workerPeaks.items()},
+        "workers": len(set(telemetry["pid"] for telemetry in telemetries)),
+        "slowest": [
+            {
+                "counter": signal["counter"],
+                "name": signal["name"],
+                "samples": signal["value"][4],
+                "seconds": telemetry["seconds"],
+                "timings": telemetry["timings"],
+                "rss_growth_mb": telemetry.get("rss_growth_mb"),
+                "pid": telemetry["pid"],
+            }
+            for signal, telemetry in slowest
+        ],
+    }